@@ -1,49 +1,302 @@
 import os
+import logging
+import threading
+import time
+import click
 import mysql.connector
-from datetime import datetime, timedelta
+from datetime import datetime
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, send_from_directory, jsonify
+    session, flash, jsonify, abort
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+
+import archive
+import assets
+import fragments
+import instrumentation
+import interactions
+import jobs
+import media
+import migrations
+import passwords
+import responses
+import search
+import storage
+import stories
+import timelines
+import users
+from db import (
+    get_db, get_read_db, get_pool, pick_replica, close_db, pool_stats, init_app as init_db_pool
+)
+from pagination import (
+    FEED_PAGE_SIZE, PROFILE_PAGE_SIZE, MESSAGES_PAGE_SIZE, InvalidCursor,
+    decode_cursor, keyset_filter, page_size, split_page
+)
+from realtime import REALTIME_KEEPALIVE, REALTIME_STREAM_SECONDS, StreamsFull, get_hub
 
 app = Flask(__name__)
+# Stream multipart uploads straight into hashing temp files (storage.py)
+app.request_class = storage.UploadRequest
+init_db_pool(app)
+
+def _metrics_gauges():
+    pool = get_pool().stats()
+    user_cache = users.get_cache(get_pool).stats()
+    fragment_stats = fragment_cache.stats()
+    gauges = _job_gauges()
+    return gauges + [
+        ("app_db_pool_size", "Pool size (connections per worker).", pool["size"]),
+        ("app_db_pool_open", "Open pooled connections.", pool["open"]),
+        ("app_db_pool_in_use", "Pooled connections checked out.", pool["in_use"]),
+        ("app_db_pool_waits", "Checkouts that had to wait (cumulative).", pool["waits"]),
+        ("app_db_pool_timeouts", "Checkouts that timed out (cumulative).", pool["timeouts"]),
+        ("app_user_cache_hits", "User lookups served from cache (cumulative).", user_cache["hits"]),
+        ("app_user_cache_misses", "User lookups that went to MySQL (cumulative).",
+         user_cache["misses"]),
+        ("app_user_cache_entries", "Users cached in this worker.", user_cache["entries"]),
+        ("app_fragment_cache_hits", "Fragments served from cache (cumulative).",
+         fragment_stats["hits"]),
+        ("app_fragment_cache_misses", "Fragments rendered (cumulative).",
+         fragment_stats["misses"]),
+    ] + _stream_gauges() + _hashing_gauges() + _replica_gauges()
+
+def _stream_gauges():
+    hub = get_hub(get_pool).stats()
+    return [
+        ("app_message_streams_open", "Open message streams (each holds a thread).",
+         hub["subscribers"]),
+        ("app_message_streams_max", "Message streams allowed per worker.", hub["max_streams"]),
+        ("app_message_streams_rejected", "Message streams refused with 503 (cumulative).",
+         hub["rejected"]),
+    ]
+
+def _hashing_gauges():
+    hashing = passwords.get_hasher().stats()
+    return [
+        ("app_password_hash_threads", "Password hashing threads per worker.", hashing["threads"]),
+        ("app_password_hash_pending", "Password hashes running or queued.", hashing["pending"]),
+        ("app_password_hash_completed", "Password hashes done (cumulative).", hashing["completed"]),
+        ("app_password_hash_rejected", "Sign-ins refused with 503 because hashing was "
+         "saturated (cumulative).", hashing["rejected"]),
+        ("app_password_hash_wait_seconds", "Time hashes spent queued (cumulative).",
+         hashing["wait_time_total"]),
+        ("app_password_hash_wait_max_seconds", "Longest time a hash spent queued.",
+         hashing["wait_time_max"]),
+        ("app_password_hash_seconds", "Time spent hashing (cumulative).",
+         hashing["hash_time_total"]),
+    ]
+
+def _replica_gauges():
+    """Pool and lag gauges per read replica, labelled with its host:port."""
+    replicas = pool_stats()["replicas"]
+    gauges = []
+    for name, help_text, key in (
+        ("app_db_replica_pool_open", "Open pooled connections to the replica.", "open"),
+        ("app_db_replica_pool_in_use", "Replica connections checked out.", "in_use"),
+        ("app_db_replica_pool_waits", "Replica checkouts that had to wait (cumulative).", "waits"),
+        ("app_db_replica_pool_timeouts", "Replica checkouts that timed out (cumulative).",
+         "timeouts"),
+        ("app_db_replica_reads", "Requests whose reads went to the replica (cumulative).", "reads"),
+        ("app_db_replica_lag_seconds", "Last measured replication lag (-1 if unknown).", "lag"),
+        ("app_db_replica_usable", "1 if reads are being sent to the replica.", "usable"),
+    ):
+        for replica in replicas:
+            value = replica[key]
+            gauges.append((name, help_text, -1 if value is None else int(value),
+                           {"replica": replica["name"]}))
+    return gauges
+
+def _job_gauges():
+    """Queue depth, shared by all workers (so the same on every scrape)."""
+    db = get_pool()
+    try:
+        conn = db.acquire(timeout=1)
+    except Exception:
+        return []
+    try:
+        stats = jobs.queue_stats(conn)
+    except Exception:
+        return []
+    finally:
+        db.release(conn)
+    return [
+        ("app_jobs_queued", "Jobs waiting to run (including scheduled retries).", stats["queued"]),
+        ("app_jobs_running", "Jobs claimed by a worker.", stats["running"]),
+        ("app_jobs_failed", "Jobs that used up their attempts.", stats["failed"]),
+        ("app_jobs_oldest_due_seconds", "How long the oldest due job has waited.",
+         stats["oldest_due_seconds"]),
+    ]
+
+# Query/template timing, /metrics and the slow-request log; installed
+# before the first pooled connection is opened
+instrumentation.init_app(app, extra_gauges=_metrics_gauges)
+# Compression and the JSON encoder. Installed after instrumentation so the
+# byte counts it records are what goes over the wire.
+responses.init_app(app)
 
 # Read SECRET_KEY from environment or default
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "YOUR_SUPER_SECRET_KEY")
 
-# MySQL config from environment variables
-MYSQL_HOST = os.environ.get("MYSQL_HOST", "localhost")
-MYSQL_PORT = int(os.environ.get("MYSQL_PORT", "3306"))
-MYSQL_USER = os.environ.get("MYSQL_USER", "root")
-MYSQL_PASS = os.environ.get("MYSQL_PASS", "password")
-MYSQL_DB   = os.environ.get("MYSQL_DB", "socialdb")
-
 # Folder for uploaded images/videos
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 
 ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".mp4", ".mov", ".avi"}
 
+# Where uploads are stored (content-addressed, see storage.py)
+storage_backend = storage.load_backend(UPLOAD_FOLDER)
+# Uploads spool next to where they're stored, so storing them is a rename
+app.config["UPLOAD_TMP_FOLDER"] = storage_backend.temp_folder
+
 def allowed_file(filename):
     ext = os.path.splitext(filename)[1].lower()
     return ext in ALLOWED_EXTENSIONS
 
-def get_db_connection():
-    """Create a new MySQL connection. For production, consider a pool/ORM."""
-    return mysql.connector.connect(
-        host=MYSQL_HOST,
-        port=MYSQL_PORT,
-        user=MYSQL_USER,
-        password=MYSQL_PASS,
-        database=MYSQL_DB
+def process_media(key):
+    """Make display variants for a newly stored upload."""
+    if key and storage_backend.local_root:
+        media.process_upload(storage_backend.local_root, key)
+
+def delete_media_variants(key):
+    if storage_backend.local_root:
+        media.delete_variants(storage_backend.local_root, key)
+
+def media_ready(key):
+    """False while an image upload still waits for its variants."""
+    return not key or not media.is_image(key) or bool(
+        media.load_manifest(app.config["UPLOAD_FOLDER"], key))
+
+# ----------- BACKGROUND JOBS (jobs.py) -----------
+# Handlers run in the worker process (`flask --app app jobs-worker`);
+# requests only enqueue, in the same transaction as their change.
+
+@jobs.handler("media.process")
+def process_media_job(conn, payload):
+    process_media(payload["key"])
+
+@jobs.handler("media.collect")
+def collect_media_job(conn, payload):
+    """Delete stored uploads (and their variants) nothing refers to any more."""
+    storage.collect(storage_backend, conn, payload["keys"], on_delete=delete_media_variants)
+
+@jobs.handler("timeline.fan_out")
+def fan_out_job(conn, payload):
+    cursor = conn.cursor()
+    timelines.fan_out(cursor, payload["post_id"])
+    cursor.close()
+
+def enqueue_media(cursor, key):
+    if key:
+        jobs.enqueue(cursor, "media.process", {"key": key})
+
+def enqueue_collect(cursor, keys):
+    keys = list(dict.fromkeys(k for k in keys if k))
+    if keys:
+        jobs.enqueue(cursor, "media.collect", {"keys": keys})
+
+def active_stories(cursor):
+    """The stories bar (cached per worker, see stories.py)."""
+    stories.start_reaper(get_pool, enqueue_collect)
+    return stories.get_cache(get_pool).get(lambda: stories.load_active_stories(cursor))
+
+@app.url_defaults
+def version_static_urls(endpoint, values):
+    """Add ?v=<file version> to static URLs, so they can be cached forever
+    (content-addressed uploads are versioned by name already)."""
+    if endpoint != "static" or "v" in values:
+        return
+    filename = values.get("filename", "")
+    if filename.startswith("uploads/") and storage.key_digest(filename[len("uploads/"):]):
+        return
+    version = assets.file_version(os.path.join(app.static_folder, filename))
+    if version:
+        values["v"] = version
+
+def static_file(filename):
+    """Replaces Flask's static view: versioned URLs are immutable, and CSS/JS
+    are served precompressed when possible."""
+    digest = None
+    if filename.startswith("uploads/"):
+        digest = storage.key_digest(filename[len("uploads/"):])
+    version = request.args.get("v")
+    immutable = bool(digest) or (
+        version is not None and version == assets.file_version(os.path.join(app.static_folder, filename))
+    )
+    return assets.send_asset(app.static_folder, filename, immutable=immutable, etag=digest or True)
+
+app.view_functions["static"] = static_file
+
+@app.template_global()
+def media_url(filename, kind=None):
+    """URL of an upload, or of its `kind` variant if it has been made."""
+    if kind:
+        manifest = media.load_manifest(app.config["UPLOAD_FOLDER"], filename)
+        width = media.pick_width(manifest, kind) if manifest else None
+        if width:
+            return url_for("static", filename="uploads/" + media.variant_path(filename, kind, width))
+    return storage_backend.url(filename)
+
+# Rendered post cards, tiles and the stories bar (see fragments.py)
+fragment_cache = fragments.FragmentCache(fragments.load_backend(), app.jinja_env)
+_stories_bar_key = (None, None)
+_stories_bar_lock = threading.Lock()
+
+@app.template_global()
+def post_card(post, viewer_id):
+    """A feed post card: cached HTML plus this viewer's like/save state."""
+    liked = post["user_has_liked"]
+    return fragment_cache.render(
+        "_post_card.html",
+        (post["id"], post["like_count"], post["profile_picture"],
+         media_ready(post["media_filename"]) and media_ready(post["profile_picture"])),
+        {"post": post},
+        {"liked_class": "liked" if liked else "", "like_label": "Unlike" if liked else "Like",
+         "save_label": "Unsave" if post["user_has_saved"] else "Save",
+         "owner": post["user_id"] == viewer_id},
+    )
+
+@app.template_global()
+def post_tile(post):
+    return fragment_cache.render("_post_tile.html", (post["id"], media_ready(post["media_filename"])),
+                                 {"post": post})
+
+@app.template_global()
+def stories_bar(story_groups):
+    global _stories_bar_key
+    # The list is shared until the stories cache reloads; hash it once per
+    # load, under the lock so a slow hash of an old list can't overwrite
+    # the key of a newer one
+    with _stories_bar_lock:
+        groups, key = _stories_bar_key
+        if groups is not story_groups:
+            key = fragments.content_key([
+                (g["user_id"], g["profile_picture"],
+                 [(s["id"], media_ready(s["media_filename"])) for s in g["stories"]])
+                for g in story_groups
+            ])
+            _stories_bar_key = (story_groups, key)
+    return fragment_cache.render("_stories_bar.html", (key,), {"story_groups": story_groups})
+
+@app.template_global()
+def media_srcset(filename, kind):
+    """srcset listing every `kind` variant of an upload ("" if none)."""
+    manifest = media.load_manifest(app.config["UPLOAD_FOLDER"], filename)
+    if not manifest:
+        return ""
+    return ", ".join(
+        f'{url_for("static", filename="uploads/" + media.variant_path(filename, kind, w))} {w}w'
+        for w in manifest.get(kind, [])
     )
 
 # ----------- INIT DB -----------
-def init_db():
-    """Create tables IF NOT EXISTS (called once)."""
-    conn = get_db_connection()
+def init_db(log=None):
+    """Create tables IF NOT EXISTS, then apply pending migrations.
+
+    Run once per deploy (`flask --app app init-db`, the k8s migrate job),
+    not when a worker starts.
+    """
+    pool = get_pool()
+    conn = pool.acquire()
     cursor = conn.cursor()
 
     # USERS
@@ -106,22 +359,230 @@ def init_db():
 
     conn.commit()
     cursor.close()
-    conn.close()
 
-init_db()
+    migrations.upgrade(conn, log=log or app.logger.info)
+    pool.release(conn)
+
+def create_app(config=None):
+    """The module's `app` with `config` applied, for wsgi.py. Not a
+    factory: the app and its routes are built when this module is
+    imported, so every call returns (and reconfigures) the same object.
+    Nothing here touches MySQL: the pool connects on the first request,
+    and the schema is set up separately by init-db."""
+    if config:
+        app.config.update(config)
+    return app
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the tables and apply pending migrations (once per deploy)."""
+    init_db(log=click.echo)
+    click.echo("database ready")
+
+@app.cli.command("db-upgrade")
+@click.option("--target", type=int, default=None, help="Stop after this version.")
+def db_upgrade_command(target):
+    """Apply pending schema migrations."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        applied = migrations.upgrade(conn, target=target, log=click.echo)
+    finally:
+        pool.release(conn)
+    click.echo(f"applied {len(applied)} migration(s)")
+
+@app.cli.command("reconcile-like-counts")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+def reconcile_like_counts_command(batch_size):
+    """Recompute posts.like_count from the likes table."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        fixed = migrations.reconcile_like_counts(conn, batch_size, log=click.echo)
+    finally:
+        pool.release(conn)
+    click.echo(f"corrected {fixed} counter(s)")
+
+@app.cli.command("backfill-conversations")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+def backfill_conversations_command(batch_size):
+    """Rebuild the conversations summary table from messages."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        written = migrations.backfill_conversations(conn, batch_size, log=click.echo)
+    finally:
+        pool.release(conn)
+    click.echo(f"wrote {written} row(s)")
+
+@app.cli.command("backfill-media")
+@click.option("--force", is_flag=True, help="Rebuild variants that already exist.")
+def backfill_media_command(force):
+    """Make resized variants for every existing upload."""
+    folder = storage_backend.local_root
+    if not folder:
+        raise click.ClickException("media variants need a local storage backend")
+    made = failed = 0
+    for filename in media.iter_uploads(folder):
+        if not media.is_image(filename):
+            continue
+        try:
+            media.make_variants(folder, filename, force=force)
+            made += 1
+        except Exception as e:
+            failed += 1
+            click.echo(f"{filename}: {e}")
+    click.echo(f"processed {made} image(s), {failed} failed")
+
+@app.cli.command("compress-static")
+def compress_static_command():
+    """Write .br/.gz copies of the CSS and JS (run at build time)."""
+    written = assets.compress_static(app.static_folder, log=click.echo)
+    click.echo(f"{written} compressed files written")
+
+@app.cli.command("reap-stories")
+@click.option("--batch-size", default=stories.STORY_REAP_BATCH, show_default=True)
+def reap_stories_command(batch_size):
+    """Delete expired stories and queue removal of media only they used."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        deleted = stories.reap_expired(conn, enqueue_collect, batch_size=batch_size,
+                                       log=click.echo)
+    finally:
+        pool.release(conn)
+    click.echo(f"{deleted} expired stories deleted")
+
+@app.cli.command("jobs-worker")
+@click.option("--threads", type=int, default=jobs.JOB_WORKER_THREADS, show_default=True,
+              help="Jobs run at once per process (each holds a pooled connection).")
+@click.option("--processes", type=int, default=1, show_default=True)
+def jobs_worker_command(threads, processes):
+    """Run background jobs until SIGTERM."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(message)s")
+    jobs.run_workers(get_pool, processes=processes, threads=threads)
+
+@app.cli.command("jobs-status")
+def jobs_status_command():
+    """Show queue depth and recent failures."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        for name, value in jobs.queue_stats(conn).items():
+            click.echo(f"{name:<20} {value}")
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, kind, attempts, last_error FROM jobs
+            WHERE status = 'failed' ORDER BY id DESC LIMIT 10
+        """)
+        for job_id, kind, attempts, error in cursor.fetchall():
+            click.echo(f"failed #{job_id} {kind} after {attempts} attempt(s): {error}")
+        cursor.close()
+    finally:
+        pool.release(conn)
+
+@app.cli.command("db-status")
+def db_status_command():
+    """List schema migrations and whether each has been applied."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        for version, description, applied in migrations.status(conn):
+            click.echo(f"{version:>4}  {'applied' if applied else 'pending':<8} {description}")
+    finally:
+        pool.release(conn)
+
+@app.cli.command("export-data")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option("--user", "username", help="Only this user's data.")
+@click.option("--password-hashes/--no-password-hashes", default=True, show_default=True,
+              help="Include password hashes (without them users can't log in after import).")
+@click.option("--gzip/--no-gzip", default=True, show_default=True)
+def export_data_command(path, username, password_hashes, gzip):
+    """Stream the site's (or one user's) rows and media to an archive at
+    PATH ("-" for stdout)."""
+    pool = get_pool()
+    conn = pool.acquire()
+    finished = False
+    try:
+        user_id = None
+        if username:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM users WHERE username=%s", (username,))
+            row = cursor.fetchone()
+            cursor.close()
+            if row is None:
+                raise click.ClickException(f"user {username} does not exist")
+            user_id = row[0]
+        with click.open_file(path, "wb") as out:
+            for chunk in archive.export_archive(conn, storage_backend, user_id=user_id,
+                                                password_hashes=password_hashes, gzip=gzip):
+                out.write(chunk)
+        finished = True
+    finally:
+        pool.release(conn, discard=not finished)
+    if path != "-":
+        click.echo(f"wrote {path}")
+
+@app.cli.command("import-data")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--batch-size", type=int, default=archive.IMPORT_BATCH_ROWS, show_default=True,
+              help="Rows per INSERT.")
+def import_data_command(path, batch_size):
+    """Load an export-data archive. Re-run the same command to resume an
+    interrupted import."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        with click.open_file(path, "rb") as f:
+            counts = archive.import_archive(conn, f, storage_backend, on_media=enqueue_media,
+                                            batch_rows=batch_size, log=click.echo)
+    except archive.InvalidArchive as e:
+        raise click.ClickException(f"invalid archive: {e}")
+    except archive.ImportConflict as e:
+        raise click.ClickException(f"import stopped: {e}")
+    finally:
+        pool.release(conn)
+    click.echo(f"{counts['rows']} row(s) imported, "
+               f"{counts['chunks_skipped']} chunk(s) already imported, "
+               f"{counts['media']} media file(s) stored ({counts['media_present']} already present)")
 
 def get_current_user_id():
     return session.get("user_id")
 
 def get_user_by_username(username):
-    """Query the 'users' table by username."""
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users WHERE username=%s", (username,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user
+    """A user's public columns (users.COLUMNS), cached per worker."""
+    return users.get_cache(get_pool).by_username(username, get_db)
+
+def load_viewer_flags(cursor, post_ids, viewer_id):
+    """Whether the viewer has liked/saved each post in a batch.
+
+    Two set-based queries however many posts there are.
+    Returns {post_id: {"user_has_liked", "user_has_saved"}}.
+    """
+    flags = {pid: {"user_has_liked": False, "user_has_saved": False}
+             for pid in post_ids}
+    if not flags:
+        return flags
+
+    ids = list(flags)
+    placeholders = ", ".join(["%s"] * len(ids))
+
+    cursor.execute(f"""
+        SELECT post_id FROM likes
+        WHERE user_id=%s AND post_id IN ({placeholders})
+    """, [viewer_id] + ids)
+    for row in cursor.fetchall():
+        flags[row["post_id"]]["user_has_liked"] = True
+
+    cursor.execute(f"""
+        SELECT post_id FROM saved_posts
+        WHERE user_id=%s AND post_id IN ({placeholders})
+    """, [viewer_id] + ids)
+    for row in cursor.fetchall():
+        flags[row["post_id"]]["user_has_saved"] = True
+
+    return flags
 
 # ------------- ROUTES -------------
 @app.route("/")
@@ -135,9 +596,12 @@ def signup():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        password_hash = generate_password_hash(password)
+        try:
+            password_hash = passwords.get_hasher().hash(password)
+        except passwords.Busy:
+            return _hashing_busy("signup.html")
 
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
         try:
             cursor.execute("""
@@ -154,7 +618,6 @@ def signup():
                 flash(f"MySQL Error: {e}", "error")
         finally:
             cursor.close()
-            conn.close()
 
     return render_template("signup.html")
 
@@ -164,14 +627,25 @@ def login():
         username = request.form["username"]
         password = request.form["password"]
 
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE username=%s", (username,))
+        cursor.execute("SELECT id, username, password_hash FROM users WHERE username=%s",
+                       (username,))
         user = cursor.fetchone()
         cursor.close()
-        conn.close()
 
-        if user and check_password_hash(user["password_hash"], password):
+        hasher = passwords.get_hasher()
+        try:
+            valid = user is not None and hasher.check(user["password_hash"], password)
+        except passwords.Busy:
+            return _hashing_busy("login.html")
+        if valid and hasher.needs_rehash(user["password_hash"]):
+            try:
+                upgrade_password_hash(conn, user, hasher.hash(password))
+            except passwords.Busy:
+                pass  # keep the old hash; the next login upgrades it
+
+        if valid:
             session["user_id"] = user["id"]
             session["username"] = user["username"]
             flash("Welcome back!", "success")
@@ -181,6 +655,20 @@ def login():
 
     return render_template("login.html")
 
+def upgrade_password_hash(conn, user, new_hash):
+    """Replace a hash made with old parameters (see passwords.py), unless
+    the password changed meanwhile."""
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET password_hash=%s WHERE id=%s AND password_hash=%s",
+                   (new_hash, user["id"], user["password_hash"]))
+    conn.commit()
+    cursor.close()
+
+def _hashing_busy(template):
+    """503 for a sign-up or login that couldn't get a hashing slot."""
+    flash("Too many sign-ins right now, please try again in a moment.", "error")
+    return render_template(template), 503, {"Retry-After": "2"}
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -194,7 +682,8 @@ def feed():
     if not user_id:
         return redirect(url_for("login"))
 
-    conn = get_db_connection()
+    # A POST reads the page back on the primary, so it includes the new post
+    conn = get_db() if request.method == "POST" else get_read_db()
     cursor = conn.cursor(dictionary=True)
 
     if request.method == "POST":
@@ -203,10 +692,7 @@ def feed():
         media_filename = None
 
         if media_file and media_file.filename and allowed_file(media_file.filename):
-            secure_name = secure_filename(media_file.filename)
-            media_path = os.path.join(app.config["UPLOAD_FOLDER"], secure_name)
-            media_file.save(media_path)
-            media_filename = secure_name
+            media_filename = storage.store_upload(storage_backend, cursor, media_file)
 
         if content or media_filename:
             now = datetime.now()
@@ -214,48 +700,98 @@ def feed():
                 INSERT INTO posts (user_id, content, media_filename, created_at)
                 VALUES (%s, %s, %s, %s)
             """, (user_id, content, media_filename, now))
+            post_id = cursor.lastrowid
+            timelines.add_own(cursor, user_id, post_id, now)
+            jobs.enqueue(cursor, "timeline.fan_out", {"post_id": post_id})
+            enqueue_media(cursor, media_filename)
             conn.commit()
 
-    # Stories (<24h)
-    cutoff = datetime.now() - timedelta(hours=24)
-    cursor.execute("""
-        SELECT s.id, s.media_filename, s.created_at,
-               u.username, u.profile_picture
-        FROM stories s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.created_at >= %s
-        ORDER BY s.created_at DESC
-    """, (cutoff,))
-    stories = cursor.fetchall()
-
-    # All posts
-    cursor.execute("""
+    try:
+        position = decode_cursor(request.args.get("cursor"))
+    except InvalidCursor:
+        position = None
+    limit = page_size(request.args.get("limit"), FEED_PAGE_SIZE)
+    # Home timeline by default, ?view=all for everyone's posts
+    view = "all" if request.args.get("view") == "all" else None
+    load_page = load_feed_page if view == "all" else load_home_page
+    posts, next_cursor = load_page(cursor, user_id, position, limit)
+
+    # "Load more" fetches only the next batch of post cards
+    if request.args.get("fragment"):
+        cursor.close()
+        return render_template("_feed_posts.html", posts=posts, view=view,
+                               next_cursor=next_cursor, current_user_id=user_id)
+
+    story_groups = active_stories(cursor)
+
+    cursor.close()
+    return render_template("feed.html", story_groups=story_groups, posts=posts, view=view,
+                           next_cursor=next_cursor, current_user_id=user_id)
+
+@app.route("/feed_api")
+def feed_api():
+    """JSON variant of the feed: one page of posts plus the next cursor."""
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 403
+
+    try:
+        position = decode_cursor(request.args.get("cursor"))
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    limit = page_size(request.args.get("limit"), FEED_PAGE_SIZE)
+
+    load_page = load_feed_page if request.args.get("view") == "all" else load_home_page
+    cursor = get_read_db().cursor(dictionary=True)
+    posts, next_cursor = load_page(cursor, user_id, position, limit)
+    cursor.close()
+
+    return jsonify({"users": users_json(posts), "posts": [post_json(p) for p in posts],
+                    "next_cursor": next_cursor})
+
+def load_feed_page(cursor, viewer_id, position, limit):
+    """One page of the "All posts" list, newest first."""
+    where, params = keyset_filter(position, "p.created_at", "p.id")
+    cursor.execute(f"""
         SELECT p.id, p.user_id, p.content, p.media_filename, p.created_at,
-               u.username, u.profile_picture
+               p.like_count, u.username, u.profile_picture
         FROM posts p
         JOIN users u ON p.user_id = u.id
-        ORDER BY p.created_at DESC
-    """)
-    raw_posts = cursor.fetchall()
+        {"WHERE " + where if where else ""}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT %s
+    """, params + [limit + 1])
+    raw_posts, next_cursor = split_page(cursor.fetchall(), limit)
+    return post_cards(cursor, raw_posts, viewer_id), next_cursor
+
+def load_home_page(cursor, viewer_id, position, limit):
+    """One page of the viewer's home timeline (see timelines.py)."""
+    rows, next_cursor = timelines.load_home_ids(cursor, viewer_id, position, limit)
+    return load_posts_by_ids(cursor, [r["id"] for r in rows], viewer_id), next_cursor
+
+def load_posts_by_ids(cursor, ids, viewer_id):
+    """Post cards for `ids`, in that order (missing posts are skipped)."""
+    if not ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(ids))
+    cursor.execute(f"""
+        SELECT p.id, p.user_id, p.content, p.media_filename, p.created_at,
+               p.like_count, u.username, u.profile_picture
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        WHERE p.id IN ({placeholders})
+    """, ids)
+    by_id = {p["id"]: p for p in cursor.fetchall()}
+    raw_posts = [by_id[i] for i in ids if i in by_id]
+    return post_cards(cursor, raw_posts, viewer_id)
+
+def post_cards(cursor, raw_posts, viewer_id):
+    """Post rows plus the viewer's liked/saved flags, as the feed renders them."""
+    flags = load_viewer_flags(cursor, [p["id"] for p in raw_posts], viewer_id)
 
     posts = []
     for p in raw_posts:
-        post_id = p["id"]
-        # Count likes
-        cursor.execute("SELECT COUNT(*) AS c FROM likes WHERE post_id=%s", (post_id,))
-        lr = cursor.fetchone()
-        like_count = lr["c"] if lr else 0
-
-        # user has liked?
-        cursor.execute("SELECT id FROM likes WHERE post_id=%s AND user_id=%s", (post_id, user_id))
-        rlike = cursor.fetchone()
-        user_has_liked = True if rlike else False
-
-        # user has saved?
-        cursor.execute("SELECT id FROM saved_posts WHERE post_id=%s AND user_id=%s", (post_id, user_id))
-        rsave = cursor.fetchone()
-        user_has_saved = True if rsave else False
-
+        st = flags[p["id"]]
         posts.append({
             "id": p["id"],
             "user_id": p["user_id"],
@@ -264,14 +800,11 @@ def feed():
             "created_at": p["created_at"],
             "username": p["username"],
             "profile_picture": p["profile_picture"],
-            "like_count": like_count,
-            "user_has_liked": user_has_liked,
-            "user_has_saved": user_has_saved
+            "like_count": p["like_count"],
+            "user_has_liked": st["user_has_liked"],
+            "user_has_saved": st["user_has_saved"]
         })
-
-    cursor.close()
-    conn.close()
-    return render_template("feed.html", stories=stories, posts=posts, current_user_id=user_id)
+    return posts
 
 @app.route("/like_api/<int:post_id>", methods=["POST"])
 def like_api(post_id):
@@ -279,50 +812,110 @@ def like_api(post_id):
     if not user_id:
         return jsonify({"error": "Not logged in"}), 403
 
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT id FROM likes WHERE post_id=%s AND user_id=%s", (post_id, user_id))
-    row = cursor.fetchone()
+    # Optional explicit action makes retries idempotent; without it, toggle.
+    wanted = request.args.get("action") or request.form.get("action")
+    if wanted not in (None, "like", "unlike"):
+        return jsonify({"error": "action must be 'like' or 'unlike'"}), 400
 
-    if row:
-        cursor.execute("DELETE FROM likes WHERE id=%s", (row["id"],))
+    conn = get_db()
+    cursor = conn.cursor(dictionary=True)
+    if wanted == "like":
+        set_like(cursor, post_id, user_id, True)
+        action = "liked"
+    elif wanted == "unlike":
+        set_like(cursor, post_id, user_id, False)
+        action = "unliked"
+    elif set_like(cursor, post_id, user_id, False):
         action = "unliked"
     else:
-        cursor.execute("INSERT INTO likes (post_id, user_id) VALUES (%s, %s)", (post_id, user_id))
+        set_like(cursor, post_id, user_id, True)
         action = "liked"
-    conn.commit()
 
-    cursor.execute("SELECT COUNT(*) AS c FROM likes WHERE post_id=%s", (post_id,))
-    lr = cursor.fetchone()
-    like_count = lr["c"] if lr else 0
+    cursor.execute("SELECT like_count FROM posts WHERE id=%s", (post_id,))
+    row = cursor.fetchone()
+    like_count = row["like_count"] if row else 0
+    conn.commit()
 
     cursor.close()
-    conn.close()
     return jsonify({"status": action, "like_count": like_count})
 
+def set_like(cursor, post_id, user_id, liked):
+    """Make (post_id, user_id) liked or not with one idempotent statement,
+    adjusting posts.like_count in the same transaction if it changed.
+
+    Returns True if the like state actually changed. The caller commits.
+    """
+    if liked:
+        cursor.execute("INSERT IGNORE INTO likes (post_id, user_id) VALUES (%s, %s)",
+                       (post_id, user_id))
+    else:
+        cursor.execute("DELETE FROM likes WHERE post_id=%s AND user_id=%s",
+                       (post_id, user_id))
+    if cursor.rowcount <= 0:
+        return False
+    cursor.execute("UPDATE posts SET like_count = like_count + %s WHERE id=%s",
+                   (1 if liked else -1, post_id))
+    return True
+
+def set_saved(cursor, post_id, user_id, saved):
+    """Make (post_id, user_id) saved or not with one idempotent statement
+    (see set_like). Returns True if the state actually changed."""
+    if saved:
+        cursor.execute("INSERT IGNORE INTO saved_posts (post_id, user_id) VALUES (%s, %s)",
+                       (post_id, user_id))
+    else:
+        cursor.execute("DELETE FROM saved_posts WHERE post_id=%s AND user_id=%s",
+                       (post_id, user_id))
+    return cursor.rowcount > 0
+
 @app.route("/save_api/<int:post_id>", methods=["POST"])
 def save_api(post_id):
     user_id = get_current_user_id()
     if not user_id:
         return jsonify({"error": "Not logged in"}), 403
 
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT id FROM saved_posts WHERE post_id=%s AND user_id=%s", (post_id, user_id))
-    row = cursor.fetchone()
+    # Optional explicit action makes retries idempotent; without it, toggle.
+    wanted = request.args.get("action") or request.form.get("action")
+    if wanted not in (None, "save", "unsave"):
+        return jsonify({"error": "action must be 'save' or 'unsave'"}), 400
 
-    if row:
-        cursor.execute("DELETE FROM saved_posts WHERE id=%s", (row["id"],))
+    conn = get_db()
+    cursor = conn.cursor()
+    if wanted == "save":
+        set_saved(cursor, post_id, user_id, True)
+        action = "saved"
+    elif wanted == "unsave":
+        set_saved(cursor, post_id, user_id, False)
+        action = "unsaved"
+    elif set_saved(cursor, post_id, user_id, False):
         action = "unsaved"
     else:
-        cursor.execute("INSERT INTO saved_posts (post_id, user_id) VALUES (%s, %s)", (post_id, user_id))
+        set_saved(cursor, post_id, user_id, True)
         action = "saved"
     conn.commit()
 
     cursor.close()
-    conn.close()
     return jsonify({"status": action})
 
+@app.route("/batch_api", methods=["POST"])
+def batch_api():
+    """Apply queued likes/saves (see interactions.py) in one transaction.
+
+    Body: {"ops": [{"seq", "op", "post_id"}]}. Returns {"posts": {id:
+    {"seq", "like_count", "liked"/"saved"}}} for the posts that exist;
+    the client ignores entries older than its own latest seq for a post.
+    """
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 403
+    try:
+        final = interactions.collapse(interactions.parse_ops(request.get_json(silent=True)))
+    except interactions.InvalidBatch as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = interactions.apply_batch(get_db(), user_id, final)
+    return jsonify({"posts": results})
+
 @app.route("/delete_post/<int:post_id>", methods=["POST"])
 def delete_post(post_id):
     """Allow user to delete their own post, or admin can delete any post."""
@@ -331,15 +924,14 @@ def delete_post(post_id):
         flash("You must be logged in to delete a post.", "error")
         return redirect(url_for("login"))
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT user_id FROM posts WHERE id=%s", (post_id,))
+    cursor.execute("SELECT user_id, media_filename FROM posts WHERE id=%s", (post_id,))
     post = cursor.fetchone()
 
     if not post:
         flash("Post not found!", "error")
         cursor.close()
-        conn.close()
         return redirect(url_for("feed"))
 
     # Check if current user is admin or the owner
@@ -351,17 +943,17 @@ def delete_post(post_id):
         cursor.execute("DELETE FROM posts WHERE id=%s", (post_id,))
         cursor.execute("DELETE FROM likes WHERE post_id=%s", (post_id,))
         cursor.execute("DELETE FROM saved_posts WHERE post_id=%s", (post_id,))
+        timelines.remove_post(cursor, post_id)
+        storage.release(cursor, post["media_filename"])
+        enqueue_collect(cursor, [post["media_filename"]])
         conn.commit()
-
         cursor.close()
-        conn.close()
 
         flash("Post deleted!", "success")
         return redirect(url_for("feed"))
     else:
         flash("You cannot delete someone else's post!", "error")
         cursor.close()
-        conn.close()
         return redirect(url_for("feed"))
 
 @app.route("/upload_story", methods=["POST"])
@@ -373,20 +965,18 @@ def upload_story():
 
     story_file = request.files.get("story_file")
     if story_file and story_file.filename and allowed_file(story_file.filename):
-        fname = secure_filename(story_file.filename)
-        path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
-        story_file.save(path)
-
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
+        fname = storage.store_upload(storage_backend, cursor, story_file)
         now = datetime.now()
         cursor.execute("""
-            INSERT INTO stories (user_id, media_filename, created_at)
-            VALUES (%s, %s, %s)
-        """, (user_id, fname, now))
+            INSERT INTO stories (user_id, media_filename, created_at, expires_at)
+            VALUES (%s, %s, %s, %s)
+        """, (user_id, fname, now, now + stories.STORY_TTL))
+        enqueue_media(cursor, fname)
         conn.commit()
         cursor.close()
-        conn.close()
+        stories.story_posted(get_pool, user_id, conn)
 
         flash("Story uploaded!", "success")
     else:
@@ -415,7 +1005,7 @@ def admin_edit_profile(target_user_id):
 
 def _edit_profile_logic(target_user_id, is_admin=False):
     """Internal function to do the actual profile fetch/update logic."""
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
 
     # Fetch the user record we want to edit
@@ -423,44 +1013,50 @@ def _edit_profile_logic(target_user_id, is_admin=False):
     user = cursor.fetchone()
     if not user:
         cursor.close()
-        conn.close()
         flash("User does not exist!", "error")
         return redirect(url_for("feed"))
 
     if request.method == "POST":
         new_bio = request.form.get("bio", "")
         pfp_file = request.files.get("profile_picture")
+        new_picture = None
         if pfp_file and pfp_file.filename and allowed_file(pfp_file.filename):
-            sec_name = secure_filename(pfp_file.filename)
-            path = os.path.join(app.config["UPLOAD_FOLDER"], sec_name)
-            pfp_file.save(path)
+            new_picture = storage.store_upload(storage_backend, cursor, pfp_file)
+            storage.release(cursor, user["profile_picture"])
             cursor.execute("UPDATE users SET profile_picture=%s WHERE id=%s",
-                           (sec_name, target_user_id))
+                           (new_picture, target_user_id))
+            enqueue_media(cursor, new_picture)
+            enqueue_collect(cursor, [user["profile_picture"]])
 
         cursor.execute("UPDATE users SET bio=%s WHERE id=%s", (new_bio, target_user_id))
         conn.commit()
+        users.user_changed(get_pool, target_user_id, conn)
         flash("Profile updated!", "success")
 
         # Re-fetch updated user
         cursor.execute("SELECT * FROM users WHERE id=%s", (target_user_id,))
         user = cursor.fetchone()
 
+    fragment = request.args.get("fragment")
+    limit = page_size(request.args.get("limit"), PROFILE_PAGE_SIZE)
+    try:
+        posts_position = decode_cursor(request.args.get("posts_cursor"))
+        saved_position = decode_cursor(request.args.get("saved_cursor"))
+    except InvalidCursor:
+        posts_position = saved_position = None
+
     # Grab user's posts
-    cursor.execute("""
-        SELECT p.*, u.username, u.profile_picture
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        WHERE p.user_id=%s
-        ORDER BY p.created_at DESC
-    """, (target_user_id,))
-    raw_posts = cursor.fetchall()
+    raw_posts, posts_next = [], None
+    if fragment in (None, "posts"):
+        raw_posts, posts_next = load_user_posts_page(cursor, target_user_id, posts_position, limit)
+
+    # Grab user's saved posts
+    raw_saved, saved_next = [], None
+    if fragment in (None, "saved"):
+        raw_saved, saved_next = load_saved_posts_page(cursor, target_user_id, saved_position, limit)
 
     posts = []
     for p in raw_posts:
-        cursor.execute("SELECT COUNT(*) AS c FROM likes WHERE post_id=%s", (p["id"],))
-        lr = cursor.fetchone()
-        like_count = lr["c"] if lr else 0
-
         posts.append({
             "id": p["id"],
             "content": p["content"],
@@ -468,26 +1064,11 @@ def _edit_profile_logic(target_user_id, is_admin=False):
             "created_at": p["created_at"],
             "username": p["username"],
             "profile_picture": p["profile_picture"],
-            "like_count": like_count
+            "like_count": p["like_count"]
         })
 
-    # Grab user's saved posts
-    cursor.execute("""
-        SELECT p.*, u.username, u.profile_picture
-        FROM saved_posts s
-        JOIN posts p ON s.post_id = p.id
-        JOIN users u ON p.user_id = u.id
-        WHERE s.user_id=%s
-        ORDER BY p.created_at DESC
-    """, (target_user_id,))
-    raw_saved = cursor.fetchall()
-
     saved_posts = []
     for sp in raw_saved:
-        cursor.execute("SELECT COUNT(*) AS c FROM likes WHERE post_id=%s", (sp["id"],))
-        lr = cursor.fetchone()
-        lc = lr["c"] if lr else 0
-
         saved_posts.append({
             "id": sp["id"],
             "content": sp["content"],
@@ -495,44 +1076,88 @@ def _edit_profile_logic(target_user_id, is_admin=False):
             "created_at": sp["created_at"],
             "username": sp["username"],
             "profile_picture": sp["profile_picture"],
-            "like_count": lc
+            "like_count": sp["like_count"]
         })
 
-    user_post_count = len(posts)
+    posts_more_url = _more_url(posts_cursor=posts_next) if posts_next else None
+    saved_more_url = _more_url(saved_cursor=saved_next) if saved_next else None
+
+    if fragment == "posts":
+        cursor.close()
+        return render_template("_post_tiles.html", tiles=posts,
+                               more_url=posts_more_url, fragment="posts")
+    if fragment == "saved":
+        cursor.close()
+        return render_template("_post_tiles.html", tiles=saved_posts,
+                               more_url=saved_more_url, fragment="saved")
+
+    user_post_count = count_user_posts(cursor, target_user_id)
+    following_count = timelines.count_following(cursor, target_user_id)
 
     cursor.close()
-    conn.close()
 
     # Reuse 'profile.html' template, or create a separate one if needed
     return render_template("profile.html",
                            user=user,
                            posts=posts,
                            saved_posts=saved_posts,
+                           posts_more_url=posts_more_url,
+                           saved_more_url=saved_more_url,
                            user_post_count=user_post_count,
+                           following_count=following_count,
                            is_admin_edit=is_admin)
 
+def _more_url(**cursor_args):
+    """URL of the current page with only the given cursor(s) set."""
+    return url_for(request.endpoint, **(request.view_args or {}), **cursor_args)
+
+def count_user_posts(cursor, owner_id):
+    cursor.execute("SELECT COUNT(*) AS c FROM posts WHERE user_id=%s", (owner_id,))
+    row = cursor.fetchone()
+    return row["c"] if row else 0
+
+def load_user_posts_page(cursor, owner_id, position, limit):
+    """One page of a user's own posts, newest first."""
+    where, params = keyset_filter(position, "p.created_at", "p.id")
+    cursor.execute(f"""
+        SELECT p.*, u.username, u.profile_picture
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        WHERE p.user_id=%s {"AND " + where if where else ""}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT %s
+    """, [owner_id] + params + [limit + 1])
+    return split_page(cursor.fetchall(), limit)
+
+def load_saved_posts_page(cursor, user_id, position, limit):
+    """One page of the posts a user has saved, newest post first."""
+    where, params = keyset_filter(position, "p.created_at", "p.id")
+    cursor.execute(f"""
+        SELECT p.*, u.username, u.profile_picture
+        FROM saved_posts s
+        JOIN posts p ON s.post_id = p.id
+        JOIN users u ON p.user_id = u.id
+        WHERE s.user_id=%s {"AND " + where if where else ""}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT %s
+    """, [user_id] + params + [limit + 1])
+    return split_page(cursor.fetchall(), limit)
+
 @app.route("/user/<username>")
 def user_profile(username):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users WHERE username=%s", (username,))
-    user = cursor.fetchone()
+    user = get_user_by_username(username)
     if not user:
         flash("User does not exist!", "error")
-        cursor.close()
-        conn.close()
         return redirect(url_for("feed"))
 
-    cursor.execute("""
-        SELECT p.*, u.username, u.profile_picture
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        WHERE u.username=%s
-        ORDER BY p.created_at DESC
-    """, (username,))
-    raw_posts = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    cursor = get_read_db().cursor(dictionary=True)
+
+    try:
+        position = decode_cursor(request.args.get("posts_cursor"))
+    except InvalidCursor:
+        position = None
+    limit = page_size(request.args.get("limit"), PROFILE_PAGE_SIZE)
+    raw_posts, posts_next = load_user_posts_page(cursor, user["id"], position, limit)
 
     posts = []
     for p in raw_posts:
@@ -545,13 +1170,108 @@ def user_profile(username):
             "profile_picture": p["profile_picture"]
         })
 
-    user_post_count = len(raw_posts)
+    posts_more_url = _more_url(posts_cursor=posts_next) if posts_next else None
+
+    if request.args.get("fragment") == "posts":
+        cursor.close()
+        return render_template("_post_tiles.html", tiles=posts,
+                               more_url=posts_more_url, fragment="posts")
+
+    user_post_count = count_user_posts(cursor, user["id"])
+    following_count = timelines.count_following(cursor, user["id"])
+    viewer_id = get_current_user_id()
+    is_following = bool(viewer_id) and timelines.is_following(cursor, viewer_id, user["id"])
+    cursor.close()
 
     return render_template("user_profile.html",
                            user=user,
+                           following_count=following_count,
+                           is_following=is_following,
+                           is_self=(viewer_id == user["id"]),
                            posts=posts,
+                           posts_more_url=posts_more_url,
                            user_post_count=user_post_count)
 
+@app.route("/follow/<username>", methods=["POST"])
+def follow_user(username):
+    return _set_following(username, True)
+
+@app.route("/unfollow/<username>", methods=["POST"])
+def unfollow_user(username):
+    return _set_following(username, False)
+
+def _set_following(username, following):
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for("login"))
+
+    target = get_user_by_username(username)
+    if not target:
+        flash("User does not exist!", "error")
+        return redirect(url_for("feed"))
+
+    conn = get_db()
+    cursor = conn.cursor(dictionary=True)
+    if following:
+        changed = timelines.follow(cursor, user_id, target["id"])
+    else:
+        changed = timelines.unfollow(cursor, user_id, target["id"])
+    conn.commit()
+    cursor.close()
+    if changed:
+        # follower_count is part of the cached user
+        users.user_changed(get_pool, target["id"], conn)
+    return redirect(url_for("user_profile", username=username))
+
+# ----- SEARCH -----
+@app.route("/search")
+def search_page():
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for("login"))
+
+    q, kind, results, next_offset = run_search(user_id)
+    more_url = (url_for("search_page", q=q, type=kind, offset=next_offset)
+                if next_offset is not None else None)
+
+    if request.args.get("fragment"):
+        return render_template("_search_results.html", kind=kind, results=results,
+                               more_url=more_url, current_user_id=user_id)
+    return render_template("search.html", q=q, kind=kind, results=results,
+                           more_url=more_url, current_user_id=user_id)
+
+@app.route("/search_api")
+def search_api():
+    """JSON variant of the search page: one page of results plus the next offset."""
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 403
+
+    q, kind, results, next_offset = run_search(user_id)
+    if kind == "posts":
+        return jsonify({"q": q, "type": kind, "users": users_json(results),
+                        "results": [post_json(p) for p in results], "next_offset": next_offset})
+    return jsonify({"q": q, "type": kind, "results": results, "next_offset": next_offset})
+
+def run_search(viewer_id):
+    """(q, kind, results, next_offset) for the current request's
+    ?q=&type=posts|people&offset=&limit="""
+    q = request.args.get("q", "").strip()[:100]
+    kind = "people" if request.args.get("type") == "people" else "posts"
+    if not q:
+        return q, kind, [], None
+    offset = search.clamp_offset(request.args.get("offset"))
+    limit = page_size(request.args.get("limit"), search.SEARCH_PAGE_SIZE)
+
+    cursor = get_read_db().cursor(dictionary=True)
+    if kind == "people":
+        results, next_offset = search.search_users(cursor, q, offset, limit)
+    else:
+        ids, next_offset = search.search_post_ids(cursor, q, offset, limit)
+        results = load_posts_by_ids(cursor, ids, viewer_id)
+    cursor.close()
+    return q, kind, results, next_offset
+
 # ----- MESSAGES -----
 @app.route("/messages")
 def messages_list():
@@ -559,21 +1279,59 @@ def messages_list():
     if not user_id:
         return redirect(url_for("login"))
 
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT DISTINCT u.id, u.username
-        FROM messages m
-        JOIN users u ON (u.id = m.sender_id OR u.id = m.recipient_id)
-        WHERE (m.sender_id=%s OR m.recipient_id=%s)
-          AND u.id<>%s
-    """, (user_id, user_id, user_id))
-    rows = cursor.fetchall()
+    try:
+        position = decode_cursor(request.args.get("cursor"))
+    except InvalidCursor:
+        position = None
+    limit = page_size(request.args.get("limit"), MESSAGES_PAGE_SIZE)
+
+    cursor = get_read_db().cursor(dictionary=True)
+    conversation_partners, next_cursor = load_inbox_page(cursor, user_id, position, limit)
     cursor.close()
-    conn.close()
 
-    conversation_partners = rows
-    return render_template("messages.html", conversation_partners=conversation_partners)
+    return render_template("messages.html",
+                           conversation_partners=conversation_partners,
+                           next_cursor=next_cursor)
+
+def load_inbox_page(cursor, user_id, position, limit):
+    """A page of the user's conversations, most recent first, read from the
+    conversations summary table."""
+    where, params = keyset_filter(position, "c.last_message_at", "c.partner_id")
+    cursor.execute(f"""
+        SELECT c.partner_id AS id, u.username, c.snippet, c.last_message_at,
+               c.last_sender_id, c.unread_count
+        FROM conversations c
+        JOIN users u ON u.id = c.partner_id
+        WHERE c.user_id=%s AND c.partner_id<>%s {"AND " + where if where else ""}
+        ORDER BY c.last_message_at DESC, c.partner_id DESC
+        LIMIT %s
+    """, [user_id, user_id] + params + [limit + 1])
+    return split_page(cursor.fetchall(), limit, created_key="last_message_at")
+
+def record_conversation_message(cursor, sender_id, recipient_id, message_id, content, sent_at):
+    """Update both users' conversation summaries for a new message (same
+    transaction as the message insert)."""
+    snippet = content[:migrations.SNIPPET_LENGTH]
+    cursor.execute("""
+        INSERT INTO conversations
+            (user_id, partner_id, last_message_id, last_message_at,
+             last_sender_id, snippet, unread_count)
+        VALUES (%s, %s, %s, %s, %s, %s, 0),
+               (%s, %s, %s, %s, %s, %s, 1)
+        ON DUPLICATE KEY UPDATE
+            last_message_id = VALUES(last_message_id),
+            last_message_at = VALUES(last_message_at),
+            last_sender_id = VALUES(last_sender_id),
+            snippet = VALUES(snippet),
+            unread_count = unread_count + VALUES(unread_count)
+    """, (sender_id, recipient_id, message_id, sent_at, sender_id, snippet,
+          recipient_id, sender_id, message_id, sent_at, sender_id, snippet))
+
+def mark_conversation_read(cursor, user_id, partner_id):
+    cursor.execute("""
+        UPDATE conversations SET unread_count=0
+        WHERE user_id=%s AND partner_id=%s AND unread_count<>0
+    """, (user_id, partner_id))
 
 @app.route("/messages/<username>", methods=["GET", "POST"])
 def direct_messages(username):
@@ -587,7 +1345,7 @@ def direct_messages(username):
         return redirect(url_for("messages_list"))
 
     other_id = other_user["id"]
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor(dictionary=True)
 
     if request.method == "POST":
@@ -598,40 +1356,44 @@ def direct_messages(username):
                 INSERT INTO messages (sender_id, recipient_id, content, created_at)
                 VALUES (%s, %s, %s, %s)
             """, (user_id, other_id, content, now))
+            message_id = cursor.lastrowid
+            record_conversation_message(cursor, user_id, other_id, message_id, content, now)
             conn.commit()
+            get_hub(get_pool).message_sent(user_id, other_id, message_id, conn)
+    else:
+        mark_conversation_read(cursor, user_id, other_id)
+        conn.commit()
 
-    cursor.execute("""
-        SELECT m.*, s.username as sender_name, r.username as recipient_name
-        FROM messages m
-        JOIN users s ON s.id = m.sender_id
-        JOIN users r ON r.id = m.recipient_id
-        WHERE (m.sender_id=%s AND m.recipient_id=%s)
-           OR (m.sender_id=%s AND m.recipient_id=%s)
-        ORDER BY m.created_at ASC
-    """, (user_id, other_id, other_id, user_id))
-    msgs = cursor.fetchall()
+    try:
+        position = decode_cursor(request.args.get("before"))
+    except InvalidCursor:
+        position = None
+    limit = page_size(request.args.get("limit"), MESSAGES_PAGE_SIZE)
+    messages_list, older_cursor = load_conversation_page(cursor, user_id, other_id, position, limit)
     cursor.close()
-    conn.close()
-
-    messages_list = []
-    for msg in msgs:
-        messages_list.append({
-            "id": msg["id"],
-            "content": msg["content"],
-            "created_at": str(msg["created_at"]),
-            "sender_id": msg["sender_id"],
-            "sender_name": msg["sender_name"],
-            "recipient_id": msg["recipient_id"],
-            "recipient_name": msg["recipient_name"]
-        })
+
+    # "Load older" fetches only the earlier bubbles
+    if request.args.get("fragment"):
+        return render_template("_message_bubbles.html",
+                               other_user=other_user,
+                               messages_list=messages_list,
+                               older_cursor=older_cursor)
 
     return render_template("messages.html",
                            conversation=True,
                            other_user=other_user,
-                           messages_list=messages_list)
+                           messages_list=messages_list,
+                           older_cursor=older_cursor)
 
 @app.route("/messages_api/<username>")
 def messages_api(username):
+    """Conversation as JSON.
+
+    With ?since_id=N only messages newer than N are returned (the polling
+    path). The ETag is the conversation's latest message id, so a poll with
+    a matching If-None-Match gets an empty 304 after two index lookups.
+    Without since_id, returns the latest page (or the one ?before= a cursor).
+    """
     user_id = get_current_user_id()
     if not user_id:
         return jsonify({"error": "Not logged in"}), 403
@@ -640,39 +1402,381 @@ def messages_api(username):
     if not other_user:
         return jsonify({"error": "User does not exist"}), 404
 
+    try:
+        since_id = int(request.args.get("since_id", 0))
+        position = decode_cursor(request.args.get("before"))
+    except (ValueError, InvalidCursor) as e:
+        return jsonify({"error": str(e)}), 400
+    limit = page_size(request.args.get("limit"), MESSAGES_PAGE_SIZE)
+
     other_id = other_user["id"]
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    cursor = get_read_db().cursor(dictionary=True)
+
+    # The ETag names the newest message the client holds after applying the
+    # response, so it only matches once the client is caught up.
+    last_id = conversation_last_id(cursor, user_id, other_id)
+    etag = f"{user_id}-{other_id}-{last_id}"
+    # Weak comparison: a compressed 200 carries the ETag as W/"..."
+    if position is None and request.if_none_match.contains_weak(etag):
+        cursor.close()
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    if since_id and position is None:
+        if since_id >= last_id:
+            data, more = [], False
+        else:
+            data, more = load_conversation_since(cursor, user_id, other_id, since_id, limit)
+            if any(msg["sender_id"] == other_id for msg in data):
+                conn = get_db()
+                write_cursor = conn.cursor()
+                mark_conversation_read(write_cursor, user_id, other_id)
+                conn.commit()
+                write_cursor.close()
+        cursor.close()
+        resp = jsonify({"users": conversation_users(user_id, other_user),
+                        "messages": [message_json(m) for m in data],
+                        "last_id": last_id, "more": more})
+        if more:
+            etag = f"{user_id}-{other_id}-{data[-1]['id']}"
+    else:
+        data, older_cursor = load_conversation_page(cursor, user_id, other_id, position, limit)
+        cursor.close()
+        resp = jsonify({"users": conversation_users(user_id, other_user),
+                        "messages": [message_json(m) for m in data],
+                        "last_id": last_id, "older_cursor": older_cursor})
+
+    if position is None:
+        resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+@app.route("/messages_stream/<username>")
+def messages_stream(username):
+    """Server-Sent Events stream of new messages in one conversation.
+
+    The stream parks on this worker's MessageHub and only touches the DB
+    when a message for this pair is announced. Resumes from Last-Event-ID
+    (or ?since_id=) after a reconnect. It holds a server thread, so the
+    number per worker is capped (503 past that; the page polls instead)
+    and each one ends after REALTIME_STREAM_SECONDS for the browser to
+    reconnect.
+    """
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({"error": "Not logged in"}), 403
+
+    other_user = get_user_by_username(username)
+    if not other_user:
+        return jsonify({"error": "User does not exist"}), 404
+
+    other_id = other_user["id"]
+    resume_from = request.headers.get("Last-Event-ID") or request.args.get("since_id")
+    try:
+        since_id = int(resume_from) if resume_from else None
+    except ValueError:
+        return jsonify({"error": "since_id must be an integer"}), 400
+
+    hub = get_hub(get_pool)
+    # Subscribe before the first catch-up read so nothing slips in between
+    try:
+        sub = hub.subscribe(user_id, other_id)
+    except StreamsFull:
+        return jsonify({"error": "Too many open streams, poll messages_api"}), 503, \
+            {"Retry-After": "30"}
+    try:
+        if since_id is None:
+            cursor = get_db().cursor(dictionary=True)
+            since_id = conversation_last_id(cursor, user_id, other_id)
+            cursor.close()
+    except Exception:
+        hub.unsubscribe(sub)
+        raise
+    # Don't pin a pooled connection for the life of the stream
+    close_db()
+    deadline = time.monotonic() + REALTIME_STREAM_SECONDS
+
+    def stream():
+        last_id = since_id
+        try:
+            yield "retry: 3000\n\n"
+            woken = True
+            while True:
+                if woken:
+                    for msg in _messages_since(user_id, other_id, last_id):
+                        last_id = msg["id"]
+                        data = app.json.dumps(message_json(msg))
+                        yield f"id: {last_id}\nevent: message\ndata: {data}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Free the thread; the browser reconnects from last_id
+                    return
+                woken = sub.wait(min(REALTIME_KEEPALIVE, remaining))
+        finally:
+            hub.unsubscribe(sub)
+
+    resp = app.response_class(stream(), mimetype="text/event-stream")
+    # Runs even if the client goes away before the stream starts
+    resp.call_on_close(lambda: hub.unsubscribe(sub))
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+def _messages_since(user_id, other_id, since_id):
+    """All messages after `since_id`, read on a short-lived pool checkout."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        msgs, more = load_conversation_since(cursor, user_id, other_id, since_id, MESSAGES_PAGE_SIZE)
+        while more:
+            batch, more = load_conversation_since(cursor, user_id, other_id, msgs[-1]["id"],
+                                                  MESSAGES_PAGE_SIZE)
+            msgs.extend(batch)
+        # Delivered to an open chat, so they count as read
+        if any(msg["sender_id"] == other_id for msg in msgs):
+            mark_conversation_read(cursor, user_id, other_id)
+            conn.commit()
+        cursor.close()
+    finally:
+        pool.release(conn)
+    return msgs
+
+def conversation_last_id(cursor, user_id, other_id):
+    """Id of the newest message between two users (0 if none).
+
+    One backward index probe per direction rather than MAX() over the OR,
+    which MySQL would answer by scanning the whole conversation.
+    """
+    last_id = 0
+    for sender, recipient in ((user_id, other_id), (other_id, user_id)):
+        cursor.execute("""
+            SELECT id FROM messages
+            WHERE sender_id=%s AND recipient_id=%s
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        """, (sender, recipient))
+        row = cursor.fetchone()
+        if row:
+            last_id = max(last_id, row["id"])
+    return last_id
+
+def load_conversation_since(cursor, user_id, other_id, since_id, limit):
+    """Messages newer than `since_id`, oldest first, at most `limit` of them.
+    Returns (messages, more) where `more` means another call is needed."""
     cursor.execute("""
-        SELECT m.*, s.username as sender_name, r.username as recipient_name
+        SELECT m.id, m.sender_id, m.recipient_id, m.content, m.created_at
         FROM messages m
-        JOIN users s ON s.id = m.sender_id
-        JOIN users r ON r.id = m.recipient_id
-        WHERE (m.sender_id=%s AND m.recipient_id=%s)
-           OR (m.sender_id=%s AND m.recipient_id=%s)
-        ORDER BY m.created_at ASC
-    """, (user_id, other_id, other_id, user_id))
+        WHERE ((m.sender_id=%s AND m.recipient_id=%s)
+            OR (m.sender_id=%s AND m.recipient_id=%s))
+          AND m.id > %s
+        ORDER BY m.id ASC
+        LIMIT %s
+    """, (user_id, other_id, other_id, user_id, since_id, limit + 1))
     msgs = cursor.fetchall()
-    cursor.close()
-    conn.close()
-
-    data = []
-    for msg in msgs:
-        data.append({
-            "id": msg["id"],
-            "content": msg["content"],
-            "created_at": str(msg["created_at"]),
-            "sender_id": msg["sender_id"],
-            "sender_name": msg["sender_name"],
-            "recipient_id": msg["recipient_id"],
-            "recipient_name": msg["recipient_name"]
-        })
-
-    return jsonify({"messages": data})
-
-@app.route("/uploads/<filename>")
+    more = len(msgs) > limit
+    return msgs[:limit], more
+
+def load_conversation_page(cursor, user_id, other_id, position, limit):
+    """The latest page of a conversation (or the page before `position`),
+    returned oldest first, plus the cursor for the page before it."""
+    where, params = keyset_filter(position, "m.created_at", "m.id")
+    cursor.execute(f"""
+        SELECT m.id, m.sender_id, m.recipient_id, m.content, m.created_at
+        FROM messages m
+        WHERE ((m.sender_id=%s AND m.recipient_id=%s)
+            OR (m.sender_id=%s AND m.recipient_id=%s))
+          {"AND " + where if where else ""}
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT %s
+    """, [user_id, other_id, other_id, user_id] + params + [limit + 1])
+    msgs, older_cursor = split_page(cursor.fetchall(), limit)
+    msgs.reverse()
+
+    return msgs, older_cursor
+
+def conversation_users(user_id, other_user):
+    """The `users` map of a conversation response: both participants."""
+    names = {other_user["id"]: {"username": other_user["username"]}}
+    me = users.get_cache(get_pool).by_id(user_id, get_db)
+    if me is not None:
+        names[user_id] = {"username": me["username"]}
+    return names
+
+def message_json(msg):
+    """A message as the JSON APIs send it. Names aren't repeated per
+    message: the response carries a `users` map (see users_json)."""
+    return {
+        "id": msg["id"],
+        "sender_id": msg["sender_id"],
+        "content": msg["content"],
+        "created_at": responses.epoch(msg["created_at"]),
+    }
+
+def post_json(post):
+    """A post card (post_cards()) as the JSON APIs send it; the author's
+    name and picture go in the `users` map."""
+    return {
+        "id": post["id"],
+        "user_id": post["user_id"],
+        "content": post["content"],
+        "media_filename": post["media_filename"],
+        "created_at": responses.epoch(post["created_at"]),
+        "like_count": post["like_count"],
+        "liked": post["user_has_liked"],
+        "saved": post["user_has_saved"],
+    }
+
+def users_json(rows, id_key="user_id"):
+    """{user id: {"username", "profile_picture"}} for the authors of `rows`,
+    each user once."""
+    return {row[id_key]: {"username": row["username"], "profile_picture": row["profile_picture"]}
+            for row in rows}
+
+# Representative calls for each hot query, used by `flask explain-hot-queries`.
+# Keep this in step with the routes: the report EXPLAINs exactly the SQL
+# these functions issue.
+HOT_PATHS = {
+    "feed page": lambda cur: load_feed_page(cur, 1, None, FEED_PAGE_SIZE),
+    "feed page (cursor)": lambda cur: load_feed_page(
+        cur, 1, (datetime.now(), 2**31 - 1), FEED_PAGE_SIZE),
+    "profile posts": lambda cur: load_user_posts_page(cur, 1, None, PROFILE_PAGE_SIZE),
+    "profile saved posts": lambda cur: load_saved_posts_page(cur, 1, None, PROFILE_PAGE_SIZE),
+    "profile post count": lambda cur: count_user_posts(cur, 1),
+    "conversation page": lambda cur: load_conversation_page(cur, 1, 2, None, MESSAGES_PAGE_SIZE),
+    "conversation last id": lambda cur: conversation_last_id(cur, 1, 2),
+    "conversation since": lambda cur: load_conversation_since(cur, 1, 2, 0, MESSAGES_PAGE_SIZE),
+    "inbox page": lambda cur: load_inbox_page(cur, 1, None, MESSAGES_PAGE_SIZE),
+    "user by username": lambda cur: users.load_user(cur, "username", "admin"),
+    "active stories": stories.load_active_stories,
+    "home timeline page": lambda cur: timelines.load_home_ids(cur, 1, None, FEED_PAGE_SIZE),
+    "search posts": lambda cur: search.search_post_ids(cur, "photo", 0, search.SEARCH_PAGE_SIZE),
+    "search people": lambda cur: search.search_users(cur, "adm", 0, search.SEARCH_PAGE_SIZE),
+}
+
+@app.cli.command("explain-hot-queries")
+@click.option("--strict", is_flag=True, help="Exit non-zero if any plan has warnings.")
+def explain_hot_queries_command(strict):
+    """Print EXPLAIN plans for the hot queries and flag full scans/filesorts."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        flagged = migrations.explain_report(conn, HOT_PATHS, out=click.echo)
+    finally:
+        pool.release(conn)
+    if flagged:
+        click.echo(f"{flagged} statement(s) with warnings")
+        if strict:
+            raise SystemExit(1)
+
+@app.route("/admin/db_stats")
+def db_stats():
+    """Connection pool stats for this worker (admin only)."""
+    if session.get("username") != "admin":
+        return jsonify({"error": "Admins only"}), 403
+    pools = pool_stats()
+    return jsonify({"pid": os.getpid(), "pool": pools["primary"], "replicas": pools["replicas"],
+                    "stories_cache": stories.get_cache(get_pool).stats(),
+                    "user_cache": users.get_cache(get_pool).stats(),
+                    "fragment_cache": fragment_cache.stats(),
+                    "password_hashing": passwords.get_hasher().stats()})
+
+# ----- EXPORT -----
+@app.route("/export")
+def export_data():
+    """The logged-in user's posts, stories, likes, saves, follows and
+    messages with their media, as a .tar.gz streamed as it is read
+    (archive.py). Admins can ask for ?scope=site. Password hashes are
+    never included."""
+    user_id = get_current_user_id()
+    if not user_id:
+        return redirect(url_for("login"))
+    site = request.args.get("scope") == "site"
+    if site and session.get("username") != "admin":
+        return jsonify({"error": "Admins only"}), 403
+
+    # Held until the download ends, so not the request's connection; a
+    # replica's when one is caught up
+    replica = pick_replica()
+    pool = replica.pool if replica else get_pool()
+    conn = pool.acquire()
+    chunks = archive.export_archive(conn, storage_backend, user_id=None if site else user_id)
+
+    finished = False
+
+    def stream():
+        nonlocal finished
+        yield from chunks
+        finished = True
+
+    def release():
+        chunks.close()
+        pool.release(conn, discard=not finished)
+
+    name = "site" if site else session["username"]
+    resp = app.response_class(stream(), mimetype="application/gzip")
+    # Runs even if the body is never read (HEAD, client gone before the
+    # first chunk); a half-read archive leaves the connection mid-query
+    resp.call_on_close(release)
+    resp.headers["Content-Disposition"] = \
+        f'attachment; filename="{name}-{datetime.now():%Y%m%d}.tar.gz"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# ----------- PROBES -----------
+# How long /readyz waits for a pooled connection before reporting not ready
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", "2"))
+_schema_current = False
+
+@app.route("/healthz")
+def healthz():
+    """Liveness: the worker is serving requests. Never touches MySQL, so a
+    database outage doesn't get every pod restarted."""
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: MySQL answers and the schema is fully migrated."""
+    global _schema_current
+    pool = get_pool()
+    try:
+        conn = pool.acquire(timeout=READY_TIMEOUT)
+    except Exception as e:
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+    discard = False
+    try:
+        if _schema_current:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+        else:
+            waiting = migrations.pending(conn)
+            if waiting:
+                return jsonify({"status": "migrations pending", "pending": waiting}), 503
+            _schema_current = True
+    except mysql.connector.Error as e:
+        discard = True
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+    finally:
+        pool.release(conn, discard=discard)
+    return jsonify({"status": "ready"})
+
+@app.route("/uploads/<path:filename>")
 def uploads(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    if filename.startswith(storage.TEMP_DIR + "/"):
+        abort(404)  # uploads still being received
+    digest = storage.key_digest(filename)
+    return assets.send_asset(app.config["UPLOAD_FOLDER"], filename,
+                             immutable=bool(digest), etag=digest or True)
 
 if __name__ == "__main__":
+    # Development server only; production runs gunicorn (gunicorn.conf.py)
+    # and a separate jobs-worker
+    init_db()
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":  # the reloader's child
+        jobs.start_worker_thread(get_pool)
     app.run(host="0.0.0.0", port=5001, debug=True)
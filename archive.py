@@ -0,0 +1,577 @@
+"""Streaming export and import of user data.
+
+An archive is a tar stream (gzipped unless asked not to be):
+
+    manifest.json               format, archive id, scope, options
+    users/000001.ndjson         one JSON object per row,
+    posts/000001.ndjson ...     EXPORT_CHUNK_ROWS rows per member
+    media/ab/cd/<sha256>.jpg    uploads the rows refer to
+
+A site archive holds every row of the tables in TABLES. A user archive
+holds one user's row, follows, posts, stories, likes and saves, and the
+messages they sent or received. Derived data (counters, timelines,
+conversations, blob refcounts) is left out; import derives it for the rows
+it loads.
+
+Export reads each table through an unbuffered cursor, so rows come off
+the server as they are fetched, and sends each chunk as soon as it is
+full. Tar headers are written here rather than by tarfile, which needs a
+whole member in hand before it writes anything. Memory stays at one
+chunk however large the tables are. All tables are read in one
+consistent snapshot.
+
+Import keeps row ids. A site archive only goes into an empty database;
+a row whose id or username is taken stops the import with
+ImportConflict rather than being skipped. Each chunk is written with
+multi-row INSERTs in one transaction, together with the derived data
+for just those rows and the chunk's name in archive_imports. Running
+the import again after an interruption skips the chunks recorded there.
+"""
+import json
+import os
+import re
+import tarfile
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+import mysql.connector
+
+import migrations
+import storage
+import timelines
+
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "1000"))
+EXPORT_GZIP_LEVEL = int(os.environ.get("EXPORT_GZIP_LEVEL", "6"))
+# Rows per INSERT statement on import
+IMPORT_BATCH_ROWS = int(os.environ.get("IMPORT_BATCH_ROWS", "500"))
+
+FORMAT_VERSION = 1
+
+# Stored for users exported without their password hash: matches no
+# password, so they can't log in until one is set
+UNUSABLE_PASSWORD = "!"
+
+# (table, columns, order, rows of one user). Parents come before the rows
+# that refer to them.
+TABLES = (
+    ("users", ("id", "username", "password_hash", "profile_picture", "bio"),
+     "id", "id = %s"),
+    ("follows", ("follower_id", "followee_id", "created_at"),
+     "follower_id, followee_id", "follower_id = %s"),
+    ("posts", ("id", "user_id", "content", "media_filename", "created_at"),
+     "id", "user_id = %s"),
+    ("stories", ("id", "user_id", "media_filename", "created_at", "expires_at"),
+     "id", "user_id = %s"),
+    ("likes", ("id", "post_id", "user_id"),
+     "id", "user_id = %s"),
+    ("saved_posts", ("id", "user_id", "post_id"),
+     "id", "user_id = %s"),
+    ("messages", ("id", "sender_id", "recipient_id", "content", "created_at"),
+     "id", "sender_id = %s OR recipient_id = %s"),
+)
+COLUMNS = {table: columns for table, columns, _, _ in TABLES}
+
+_CHUNK_RE = re.compile(r"(\w+)/\d+\.ndjson")
+_MEDIA_KEY_RE = re.compile(r"[\w.-]+(/[\w.-]+)*")
+
+
+class InvalidArchive(ValueError):
+    pass
+
+
+class ImportConflict(Exception):
+    """The archive's rows clash with rows already in the database."""
+
+
+# ----- export -----
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    raise TypeError(f"can't export {type(value).__name__}")
+
+
+def _header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def _file_member(name, data, mtime):
+    return _header(name, len(data), mtime) + data + _padding(len(data))
+
+
+def _gzip(chunks, level):
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def _quietly(close):
+    # Stopped part-way through a result (the client went away): the
+    # connection can't be reused, and the caller discards it
+    try:
+        close()
+    except mysql.connector.Error:
+        pass
+
+
+def _where(user_filter, user_id):
+    if user_id is None:
+        return "", ()
+    return f"WHERE {user_filter}", (user_id,) * user_filter.count("%s")
+
+
+def _table_chunks(conn, table, columns, order, where, params, chunk_rows):
+    """NDJSON bytes of `chunk_rows` rows at a time."""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table} {where} ORDER BY {order}", params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield b"".join(
+                json.dumps(dict(zip(columns, row)), default=_json_default,
+                           ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+                for row in rows)
+    finally:
+        _quietly(cursor.close)
+
+
+def _media_keys(conn, user_id):
+    """Distinct upload keys the exported rows refer to, streamed."""
+    parts = [("posts", "media_filename", "user_id"),
+             ("stories", "media_filename", "user_id"),
+             ("users", "profile_picture", "id")]
+    selects, params = [], []
+    for table, column, owner in parts:
+        sql = f"SELECT {column} AS k FROM {table} WHERE {column} IS NOT NULL AND {column} <> ''"
+        if user_id is not None:
+            sql += f" AND {owner} = %s"
+            params.append(user_id)
+        selects.append(sql)
+    cursor = conn.cursor()
+    cursor.execute(" UNION ".join(selects), params)
+    try:
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            for (key,) in rows:
+                yield key
+    finally:
+        _quietly(cursor.close)
+
+
+def _media_member(backend, key, mtime):
+    """Tar member for one upload, read in storage.CHUNK_SIZE pieces.
+    Yields nothing if the file is missing."""
+    try:
+        f = backend.open(key)
+    except (FileNotFoundError, NotImplementedError):
+        return
+    with f:
+        try:
+            size = os.fstat(f.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            # Not a real file: measure it by reading it through once
+            size = 0
+            while True:
+                chunk = f.read(storage.CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+            f.seek(0)
+        yield _header("media/" + key, size, mtime)
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(storage.CHUNK_SIZE, remaining))
+            if not chunk:
+                raise OSError(f"media/{key} shrank while being exported")
+            remaining -= len(chunk)
+            yield chunk
+        yield _padding(size)
+
+
+def _export(conn, backend, user_id, password_hashes, chunk_rows):
+    mtime = int(time.time())
+    manifest = {
+        "format": FORMAT_VERSION,
+        "archive_id": uuid.uuid4().hex,
+        "scope": "site" if user_id is None else "user",
+        "user_id": user_id,
+        "password_hashes": password_hashes,
+        "created_at": datetime.now().isoformat(sep=" ", timespec="seconds"),
+        "tables": list(COLUMNS),
+    }
+    yield _file_member("manifest.json", json.dumps(manifest, indent=2).encode(), mtime)
+
+    # Every table as of the same moment; ends with the rollback below
+    conn.rollback()
+    cursor = conn.cursor()
+    cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+    cursor.close()
+    try:
+        for table, columns, order, user_filter in TABLES:
+            if table == "users" and not password_hashes:
+                columns = tuple(c for c in columns if c != "password_hash")
+            where, params = _where(user_filter, user_id)
+            chunks = _table_chunks(conn, table, columns, order, where, params, chunk_rows)
+            for n, data in enumerate(chunks, 1):
+                yield _file_member(f"{table}/{n:06d}.ndjson", data, mtime)
+        for key in _media_keys(conn, user_id):
+            yield from _media_member(backend, key, mtime)
+    finally:
+        _quietly(conn.rollback)
+    yield b"\0" * (2 * tarfile.BLOCKSIZE)
+
+
+def export_archive(conn, backend, user_id=None, password_hashes=False,
+                   gzip=True, chunk_rows=EXPORT_CHUNK_ROWS):
+    """The archive as an iterator of bytes: the whole site, or just
+    `user_id`'s data. `conn` is used by nothing else until the iterator
+    is exhausted or closed."""
+    chunks = _export(conn, backend, user_id, password_hashes, chunk_rows)
+    return _gzip(chunks, EXPORT_GZIP_LEVEL) if gzip else chunks
+
+
+# ----- import -----
+
+def _read_manifest(tar, member):
+    if member is None or member.name != "manifest.json":
+        raise InvalidArchive("manifest.json must come first")
+    try:
+        manifest = json.load(tar.extractfile(member))
+    except ValueError as e:
+        raise InvalidArchive(f"manifest.json: {e}") from None
+    if manifest.get("format") != FORMAT_VERSION:
+        raise InvalidArchive(f"unsupported archive format {manifest.get('format')!r}")
+    if not re.fullmatch(r"[0-9a-f]{32}", str(manifest.get("archive_id"))):
+        raise InvalidArchive("manifest.json has no valid archive_id")
+    return manifest
+
+
+def _imported_members(cursor, archive_id):
+    cursor.execute("SELECT member FROM archive_imports WHERE archive_id=%s", (archive_id,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _check_empty(cursor):
+    """Refuse a site archive if any of its tables already has rows: its
+    ids would collide with them, or worse, quietly mix with them."""
+    taken = []
+    for table in COLUMNS:
+        cursor.execute(f"SELECT 1 FROM {table} LIMIT 1")
+        if cursor.fetchone() is not None:
+            taken.append(table)
+    if taken:
+        raise ImportConflict(
+            f"a site archive needs an empty database ({', '.join(taken)} not empty)")
+
+
+def _chunk_rows(f, table, name):
+    """(columns, [values]) from an NDJSON member; every row has to have
+    the same, known, columns."""
+    columns, rows = None, []
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise InvalidArchive(f"{name}:{line_no}: {e}") from None
+        if not isinstance(row, dict):
+            raise InvalidArchive(f"{name}:{line_no}: expected an object")
+        if columns is None:
+            columns = tuple(row)
+            unknown = set(columns) - set(COLUMNS[table])
+            if unknown:
+                raise InvalidArchive(f"{name}: unknown column(s) {', '.join(sorted(unknown))}")
+            missing = set(COLUMNS[table]) - set(columns) - {"password_hash"}
+            if missing:
+                raise InvalidArchive(f"{name}: missing column(s) {', '.join(sorted(missing))}")
+        elif tuple(row) != columns:
+            raise InvalidArchive(f"{name}:{line_no}: columns differ from the first row")
+        rows.append(tuple(row.values()))
+    if table == "users" and columns and "password_hash" not in columns:
+        columns += ("password_hash",)
+        rows = [row + (UNUSABLE_PASSWORD,) for row in rows]
+    return columns, rows
+
+
+# ----- derived data, per imported chunk -----
+#
+# Each function gets the chunk's rows (dicts) and runs in its transaction,
+# so it only touches what those rows change and is never applied twice.
+
+def _in(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def _acquire_blobs(cursor, keys):
+    """One blob reference per non-empty key (storage.acquire, in bulk)."""
+    counts = {}
+    for key in keys:
+        if key:
+            counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return
+    now = datetime.now()
+    cursor.execute(f"""
+        INSERT INTO blobs (storage_key, size, refcount, created_at)
+        VALUES {", ".join(["(%s, 0, %s, %s)"] * len(counts))}
+        ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount)
+    """, [v for key, count in counts.items() for v in (key, count, now)])
+
+
+def _derive_users(cursor, rows):
+    _acquire_blobs(cursor, [row["profile_picture"] for row in rows])
+
+
+def _derive_follows(cursor, rows):
+    followers = sorted({row["follower_id"] for row in rows})
+    followees = sorted({row["followee_id"] for row in rows})
+    cursor.execute(f"""
+        UPDATE users u
+        LEFT JOIN (
+            SELECT followee_id, COUNT(*) AS c FROM follows
+            WHERE followee_id IN ({_in(followees)})
+            GROUP BY followee_id
+        ) f ON f.followee_id = u.id
+        SET u.follower_count = COALESCE(f.c, 0)
+        WHERE u.id IN ({_in(followees)})
+    """, followees + followees)
+    # Posts of the followed accounts that are already here; posts imported
+    # later reach these timelines through _derive_posts
+    cursor.execute(f"""
+        INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+        SELECT f.follower_id, p.id, p.user_id, p.created_at
+        FROM follows f
+        JOIN users u ON u.id = f.followee_id
+        JOIN posts p ON p.user_id = f.followee_id
+        WHERE f.follower_id IN ({_in(followers)}) AND f.followee_id IN ({_in(followees)})
+          AND u.follower_count < %s
+    """, followers + followees + [timelines.FANOUT_MAX_FOLLOWERS])
+
+
+def _derive_posts(cursor, rows):
+    ids = [row["id"] for row in rows]
+    cursor.execute(f"""
+        INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+        SELECT user_id, id, user_id, created_at FROM posts WHERE id IN ({_in(ids)})
+    """, ids)
+    # As timelines.fan_out, for the whole chunk
+    cursor.execute(f"""
+        INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+        SELECT f.follower_id, p.id, p.user_id, p.created_at
+        FROM posts p
+        JOIN users u ON u.id = p.user_id
+        JOIN follows f ON f.followee_id = p.user_id
+        WHERE p.id IN ({_in(ids)}) AND u.follower_count < %s
+    """, ids + [timelines.FANOUT_MAX_FOLLOWERS])
+    _acquire_blobs(cursor, [row["media_filename"] for row in rows])
+
+
+def _derive_stories(cursor, rows):
+    _acquire_blobs(cursor, [row["media_filename"] for row in rows])
+
+
+def _derive_likes(cursor, rows):
+    post_ids = sorted({row["post_id"] for row in rows})
+    cursor.execute(f"""
+        UPDATE posts p
+        LEFT JOIN (
+            SELECT post_id, COUNT(*) AS c FROM likes
+            WHERE post_id IN ({_in(post_ids)})
+            GROUP BY post_id
+        ) l ON l.post_id = p.id
+        SET p.like_count = COALESCE(l.c, 0)
+        WHERE p.id IN ({_in(post_ids)})
+    """, post_ids + post_ids)
+
+
+def _derive_messages(cursor, rows):
+    ids = [row["id"] for row in rows]
+    # Both sides' summaries for every pair in the chunk. A summary moves
+    # only to a later message; last_message_id goes last, since the
+    # other assignments compare against its old value.
+    cursor.execute(f"""
+        INSERT INTO conversations
+            (user_id, partner_id, last_message_id, last_message_at,
+             last_sender_id, snippet, unread_count)
+        SELECT t.user_id, t.partner_id, m.id, m.created_at,
+               m.sender_id, LEFT(m.content, %s), 0
+        FROM (
+            SELECT user_id, partner_id, MAX(id) AS last_id
+            FROM (
+                SELECT sender_id AS user_id, recipient_id AS partner_id, id
+                FROM messages WHERE id IN ({_in(ids)})
+                UNION ALL
+                SELECT recipient_id, sender_id, id
+                FROM messages WHERE id IN ({_in(ids)})
+            ) both_directions
+            GROUP BY user_id, partner_id
+        ) t
+        JOIN messages m ON m.id = t.last_id
+        ON DUPLICATE KEY UPDATE
+            last_message_at = IF(VALUES(last_message_id) > last_message_id,
+                                 VALUES(last_message_at), last_message_at),
+            last_sender_id = IF(VALUES(last_message_id) > last_message_id,
+                                VALUES(last_sender_id), last_sender_id),
+            snippet = IF(VALUES(last_message_id) > last_message_id, VALUES(snippet), snippet),
+            last_message_id = GREATEST(last_message_id, VALUES(last_message_id))
+    """, [migrations.SNIPPET_LENGTH] + ids + ids)
+
+
+_DERIVE = {
+    "users": _derive_users,
+    "follows": _derive_follows,
+    "posts": _derive_posts,
+    "stories": _derive_stories,
+    "likes": _derive_likes,
+    "messages": _derive_messages,
+}
+
+
+def _import_chunk(conn, archive_id, table, name, f, batch_rows):
+    """Insert one chunk, its derived data and its archive_imports row, in
+    one transaction. Returns the rows inserted."""
+    columns, rows = _chunk_rows(f, table, name)
+    if not rows:
+        return 0
+    cursor = conn.cursor()
+    try:
+        placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        for start in range(0, len(rows), batch_rows):
+            batch = rows[start:start + batch_rows]
+            cursor.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+                + ", ".join([placeholders] * len(batch)),
+                [v for row in batch for v in row])
+        if table in _DERIVE:
+            _DERIVE[table](cursor, [dict(zip(columns, row)) for row in rows])
+        cursor.execute("""
+            INSERT INTO archive_imports (archive_id, member, row_count, imported_at)
+            VALUES (%s, %s, %s, %s)
+        """, (archive_id, name, len(rows), datetime.now()))
+        conn.commit()
+    except mysql.connector.IntegrityError as e:
+        conn.rollback()
+        raise ImportConflict(f"{name}: {e.msg}") from None
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+def _import_media(conn, backend, key, f, on_media):
+    """Store one upload unless it's already there. Returns whether it was
+    stored."""
+    if backend.exists(key):
+        return False
+    tmp = storage.HashingTempFile(backend.temp_folder)
+    cursor = conn.cursor()
+    try:
+        while True:
+            chunk = f.read(storage.CHUNK_SIZE)
+            if not chunk:
+                break
+            tmp.write(chunk)
+        tmp.flush()
+        digest = storage.key_digest(key)
+        if digest is not None and digest != tmp.hexdigest():
+            raise InvalidArchive(f"media/{key}: content doesn't match its name")
+        # The rows referring to it counted its references already; this
+        # records the size
+        cursor.execute("""
+            INSERT INTO blobs (storage_key, size, refcount, created_at)
+            VALUES (%s, %s, 0, %s)
+            ON DUPLICATE KEY UPDATE size = VALUES(size)
+        """, (key, tmp.size, datetime.now()))
+        if on_media:
+            on_media(cursor, key)
+        backend.put(tmp.path, key)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        tmp.close()
+    return True
+
+
+def _import_members(conn, tar, backend, on_media, batch_rows, log, stats):
+    members = iter(tar)
+    manifest = _read_manifest(tar, next(members, None))
+    archive_id = manifest["archive_id"]
+    cursor = conn.cursor()
+    done = _imported_members(cursor, archive_id)
+    if not done and manifest.get("scope") == "site":
+        _check_empty(cursor)
+    conn.commit()
+    cursor.close()
+    if log:
+        log(f"archive {archive_id} ({manifest['scope']}, {manifest['created_at']})"
+            + (f": resuming, {len(done)} chunk(s) already imported" if done else ""))
+
+    for member in members:
+        name = member.name
+        if not member.isfile():
+            raise InvalidArchive(f"{name}: not a regular file")
+        if name.startswith("media/"):
+            key = name[len("media/"):]
+            if not _MEDIA_KEY_RE.fullmatch(key) or ".." in key.split("/"):
+                raise InvalidArchive(f"{name}: bad media key")
+            if _import_media(conn, backend, key, tar.extractfile(member), on_media):
+                stats["media"] += 1
+            else:
+                stats["media_present"] += 1
+            continue
+
+        m = _CHUNK_RE.fullmatch(name)
+        if m is None or m.group(1) not in COLUMNS:
+            raise InvalidArchive(f"{name}: unexpected member")
+        if name in done:
+            stats["chunks_skipped"] += 1
+            continue
+        rows = _import_chunk(conn, archive_id, m.group(1), name,
+                             tar.extractfile(member), batch_rows)
+        stats["rows"] += rows
+        if log:
+            log(f"{name}: {rows} row(s) imported")
+
+
+def import_archive(conn, fileobj, backend, on_media=None, batch_rows=IMPORT_BATCH_ROWS,
+                   log=None):
+    """Load an archive from `fileobj` (read sequentially, gzipped or not).
+    `on_media(cursor, key)` is called for every upload stored, in the
+    transaction that records it. Raises ImportConflict, with the chunks
+    before it kept, if a row is already taken.
+
+    Returns counts: rows imported, chunks skipped as already imported,
+    media stored and media already present.
+    """
+    stats = {"rows": 0, "chunks_skipped": 0, "media": 0, "media_present": 0}
+    try:
+        tar = tarfile.open(fileobj=fileobj, mode="r|*")
+        _import_members(conn, tar, backend, on_media, batch_rows, log, stats)
+    except (tarfile.TarError, EOFError) as e:
+        # Truncated or not a tar at all; what was committed stays, and
+        # the import resumes from there once given the whole file
+        raise InvalidArchive(f"unreadable archive: {e}") from e
+    return stats
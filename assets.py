@@ -0,0 +1,131 @@
+"""Serving static files and uploads so browsers can cache them.
+
+- Versioned URLs: url_for("static", ...) gets ?v=<version of the file>
+  (see version_static_urls in app.py). A request whose ?v= matches the
+  file on disk is answered with a one-year `immutable` Cache-Control;
+  anything else is revalidated against the ETag. Content-addressed
+  uploads (storage.py) carry their version in the name already.
+- Conditional and Range requests are handled by send_file: strong
+  ETags, 304s, and 206 partial responses read from disk with a seek, so
+  seeking in a video doesn't download it from the start.
+- Precompressed assets: compress_static() writes .br/.gz next to the CSS
+  and JS at build time (`python assets.py static`, or `flask
+  compress-static`); send_asset() serves them by Accept-Encoding.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # .gz only
+    brotli = None
+
+# One year, the conventional "forever"
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".json", ".txt"}
+# Preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+mimetypes.add_type("image/webp", ".webp")
+
+_versions = {}
+
+
+def file_version(path):
+    """Short token that changes whenever the file does, or None if it
+    doesn't exist. Cached per worker by (path, mtime, size)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_mtime_ns, st.st_size)
+    version = _versions.get(key)
+    if version is None:
+        if len(_versions) > 10000:
+            _versions.clear()
+        version = hashlib.sha1(repr(key[1:]).encode()).hexdigest()[:10]
+        _versions[key] = version
+    return version
+
+
+def _precompressed(folder, filename):
+    """(filename, encoding) of the best up-to-date precompressed copy the
+    client accepts, or (filename, None)."""
+    if os.path.splitext(filename)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+        return filename, None
+    source = safe_join(folder, filename)
+    try:
+        source_mtime = os.stat(source).st_mtime
+    except (TypeError, OSError):
+        return filename, None
+    for encoding, suffix in ENCODINGS:
+        if not request.accept_encodings[encoding]:
+            continue
+        try:
+            if os.stat(source + suffix).st_mtime >= source_mtime:
+                return filename + suffix, encoding
+        except OSError:
+            pass
+    return filename, None
+
+
+def send_asset(folder, filename, immutable=False, etag=True):
+    """send_from_directory() with precompressed variants and long-lived
+    caching for `immutable` URLs. `etag` may be a string to use as-is."""
+    served, encoding = _precompressed(folder, filename)
+    response = send_from_directory(
+        folder, served,
+        mimetype=mimetypes.guess_type(filename)[0],
+        download_name=os.path.basename(filename),
+        conditional=True,
+        etag=etag,
+        max_age=IMMUTABLE_MAX_AGE if immutable else None,
+    )
+    if immutable:
+        response.cache_control.immutable = True
+    if served != filename:
+        response.headers["Content-Encoding"] = encoding
+    if os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def compress_static(folder, skip=("uploads",), log=print):
+    """Write .gz (and .br, if brotli is installed) beside every compressible
+    file under `folder` that changed since it was last compressed.
+    Returns the number of files written."""
+    written = 0
+    for root, dirs, files in os.walk(folder):
+        if root == folder:
+            dirs[:] = [d for d in dirs if d not in skip]
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            outputs = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                outputs.append((".br", lambda d: brotli.compress(d, quality=11)))
+            for suffix, compress in outputs:
+                out = path + suffix
+                if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(path):
+                    continue
+                with open(out + ".tmp", "wb") as f:
+                    f.write(compress(data))
+                os.replace(out + ".tmp", out)
+                written += 1
+                log(f"{os.path.relpath(out, folder)}: {len(data)} -> {os.path.getsize(out)} bytes")
+    return written
+
+
+if __name__ == "__main__":
+    # Build step (see Dockerfile); doesn't need the app or a database
+    compress_static(sys.argv[1] if len(sys.argv) > 1 else "static")
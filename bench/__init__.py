@@ -0,0 +1,30 @@
+"""Load tests and benchmarks for the app.
+
+    python -m bench seed --users 2000 --posts 100000      # fill MySQL
+    python -m bench run --requests 5000 --concurrency 8   # replay a workload
+    python -m bench run --db standin                      # no MySQL at all
+
+`seed` writes a reproducible dataset (same --seed, same rows) with the
+skew real data has: a few authors write most posts, a few posts get most
+likes, and follower counts follow a power law.
+
+`run` drives the real routes in-process through Flask's test client
+(no sockets, no server). It reports p50/p95/p99 latency, throughput and
+SQL statements per request for each endpoint, and compares the result
+with a stored baseline. --mix picks another scenario set: login-storm
+sends logins and feed reads half and half, to see whether password
+hashing holds up the feed.
+
+MySQL is configured with the app's usual MYSQL_* variables. A throwaway
+local server:
+
+    docker run -d --name bench-mysql -p 3306:3306 \\
+        -e MYSQL_ROOT_PASSWORD=password -e MYSQL_DATABASE=socialdb mysql:8.0
+
+With --db standin, connections go to bench.standin instead: an
+in-memory imitation that answers the app's statements from generated
+rows. It measures the app's own overhead (routing, Python, templates).
+Statements cost nothing there unless --standin-latency-ms is given, so
+its numbers are only comparable with other stand-in runs. Baselines are
+kept per backend for that reason.
+"""
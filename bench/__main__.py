@@ -0,0 +1,131 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import bench
+from bench import seed
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Dataset the stand-in serves (smaller than a MySQL seed: it lives in memory)
+STANDIN_SIZES = {"users": 1000, "posts": 20000, "likes": 100000, "saves": 10000,
+                 "follows": 20000, "stories": 500, "messages": 20000}
+
+
+def _import_app():
+    # One process, no background threads competing with the measurement
+    os.environ.setdefault("REALTIME_BUS", "local")
+    os.environ.setdefault("STORY_REAP_INTERVAL", "0")
+    import app as app_module
+    return app_module
+
+
+def _sizes(args):
+    return {name: getattr(args, name) for name in seed.DEFAULT_SIZES
+            if getattr(args, name) is not None}
+
+
+def seed_command(args):
+    app_module = _import_app()
+    from db import get_pool
+
+    data = seed.generate(_sizes(args), seed=args.seed,
+                         media=seed.sample_media(app_module.app.config["UPLOAD_FOLDER"]))
+    app_module.init_db(log=print)
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        if args.reset:
+            seed.reset(conn)
+        seed.load(conn, data)
+    finally:
+        pool.release(conn)
+
+
+def run_command(args):
+    from bench import workload
+
+    if args.db == "standin":
+        from bench import standin
+        upload_folder = os.path.join("static", "uploads")
+        data = seed.generate(dict(STANDIN_SIZES, **_sizes(args)), seed=args.seed,
+                             media=seed.sample_media(upload_folder))
+        standin.install(data, args.standin_latency_ms)
+        ctx = workload.context_from_dataset(data)
+        app_module = _import_app()
+    else:
+        app_module = _import_app()
+        from db import get_pool
+        pool = get_pool()
+        conn = pool.acquire()
+        try:
+            ctx = workload.context_from_db(conn)
+        finally:
+            pool.release(conn)
+        if not ctx.users:
+            sys.exit("no users: run `python -m bench seed` first")
+
+    import storage
+    app = app_module.app
+    with tempfile.TemporaryDirectory(prefix="bench-uploads-") as uploads:
+        # Benchmark uploads go to a scratch folder, not static/uploads
+        app_module.storage_backend = storage.LocalStorage(uploads)
+        app.config["UPLOAD_FOLDER"] = uploads
+        app.config["UPLOAD_TMP_FOLDER"] = app_module.storage_backend.temp_folder
+        report = workload.run(app, ctx, requests=args.requests, concurrency=args.concurrency,
+                              seed=args.seed, warmup=args.warmup,
+                              scenarios=workload.MIXES[args.mix])
+
+    backend = args.db if args.db == "mysql" else f"standin-{args.standin_latency_ms:g}ms"
+    if args.mix != "default":
+        backend += f"-{args.mix}"
+    baseline = workload.load_baseline(args.baseline, backend)
+    regressions = workload.compare(report, baseline, args.tolerance) if baseline else []
+    print(workload.format_report(report, regressions))
+    if baseline is None and not args.save_baseline:
+        print(f"no {backend} baseline in {args.baseline} (--save-baseline records one)")
+    if args.save_baseline:
+        workload.save_baseline(args.baseline, backend, report)
+        print(f"saved {backend} baseline to {args.baseline}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+def main(argv=None):
+    from bench import workload
+
+    parser = argparse.ArgumentParser(prog="python -m bench", description=bench.__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("seed", help="fill MySQL with a generated dataset")
+    p.add_argument("--reset", action="store_true", help="empty the tables first")
+    p.set_defaults(func=seed_command)
+
+    p = sub.add_parser("run", help="replay the workload and report")
+    p.add_argument("--db", choices=("mysql", "standin"), default="mysql")
+    p.add_argument("--standin-latency-ms", type=float, default=0.0,
+                   help="simulated cost of each statement on the stand-in")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--warmup", type=int, default=20, help="untimed requests per thread")
+    p.add_argument("--mix", choices=sorted(workload.MIXES), default="default",
+                   help="scenario set to replay (login-storm: logins against feed reads)")
+    p.add_argument("--baseline", default=DEFAULT_BASELINE)
+    p.add_argument("--save-baseline", action="store_true")
+    p.add_argument("--tolerance", type=float, default=0.2,
+                   help="allowed p95 slowdown as a fraction")
+    p.add_argument("--fail-on-regression", action="store_true")
+    p.set_defaults(func=run_command)
+
+    for p in sub.choices.values():
+        p.add_argument("--seed", type=int, default=42, help="dataset and workload seed")
+        for name in seed.DEFAULT_SIZES:
+            p.add_argument(f"--{name}", type=int, help=f"number of {name} to generate")
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Reproducible synthetic data: generate() builds the rows, load() writes
+them to MySQL.
+
+Skew, because uniform data hides the problems real data has:
+- authors: post counts follow a Zipf-like curve (a few prolific users)
+- likes and saves: per-post weights are Pareto-distributed, so a handful
+  of posts collect most of them
+- follows: followees are drawn by the same popularity as authors, giving
+  a power-law follower count (and a few accounts over the fan-out limit)
+- messages: a few conversations are long, most are short
+
+Ids are assigned here (the tables must be empty), and posts and messages
+get ids in time order as the app would have given them.
+"""
+import bisect
+import itertools
+import os
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import migrations
+
+# Every seeded user logs in with this password
+PASSWORD = "password"
+BATCH_SIZE = 2000
+
+DEFAULT_SIZES = {
+    "users": 2000,
+    "posts": 100000,
+    "likes": 600000,
+    "saves": 60000,
+    "follows": 60000,
+    "stories": 3000,
+    "messages": 100000,
+}
+
+TABLES = ("timelines", "follows", "conversations", "messages", "saved_posts", "likes",
+          "stories", "posts", "blobs", "users")
+
+WORDS = ("cat", "nap", "sun", "window", "box", "treat", "zoomies", "purr", "tail",
+         "whiskers", "today", "again", "best", "friend", "morning", "look", "at", "this")
+
+
+class Dataset:
+    """Rows for every table, as tuples in the column order of COLUMNS."""
+
+    COLUMNS = {
+        "users": ("id", "username", "password_hash", "profile_picture", "bio"),
+        "posts": ("id", "user_id", "content", "media_filename", "created_at"),
+        "likes": ("id", "post_id", "user_id"),
+        "saved_posts": ("id", "user_id", "post_id"),
+        "follows": ("follower_id", "followee_id", "created_at"),
+        "stories": ("id", "user_id", "media_filename", "created_at", "expires_at"),
+        "messages": ("id", "sender_id", "recipient_id", "content", "created_at"),
+    }
+
+    def __init__(self):
+        self.rows = {table: [] for table in self.COLUMNS}
+
+    def __getitem__(self, table):
+        return self.rows[table]
+
+
+def username(user_id):
+    return f"user{user_id:06d}"
+
+
+def _sentence(rng, n_min=3, n_max=16):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(n_min, n_max)))
+
+
+def _cumulative(weights):
+    return list(itertools.accumulate(weights))
+
+
+def _pick(rng, cum, n=1):
+    """Indexes drawn (with replacement) by the weights behind `cum`."""
+    total = cum[-1]
+    return [bisect.bisect_left(cum, rng.random() * total) for _ in range(n)]
+
+
+def sample_media(upload_folder):
+    """Originals under the upload folder to reuse as post media."""
+    try:
+        names = sorted(os.listdir(upload_folder))
+    except OSError:
+        return []
+    return [n for n in names if os.path.splitext(n)[1].lower() in (".png", ".jpg", ".jpeg")]
+
+
+def generate(sizes=None, seed=42, media=(), now=None):
+    """Build a Dataset. The same sizes, seed and media give the same rows."""
+    sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+    rng = random.Random(seed)
+    now = (now or datetime.now()).replace(microsecond=0)
+    data = Dataset()
+    n_users = sizes["users"]
+    user_ids = list(range(1, n_users + 1))
+
+    password_hash = generate_password_hash(PASSWORD)
+    for uid in user_ids:
+        picture = rng.choice(media) if media and rng.random() < 0.7 else None
+        data["users"].append((uid, username(uid), password_hash, picture, _sentence(rng, 0, 8)))
+
+    # Popularity rank -> Zipf weight, over users in random order
+    ranked = user_ids[:]
+    rng.shuffle(ranked)
+    popularity = _cumulative(1.0 / (rank + 1) ** 1.1 for rank in range(n_users))
+
+    # Posts over the last 90 days, ids in time order
+    span = 90 * 24 * 3600
+    times = sorted(now - timedelta(seconds=rng.randrange(span)) for _ in range(sizes["posts"]))
+    for post_id, (created, idx) in enumerate(zip(times, _pick(rng, popularity, sizes["posts"])), 1):
+        has_media = media and rng.random() < 0.6
+        data["posts"].append((post_id, ranked[idx], _sentence(rng),
+                              rng.choice(media) if has_media else None, created))
+
+    # Likes and saves concentrate on a few posts
+    n_posts = len(data["posts"])
+    if n_posts:
+        post_weights = _cumulative(rng.paretovariate(1.2) for _ in range(n_posts))
+        likes = {(idx + 1, rng.choice(user_ids)) for idx in _pick(rng, post_weights, sizes["likes"])}
+        for row_id, (post_id, uid) in enumerate(sorted(likes), 1):
+            data["likes"].append((row_id, post_id, uid))
+        saves = {(idx + 1, rng.choice(user_ids)) for idx in _pick(rng, post_weights, sizes["saves"])}
+        for row_id, (post_id, uid) in enumerate(sorted(saves), 1):
+            data["saved_posts"].append((row_id, uid, post_id))
+
+    # Followers go to popular accounts
+    seen = set()
+    for idx in _pick(rng, popularity, sizes["follows"]):
+        follower, followee = rng.choice(user_ids), ranked[idx]
+        if follower != followee:
+            seen.add((follower, followee))
+    for follower, followee in sorted(seen):
+        data["follows"].append((follower, followee, now - timedelta(seconds=rng.randrange(span))))
+
+    # Stories from the last 48h, so about half have expired (none without
+    # media files to point at)
+    for story_id in range(1, (sizes["stories"] if media else 0) + 1):
+        created = now - timedelta(seconds=rng.randrange(48 * 3600))
+        data["stories"].append((story_id, ranked[_pick(rng, popularity)[0]], rng.choice(media),
+                                created, created + timedelta(hours=24)))
+
+    # Conversations between pairs of users, lengths Pareto-distributed
+    if n_users > 1 and sizes["messages"]:
+        pairs = [tuple(rng.sample(user_ids, 2)) for _ in range(max(1, sizes["messages"] // 20))]
+        pair_weights = _cumulative(rng.paretovariate(1.3) for _ in pairs)
+        month = 30 * 24 * 3600
+        msgs = []
+        for idx in _pick(rng, pair_weights, sizes["messages"]):
+            a, b = pairs[idx]
+            sender, recipient = (a, b) if rng.random() < 0.5 else (b, a)
+            msgs.append((now - timedelta(seconds=rng.randrange(month)), sender, recipient))
+        msgs.sort()
+        for msg_id, (created, sender, recipient) in enumerate(msgs, 1):
+            data["messages"].append((msg_id, sender, recipient, _sentence(rng, 1, 20), created))
+
+    return data
+
+
+def reset(conn):
+    """Empty every table the seeder writes."""
+    cursor = conn.cursor()
+    cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+    for table in TABLES:
+        cursor.execute(f"TRUNCATE TABLE {table}")
+    cursor.execute("SET FOREIGN_KEY_CHECKS=1")
+    conn.commit()
+    cursor.close()
+
+
+def load(conn, data, log=print):
+    """Insert a Dataset into empty tables, then build the derived data
+    (counters, timelines, conversations, blob refcounts)."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM users")
+    if cursor.fetchone()[0]:
+        raise RuntimeError("users table is not empty (use --reset)")
+
+    for table, columns in Dataset.COLUMNS.items():
+        rows = data[table]
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+               f"VALUES ({', '.join(['%s'] * len(columns))})")
+        for start in range(0, len(rows), BATCH_SIZE):
+            cursor.executemany(sql, rows[start:start + BATCH_SIZE])
+            conn.commit()
+        log(f"{table}: {len(rows)} rows")
+    cursor.close()
+
+    migrations.rebuild_derived(conn, log=log)
@@ -0,0 +1,450 @@
+"""In-memory stand-in for MySQL, for benchmarking without a server.
+
+install() replaces mysql.connector.connect() with connections to a
+StandIn built from a seed.Dataset. It recognises the statements the
+benchmark workload makes (by shape, like a very small query planner) and
+answers them from in-memory indexes. Writes the workload depends on
+(likes, new posts) update that state. Anything it doesn't recognise
+returns no rows, or a rowcount of 1 for writes.
+
+This is not a database: no transactions, no isolation, and only the
+statements the routes issue today. Add a handler here when a route gains
+a statement the workload exercises.
+"""
+import bisect
+import heapq
+import itertools
+import re
+import threading
+import time
+from collections import defaultdict
+
+import mysql.connector
+
+import migrations
+import timelines
+
+_placeholders = re.compile(r"IN \(((?:%s, )*%s)\)")
+
+
+def _in_count(sql):
+    m = _placeholders.search(sql)
+    return m.group(1).count("%s") if m else 0
+
+
+def _page(keys, params, limit):
+    """Up to `limit` (created_at, id) keys (newest first) after a keyset
+    position, as {id, created_at} rows."""
+    if params:
+        position = (params[0], params[2])
+        keys = (k for k in keys if k < position)
+    return [{"id": i, "created_at": c} for c, i in itertools.islice(keys, limit)]
+
+
+def _older(rows, params, created_key="created_at", id_key="id"):
+    """Rows (newest first) strictly after a keyset position; `params` is
+    keyset_filter()'s [created, created, id] or []."""
+    if not params:
+        return rows
+    created, _, row_id = params
+    return [r for r in rows if (r[created_key], r[id_key]) < (created, row_id)]
+
+
+def _columns(sql, row):
+    """[row] with just the plain columns the SELECT names, or []."""
+    if row is None:
+        return []
+    names = [c.strip() for c in sql[len("SELECT "):sql.index(" FROM ")].split(",")]
+    return [dict(row)] if names == ["*"] else [{c: row[c] for c in names}]
+
+
+class StandIn:
+    def __init__(self, data, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.RLock()
+        cols = data.COLUMNS
+
+        self.users = {}
+        self.users_by_name = {}
+        for row in data["users"]:
+            user = dict(zip(cols["users"], row), follower_count=0)
+            self.users[user["id"]] = user
+            self.users_by_name[user["username"]] = user
+        self.usernames = sorted(self.users_by_name)
+
+        self.posts = {}
+        self.post_keys = []
+        self.posts_by_word = defaultdict(set)  # FULLTEXT stand-in
+        self.posts_by_user = defaultdict(list)
+        for row in data["posts"]:
+            self._add_post(dict(zip(cols["posts"], row), like_count=0))
+
+        self.likes = {(post_id, user_id) for _, post_id, user_id in data["likes"]}
+        for post_id, _ in self.likes:
+            self.posts[post_id]["like_count"] += 1
+        self.saves = {(user_id, post_id) for _, user_id, post_id in data["saved_posts"]}
+
+        self.following = defaultdict(set)
+        for follower, followee, _ in data["follows"]:
+            self.following[follower].add(followee)
+            self.users[followee]["follower_count"] += 1
+        self._timelines = {}
+
+        self.stories = [dict(zip(cols["stories"], row)) for row in data["stories"]]
+
+        self.messages = defaultdict(list)  # (sender, recipient) -> rows by id
+        self.conversations = defaultdict(dict)  # user -> partner -> last message
+        for row in data["messages"]:
+            msg = dict(zip(cols["messages"], row))
+            self.messages[(msg["sender_id"], msg["recipient_id"])].append(msg)
+            for user, partner in ((msg["sender_id"], msg["recipient_id"]),
+                                  (msg["recipient_id"], msg["sender_id"])):
+                self.conversations[user][partner] = msg
+
+        self.next_post_id = max(self.posts, default=0) + 1
+        self.queries = 0
+        # What SHOW SLAVE STATUS reports, for exercising replica routing
+        # (MYSQL_REPLICA_HOSTS connections reach this same StandIn)
+        self.replica_lag = 0
+
+        self.handlers = [(re.compile(pattern), getattr(self, name)) for pattern, name in (
+            (r"^SELECT version FROM schema_migrations", "schema_versions"),
+            (r"^SHOW SLAVE STATUS", "slave_status"),
+            (r"^SELECT [\w, *]+ FROM users WHERE username=%s", "user_by_name"),
+            (r"^SELECT [\w, *]+ FROM users WHERE id=%s", "user_by_id"),
+            (r"^UPDATE users SET password_hash=%s WHERE id=%s AND password_hash=%s",
+             "set_password_hash"),
+            (r"FROM timelines t WHERE t\.user_id = %s", "timeline_page"),
+            (r"WHERE f\.follower_id = %s AND u\.follower_count >= %s", "pulled_authors"),
+            (r"FROM posts p WHERE p\.user_id IN", "pulled_posts"),
+            (r"FROM posts p JOIN users u ON p\.user_id = u\.id WHERE p\.id IN", "posts_by_ids"),
+            (r"FROM posts p JOIN users u ON p\.user_id = u\.id WHERE p\.user_id=%s", "user_posts_page"),
+            (r"FROM posts p JOIN users u ON p\.user_id = u\.id (WHERE|ORDER)", "all_posts_page"),
+            (r"^SELECT post_id FROM likes WHERE user_id=%s AND post_id IN", "liked_flags"),
+            (r"^SELECT post_id FROM saved_posts WHERE user_id=%s AND post_id IN", "saved_flags"),
+            (r"FROM stories s JOIN users u", "active_stories"),
+            (r"^SELECT COUNT\(\*\) AS c FROM posts WHERE user_id=%s", "count_posts"),
+            (r"^SELECT COUNT\(\*\) AS c FROM follows WHERE follower_id=%s", "count_following"),
+            (r"^SELECT 1 FROM follows WHERE follower_id=%s AND followee_id=%s", "is_following"),
+            (r"^INSERT IGNORE INTO likes", "insert_like"),
+            (r"^DELETE FROM likes WHERE post_id=%s AND user_id=%s", "delete_like"),
+            (r"^DELETE FROM likes WHERE user_id=%s AND post_id IN", "delete_likes"),
+            (r"^INSERT IGNORE INTO saved_posts \(post_id, user_id\)", "insert_saves"),
+            (r"^DELETE FROM saved_posts WHERE user_id=%s AND post_id IN", "delete_saves"),
+            (r"^SELECT id(, like_count)? FROM posts WHERE id IN", "existing_posts"),
+            (r"^UPDATE posts SET like_count = like_count \+ CASE id", "adjust_like_counts"),
+            (r"^UPDATE posts SET like_count = like_count \+ %s WHERE id=%s", "bump_like_count"),
+            (r"^SELECT like_count FROM posts WHERE id=%s", "like_count"),
+            (r"^SELECT id FROM messages WHERE sender_id=%s AND recipient_id=%s", "last_message"),
+            (r"FROM messages m .* AND m\.id > %s", "messages_since"),
+            (r"FROM messages m ", "messages_page"),
+            (r"FROM conversations c JOIN users u", "inbox_page"),
+            (r"^INSERT INTO posts ", "insert_post"),
+            (r"^INSERT IGNORE INTO timelines \(user_id, post_id, author_id, created_at\) VALUES",
+             "add_own"),
+            (r"^SELECT id FROM posts WHERE MATCH\(content\)", "search_posts"),
+            (r"FROM users WHERE username LIKE %s ORDER BY username", "users_by_prefix"),
+            (r"FROM users WHERE MATCH\(bio\)", "users_by_bio"),
+        )]
+
+    # ----- helpers -----
+
+    def _add_post(self, post):
+        self.posts[post["id"]] = post
+        # (created_at, id), oldest first
+        key = (post["created_at"], post["id"])
+        bisect.insort(self.post_keys, key)
+        bisect.insort(self.posts_by_user[post["user_id"]], key)
+        for word in set((post["content"] or "").lower().split()):
+            self.posts_by_word[word].add(post["id"])
+
+    def _post_row(self, post, star=False):
+        user = self.users[post["user_id"]]
+        row = dict(post) if star else {
+            "id": post["id"], "user_id": post["user_id"], "content": post["content"],
+            "media_filename": post["media_filename"], "created_at": post["created_at"],
+            "like_count": post["like_count"],
+        }
+        row.update(username=user["username"], profile_picture=user["profile_picture"])
+        return row
+
+    def _timeline(self, user_id):
+        """Materialized timeline ids, newest first (rebuilt after fan-out)."""
+        keys = self._timelines.get(user_id)
+        if keys is None:
+            authors = {user_id} | {a for a in self.following[user_id]
+                                   if self.users[a]["follower_count"] < timelines.FANOUT_MAX_FOLLOWERS}
+            keys = sorted((k for a in authors for k in self.posts_by_user[a]), reverse=True)
+            self._timelines[user_id] = keys
+        return keys
+
+    # ----- handlers: (sql, params) -> rows or rowcount -----
+
+    def schema_versions(self, sql, p):
+        # The schema is whatever this module imitates: fully migrated
+        return [{"version": version} for version, _, _ in migrations.MIGRATIONS]
+
+    def slave_status(self, sql, p):
+        return [{"Seconds_Behind_Master": self.replica_lag}]
+
+    def user_by_name(self, sql, p):
+        return _columns(sql, self.users_by_name.get(p[0]))
+
+    def user_by_id(self, sql, p):
+        return _columns(sql, self.users.get(p[0]))
+
+    def set_password_hash(self, sql, p):
+        user = self.users.get(p[1])
+        if user is None or user["password_hash"] != p[2]:
+            return 0
+        user["password_hash"] = p[0]
+        return 1
+
+    def timeline_page(self, sql, p):
+        return _page(self._timeline(p[0]), p[1:-1], p[-1])
+
+    def pulled_authors(self, sql, p):
+        return [{"followee_id": a} for a in self.following[p[0]]
+                if self.users[a]["follower_count"] >= p[1]]
+
+    def pulled_posts(self, sql, p):
+        n = _in_count(sql)
+        keys = sorted((k for a in p[:n] for k in self.posts_by_user[a]), reverse=True)
+        return _page(keys, p[n:-1], p[-1])
+
+    def posts_by_ids(self, sql, p):
+        return [self._post_row(self.posts[i]) for i in p if i in self.posts]
+
+    def user_posts_page(self, sql, p):
+        return [self._post_row(self.posts[r["id"]], star=True)
+                for r in _page(reversed(self.posts_by_user[p[0]]), p[1:-1], p[-1])]
+
+    def all_posts_page(self, sql, p):
+        return [self._post_row(self.posts[r["id"]])
+                for r in _page(reversed(self.post_keys), p[:-1], p[-1])]
+
+    def liked_flags(self, sql, p):
+        return [{"post_id": i} for i in p[1:] if (i, p[0]) in self.likes]
+
+    def saved_flags(self, sql, p):
+        return [{"post_id": i} for i in p[1:] if (p[0], i) in self.saves]
+
+    def active_stories(self, sql, p):
+        rows = []
+        for story in sorted(self.stories, key=lambda s: s["expires_at"]):
+            if story["expires_at"] > p[0]:
+                user = self.users[story["user_id"]]
+                rows.append(dict(story, username=user["username"],
+                                 profile_picture=user["profile_picture"]))
+        return rows
+
+    def count_posts(self, sql, p):
+        return [{"c": len(self.posts_by_user[p[0]])}]
+
+    def count_following(self, sql, p):
+        return [{"c": len(self.following[p[0]])}]
+
+    def is_following(self, sql, p):
+        return [{"1": 1}] if p[1] in self.following[p[0]] else []
+
+    def insert_like(self, sql, p):
+        pairs = {(p[i], p[i + 1]) for i in range(0, len(p), 2)} - self.likes
+        self.likes |= pairs
+        return len(pairs)
+
+    def delete_like(self, sql, p):
+        if (p[0], p[1]) not in self.likes:
+            return 0
+        self.likes.discard((p[0], p[1]))
+        return 1
+
+    def delete_likes(self, sql, p):
+        pairs = {(post_id, p[0]) for post_id in p[1:]} & self.likes
+        self.likes -= pairs
+        return len(pairs)
+
+    def insert_saves(self, sql, p):
+        pairs = {(p[i + 1], p[i]) for i in range(0, len(p), 2)} - self.saves
+        self.saves |= pairs
+        return len(pairs)
+
+    def delete_saves(self, sql, p):
+        pairs = {(p[0], post_id) for post_id in p[1:]} & self.saves
+        self.saves -= pairs
+        return len(pairs)
+
+    def existing_posts(self, sql, p):
+        return [{"id": i, "like_count": self.posts[i]["like_count"]} for i in p if i in self.posts]
+
+    def adjust_like_counts(self, sql, p):
+        n = _in_count(sql)
+        deltas = dict(zip(p[:-n:2], p[1:-n:2]))
+        for post_id, delta in deltas.items():
+            if post_id in self.posts:
+                self.posts[post_id]["like_count"] += delta
+        return len(deltas)
+
+    def bump_like_count(self, sql, p):
+        post = self.posts.get(p[1])
+        if post:
+            post["like_count"] += p[0]
+        return 1 if post else 0
+
+    def like_count(self, sql, p):
+        post = self.posts.get(p[0])
+        return [{"like_count": post["like_count"]}] if post else []
+
+    def last_message(self, sql, p):
+        msgs = self.messages.get((p[0], p[1]))
+        return [{"id": msgs[-1]["id"]}] if msgs else []
+
+    def messages_since(self, sql, p):
+        a, b, since_id, limit = p[0], p[1], p[4], p[5]
+        msgs = sorted(self.messages.get((a, b), []) + self.messages.get((b, a), []),
+                      key=lambda m: m["id"])
+        return [dict(m) for m in msgs if m["id"] > since_id][:limit]
+
+    def messages_page(self, sql, p):
+        a, b = p[0], p[1]
+        msgs = sorted(self.messages.get((a, b), []) + self.messages.get((b, a), []),
+                      key=lambda m: (m["created_at"], m["id"]), reverse=True)
+        return [dict(m) for m in _older(msgs, p[4:-1])][:p[-1]]
+
+    def inbox_page(self, sql, p):
+        rows = []
+        for partner, msg in self.conversations[p[0]].items():
+            rows.append({"id": partner, "username": self.users[partner]["username"],
+                         "snippet": msg["content"][:140], "last_message_at": msg["created_at"],
+                         "last_sender_id": msg["sender_id"], "unread_count": 0})
+        rows.sort(key=lambda r: (r["last_message_at"], r["id"]), reverse=True)
+        return _older(rows, p[2:-1], created_key="last_message_at")[:p[-1]]
+
+    def insert_post(self, sql, p):
+        post = {"id": self.next_post_id, "user_id": p[0], "content": p[1],
+                "media_filename": p[2], "created_at": p[3].replace(microsecond=0), "like_count": 0}
+        self.next_post_id += 1
+        self._add_post(post)
+        return 1, post["id"]
+
+    def add_own(self, sql, p):
+        # Follower timelines are filled by a job, which nothing runs here
+        self._timelines.pop(p[0], None)
+        return 1
+
+    def search_posts(self, sql, p):
+        # BOOLEAN MODE "+a +b*": every word, the last as a prefix. Newest
+        # first stands in for relevance.
+        words = [w.strip("+*").lower() for w in p[0].split()]
+        prefix = words.pop()
+        ids = set().union(*(self.posts_by_word[w] for w in self.posts_by_word
+                            if w.startswith(prefix)))
+        for word in words:
+            ids &= self.posts_by_word[word]
+        return [{"id": i} for i in heapq.nlargest(p[2] + p[3], ids)[p[2]:]]
+
+    def users_by_prefix(self, sql, p):
+        prefix = p[0][:-1].replace("\\_", "_").replace("\\%", "%").replace("\\\\", "\\")
+        start = bisect.bisect_left(self.usernames, prefix)
+        names = itertools.takewhile(lambda n: n.startswith(prefix), self.usernames[start:])
+        return [_columns(sql, self.users_by_name[n])[0] for n in itertools.islice(names, p[1])]
+
+    def users_by_bio(self, sql, p):
+        words = [w.strip("+*").lower() for w in p[0].split()]
+        return [_columns(sql, u)[0] for u in self.users.values()
+                if all(w in (u["bio"] or "").lower() for w in words)][:p[2]]
+
+    # ----- dispatch -----
+
+    def execute(self, sql, params):
+        sql = " ".join(sql.split())
+        params = list(params or ())
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.queries += 1
+            for pattern, handler in self.handlers:
+                if pattern.search(sql):
+                    return handler(sql, params)
+        return [] if sql.upper().startswith("SELECT") else 1
+
+
+class Cursor:
+    def __init__(self, standin, dictionary=False, **kwargs):
+        self._standin = standin
+        self._dictionary = dictionary
+        self._rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, sql, params=None, *args, **kwargs):
+        result = self._standin.execute(sql, params)
+        if isinstance(result, list):
+            self._rows = result if self._dictionary else [tuple(r.values()) for r in result]
+            self.rowcount = len(result)
+        else:
+            self._rows = []
+            if isinstance(result, tuple):
+                self.rowcount, self.lastrowid = result
+            else:
+                self.rowcount = result
+
+    def executemany(self, sql, seq_params, *args, **kwargs):
+        for params in seq_params:
+            self.execute(sql, params)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+class Connection:
+    in_transaction = False
+    autocommit = False
+
+    def __init__(self, standin):
+        self._standin = standin
+
+    def cursor(self, *args, **kwargs):
+        return Cursor(self._standin, **kwargs)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        pass
+
+    def reconnect(self, attempts=1, delay=0):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def start_transaction(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+def install(data, latency_ms=0.0):
+    """Route every new MySQL connection in this process to a StandIn.
+    Call before the app is imported. Returns the StandIn."""
+    standin = StandIn(data, latency_ms)
+    mysql.connector.connect = lambda **kwargs: Connection(standin)
+    return standin
@@ -0,0 +1,365 @@
+"""Scripted workload: weighted scenarios replayed through the test client.
+
+Each worker thread has its own client and random generator (seeded, so a
+run issues the same requests every time), acts as a random seeded user
+per request, and times the request from the client side. Statement counts
+come from the app's own instrumentation (g.request_stats).
+"""
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, request_finished
+
+from bench import seed
+
+# Up to this much slower p95 (as a fraction), or this many more statements
+# per request, and a scenario counts as regressed
+DEFAULT_TOLERANCE = 0.2
+QUERY_TOLERANCE = 0.5
+
+_last = threading.local()
+
+# Words seeded posts are made of that are long enough to be indexed
+SEARCH_WORDS = tuple(w for w in seed.WORDS if len(w) >= 3)
+
+
+class Context:
+    """What the scenarios pick from: users, popular posts and accounts,
+    and pairs of users who have a conversation."""
+
+    def __init__(self, users, hot_posts, popular_users, pairs):
+        self.users = users                  # [(id, username)]
+        self.hot_posts = hot_posts          # post ids, most liked first
+        self.popular_users = popular_users  # usernames, most followed first
+        self.pairs = pairs                  # [((id, username), (id, username))]
+
+
+def context_from_dataset(data, top=200):
+    users = [(row[0], row[1]) for row in data["users"]]
+    names = dict(users)
+    like_counts = defaultdict(int)
+    for _, post_id, _ in data["likes"]:
+        like_counts[post_id] += 1
+    followers = defaultdict(int)
+    for _, followee, _ in data["follows"]:
+        followers[followee] += 1
+    pairs = {tuple(sorted((row[1], row[2]))) for row in data["messages"]}
+    return Context(
+        users,
+        sorted(like_counts, key=lambda p: (-like_counts[p], p))[:top],
+        [names[u] for u in sorted(followers, key=lambda u: (-followers[u], u))[:top]],
+        [((a, names[a]), (b, names[b])) for a, b in sorted(pairs)[:top * 10]],
+    )
+
+
+def context_from_db(conn, top=200):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, username FROM users ORDER BY id")
+    users = [tuple(row) for row in cursor.fetchall()]
+    cursor.execute("SELECT id FROM posts ORDER BY like_count DESC, id LIMIT %s", (top,))
+    hot_posts = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT username FROM users ORDER BY follower_count DESC, id LIMIT %s", (top,))
+    popular = [row[0] for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT c.user_id, u1.username, c.partner_id, u2.username
+        FROM conversations c
+        JOIN users u1 ON u1.id = c.user_id
+        JOIN users u2 ON u2.id = c.partner_id
+        WHERE c.user_id < c.partner_id
+        ORDER BY c.user_id, c.partner_id LIMIT %s
+    """, (top * 10,))
+    pairs = [((a, an), (b, bn)) for a, an, b, bn in cursor.fetchall()]
+    cursor.close()
+    return Context(users, hot_posts, popular, pairs)
+
+
+def _tiny_png(rng):
+    from PIL import Image
+    buf = io.BytesIO()
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    Image.new("RGB", (64, 64), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+# ----- scenarios -----
+# Each takes (rng, ctx) and returns the acting user and the request, as
+# request(client, state) -> response. `state` is per thread.
+
+def feed_home(rng, ctx):
+    return rng.choice(ctx.users), lambda client, state: client.get("/feed")
+
+
+def feed_all(rng, ctx):
+    return rng.choice(ctx.users), lambda client, state: client.get("/feed?view=all")
+
+
+def feed_api(rng, ctx):
+    return rng.choice(ctx.users), lambda client, state: client.get("/feed_api?view=all")
+
+
+def like_toggle(rng, ctx):
+    post_id = rng.choice(ctx.hot_posts)
+    return rng.choice(ctx.users), lambda client, state: client.post(f"/like_api/{post_id}")
+
+
+def like_batch(rng, ctx):
+    """What the feed script sends after a burst of taps: a few posts,
+    some toggled more than once."""
+    posts = rng.sample(ctx.hot_posts, min(len(ctx.hot_posts), rng.randint(2, 6)))
+    ops = []
+    for seq in range(1, rng.randint(len(posts), 3 * len(posts)) + 1):
+        post_id = rng.choice(posts)
+        op = rng.choice(("like", "unlike", "save", "unsave"))
+        ops.append({"seq": seq, "op": op, "post_id": post_id})
+    return rng.choice(ctx.users), lambda client, state: client.post("/batch_api", json={"ops": ops})
+
+
+def message_poll(rng, ctx):
+    """A client polling an open conversation: a full page first, then
+    since_id/If-None-Match polls (mostly 304s)."""
+    me, partner = rng.choice(ctx.pairs)
+
+    def call(client, state):
+        known = state.get((me, partner))
+        if known is None:
+            resp = client.get(f"/messages_api/{partner[1]}")
+        else:
+            resp = client.get(f"/messages_api/{partner[1]}?since_id={known[0]}",
+                              headers={"If-None-Match": known[1]})
+        if resp.status_code == 200:
+            state[(me, partner)] = (resp.get_json()["last_id"], resp.headers.get("ETag", ""))
+        return resp
+    return me, call
+
+
+def profile_view(rng, ctx):
+    username = rng.choice(ctx.popular_users)
+    return rng.choice(ctx.users), lambda client, state: client.get(f"/user/{username}")
+
+
+def inbox(rng, ctx):
+    return rng.choice(ctx.pairs)[0], lambda client, state: client.get("/messages")
+
+
+def search(rng, ctx):
+    """Mostly post searches for a word or two, sometimes a username prefix."""
+    if rng.random() < 0.3:
+        username = rng.choice(ctx.users)[1]
+        url = f"/search?type=people&q={username[:rng.randint(1, len(username))]}"
+    else:
+        url = "/search?q=" + "+".join(rng.sample(SEARCH_WORDS, rng.randint(1, 2)))
+    return rng.choice(ctx.users), lambda client, state: client.get(url)
+
+
+def login(rng, ctx):
+    """A login form post. Password hashing dominates; the first login of
+    each seeded user also upgrades its hash (see passwords.py)."""
+    user = rng.choice(ctx.users)
+    form = {"username": user[1], "password": seed.PASSWORD}
+    return user, lambda client, state: client.post("/login", data=form)
+
+
+def upload(rng, ctx):
+    png = _tiny_png(rng)
+
+    def call(client, state):
+        data = {"content": "benchmark upload", "media_file": (io.BytesIO(png), "bench.png")}
+        return client.post("/feed", data=data, content_type="multipart/form-data")
+    return rng.choice(ctx.users), call
+
+
+SCENARIOS = (
+    ("feed_home", 30, feed_home),
+    ("feed_all", 10, feed_all),
+    ("feed_api", 5, feed_api),
+    ("like_toggle", 20, like_toggle),
+    ("like_batch", 5, like_batch),
+    ("message_poll", 20, message_poll),
+    ("profile_view", 10, profile_view),
+    ("inbox", 3, inbox),
+    ("search", 4, search),
+    ("upload", 2, upload),
+)
+
+# Alternative scenario sets for `run --mix`
+MIXES = {
+    "default": SCENARIOS,
+    # Logins competing with feed reads: does hashing starve the feed?
+    "login-storm": (
+        ("feed_home", 50, feed_home),
+        ("login", 50, login),
+    ),
+}
+
+
+# ----- running -----
+
+class Result:
+    def __init__(self):
+        self.latencies = []
+        self.queries = 0
+        self.errors = 0
+
+    def summary(self):
+        lat = sorted(self.latencies)
+        n = len(lat)
+        return {
+            "count": n,
+            "errors": self.errors,
+            "p50_ms": _percentile(lat, 50),
+            "p95_ms": _percentile(lat, 95),
+            "p99_ms": _percentile(lat, 99),
+            "queries": round(self.queries / n, 2) if n else 0,
+        }
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    rank = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return round(sorted_values[rank] * 1000, 2)
+
+
+def _record_queries(sender, response, **extra):
+    stats = g.get("request_stats")
+    _last.queries = stats.queries if stats is not None else 0
+
+
+def _worker(app, ctx, plan, rng, results, warmup, errors):
+    client = app.test_client()
+    state = {}
+    for i, (name, scenario) in enumerate(plan):
+        user, call = scenario(rng, ctx)
+        with client.session_transaction() as sess:
+            sess["user_id"], sess["username"] = user
+
+        _last.queries = 0
+        start = time.perf_counter()
+        try:
+            status = call(client, state).status_code
+        except Exception as e:  # a broken route shouldn't stop the run
+            status = repr(e)
+        elapsed = time.perf_counter() - start
+
+        failed = not isinstance(status, int) or status >= 400
+        if failed and len(errors) < 20:
+            errors.append(f"{name}: {status}")
+        if i < warmup:
+            continue
+        result = results[name]
+        result.latencies.append(elapsed)
+        result.queries += _last.queries
+        result.errors += failed
+
+
+def run(app, ctx, requests=2000, concurrency=4, seed=1, warmup=20, scenarios=SCENARIOS):
+    """Replay `requests` scenario picks (plus `warmup` untimed ones per
+    thread) over `concurrency` threads. Returns the report dict."""
+    if not ctx.hot_posts or not ctx.pairs:
+        scenarios = [s for s in scenarios
+                     if (s[2] not in (like_toggle, like_batch) or ctx.hot_posts)
+                     and (s[2] not in (message_poll, inbox) or ctx.pairs)]
+    names = [name for name, _, _ in scenarios]
+    weights = [weight for _, weight, _ in scenarios]
+    by_name = {name: fn for name, _, fn in scenarios}
+
+    threads, per_thread, errors = [], [], []
+    for t in range(concurrency):
+        rng = random.Random(seed * 1000 + t)
+        n = requests // concurrency + (t < requests % concurrency) + warmup
+        plan = [(name, by_name[name]) for name in rng.choices(names, weights, k=n)]
+        results = defaultdict(Result)
+        per_thread.append(results)
+        threads.append(threading.Thread(
+            target=_worker, args=(app, ctx, plan, rng, results, warmup, errors), daemon=True))
+
+    request_finished.connect(_record_queries, app)
+    started = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        request_finished.disconnect(_record_queries, app)
+    wall = time.perf_counter() - started
+
+    merged = defaultdict(Result)
+    for results in per_thread:
+        for name, result in results.items():
+            merged[name].latencies += result.latencies
+            merged[name].queries += result.queries
+            merged[name].errors += result.errors
+    total = sum(len(r.latencies) for r in merged.values())
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": round(wall, 2),
+        "rps": round(total / wall, 1) if wall else 0,
+        "scenarios": {name: dict(merged[name].summary(),
+                                 rps=round(len(merged[name].latencies) / wall, 1) if wall else 0)
+                      for name in names if name in merged},
+        "sample_errors": errors,
+    }
+
+
+# ----- reporting and baselines -----
+
+def format_report(report, regressions=()):
+    flagged = {name for name, _ in regressions}
+    lines = [f"{'scenario':<14}{'count':>7}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}"
+             f"{'p99 ms':>9}{'q/req':>7}{'req/s':>8}"]
+    for name, s in report["scenarios"].items():
+        lines.append(f"{name:<14}{s['count']:>7}{s['errors']:>5}{s['p50_ms']:>9.2f}"
+                     f"{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}{s['queries']:>7.2f}"
+                     f"{s.get('rps', 0):>8.1f}"
+                     + ("  REGRESSED" if name in flagged else ""))
+    lines.append(f"{report['requests']} requests in {report['seconds']}s "
+                 f"({report['rps']} req/s, concurrency {report['concurrency']})")
+    for error in report["sample_errors"][:5]:
+        lines.append(f"error: {error}")
+    for name, reason in regressions:
+        lines.append(f"regression: {name}: {reason}")
+    return "\n".join(lines)
+
+
+def load_baseline(path, backend):
+    try:
+        with open(path) as f:
+            return json.load(f).get(backend)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, backend, report):
+    try:
+        with open(path) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    baselines[backend] = report
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """[(scenario, reason)] for scenarios that got slower at p95 by more
+    than `tolerance`, or issue more statements per request."""
+    regressions = []
+    for name, s in report["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if not base:
+            continue
+        if base["p95_ms"] and s["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append((name, f"p95 {base['p95_ms']:.2f}ms -> {s['p95_ms']:.2f}ms"))
+        if s["queries"] > base["queries"] + QUERY_TOLERANCE:
+            regressions.append((name, f"queries/request {base['queries']} -> {s['queries']}"))
+    return regressions
@@ -0,0 +1,412 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import mysql.connector
+from flask import g, request, session
+
+log = logging.getLogger(__name__)
+
+# MySQL config from environment variables
+MYSQL_HOST = os.environ.get("MYSQL_HOST", "localhost")
+MYSQL_PORT = int(os.environ.get("MYSQL_PORT", "3306"))
+MYSQL_USER = os.environ.get("MYSQL_USER", "root")
+MYSQL_PASS = os.environ.get("MYSQL_PASS", "password")
+MYSQL_DB   = os.environ.get("MYSQL_DB", "socialdb")
+
+# Pool sizing: connections per worker process, and how long a request may
+# wait for one before giving up.
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "5"))
+MYSQL_POOL_TIMEOUT = float(os.environ.get("MYSQL_POOL_TIMEOUT", "10"))
+# Idle connections older than this are pinged before being handed out.
+# 0 means ping on every checkout.
+MYSQL_POOL_PING_INTERVAL = float(os.environ.get("MYSQL_POOL_PING_INTERVAL", "0"))
+
+# Read replicas ("host[:port],host[:port]"), same user/password/database.
+# Empty means every query goes to MYSQL_HOST.
+MYSQL_REPLICA_HOSTS = os.environ.get("MYSQL_REPLICA_HOSTS", "")
+# Replicas further behind than this many seconds aren't read from
+MYSQL_REPLICA_MAX_LAG = float(os.environ.get("MYSQL_REPLICA_MAX_LAG", "5"))
+# How often each worker re-measures a replica's lag
+MYSQL_REPLICA_CHECK_INTERVAL = float(os.environ.get("MYSQL_REPLICA_CHECK_INTERVAL", "2"))
+# After a user's own write, their reads stay on the primary this long, so
+# they see the write however far behind a replica is (keep it above
+# MYSQL_REPLICA_MAX_LAG)
+MYSQL_STICKY_SECONDS = float(os.environ.get("MYSQL_STICKY_SECONDS", "10"))
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+# Optional callable applied to every new connection (instrumentation.py
+# installs one that times queries).
+connection_wrapper = None
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the pool timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of MySQL connections shared by the threads of one worker.
+
+    Connections are opened lazily up to `size`. A checkout that finds the
+    pool exhausted waits (up to `timeout` seconds) for a connection to be
+    released instead of opening another one, so a burst can never exceed
+    `size` server connections per worker.
+    """
+
+    def __init__(self, size, timeout, ping_interval=0, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.connect_args = connect_args
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, released_at), most recent on the right
+        self._open = 0
+
+        # stats
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._discarded = 0
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.connect_args)
+        return connection_wrapper(conn) if connection_wrapper else conn
+
+    def _healthy(self, conn, released_at):
+        """Make sure an idle connection still works, reconnecting if the
+        server went away (restart, wait_timeout, network blip)."""
+        if self.ping_interval and time.monotonic() - released_at < self.ping_interval:
+            return conn
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except mysql.connector.Error:
+            pass
+        try:
+            conn.reconnect(attempts=2, delay=0.2)
+            with self._cond:
+                self._reconnects += 1
+            return conn
+        except mysql.connector.Error:
+            self._close_quietly(conn)
+            return None
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        """Check out a healthy connection, waiting (up to `timeout`, default
+        the pool's) if the pool is exhausted."""
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.size:
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"no MySQL connection available after {timeout}s "
+                            f"(pool size {self.size})"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                else:
+                    conn, released_at = None, None
+                    self._open += 1  # reserve the slot before connecting
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._open -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                conn = self._healthy(conn, released_at)
+                if conn is None:
+                    # Could not revive it; free the slot and try again.
+                    with self._cond:
+                        self._open -= 1
+                        self._discarded += 1
+                        self._cond.notify()
+                    continue
+
+            elapsed = time.monotonic() - start
+            with self._cond:
+                self._in_use += 1
+                self._checkouts += 1
+                if waited:
+                    self._waits += 1
+                    self._wait_time += elapsed
+                    self._max_wait = max(self._max_wait, elapsed)
+            return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection. Any open transaction is rolled back so the
+        next borrower starts from a clean snapshot."""
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._open -= 1
+                self._discarded += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+        if discard:
+            self._close_quietly(conn)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, deque()
+            self._open -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 6),
+                "wait_time_max": round(self._max_wait, 6),
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "discarded": self._discarded,
+            }
+
+
+class Replica:
+    """A read replica's pool plus its last measured replication lag."""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.lag = None  # seconds behind the primary; None = unknown or broken
+        self.error = None
+        self.checked_at = None
+        self.reads = 0
+        self._checking = False
+        self._lock = threading.Lock()
+
+    def usable(self, max_lag=MYSQL_REPLICA_MAX_LAG, interval=MYSQL_REPLICA_CHECK_INTERVAL):
+        """Whether reads may go here. Re-measures the lag when the last
+        check is older than `interval`; only one thread does that, the
+        others go by the previous result meanwhile."""
+        with self._lock:
+            due = not self._checking and (
+                self.checked_at is None or time.monotonic() - self.checked_at >= interval)
+            if due:
+                self._checking = True
+        if due:
+            self.check()
+        return self.lag is not None and self.lag <= max_lag
+
+    def check(self):
+        lag, error = None, None
+        try:
+            conn = self.pool.acquire(timeout=1)
+        except Exception as e:
+            conn, error = None, repr(e)
+        if conn is not None:
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute("SHOW SLAVE STATUS")
+                row = cursor.fetchone()
+                cursor.close()
+                if row is None:
+                    error = "not a replica (SHOW SLAVE STATUS is empty)"
+                else:
+                    lag = row.get("Seconds_Behind_Master", row.get("Seconds_Behind_Source"))
+                    if lag is None:
+                        error = "replication is not running"
+                self.pool.release(conn)
+            except Exception as e:
+                error = repr(e)
+                self.pool.release(conn, discard=True)
+        if error and error != self.error:
+            log.warning("replica %s not used for reads: %s", self.name, error)
+        self.mark(lag, error)
+
+    def mark(self, lag, error=None):
+        with self._lock:
+            self.lag, self.error = lag, error
+            self.checked_at = time.monotonic()
+            self._checking = False
+
+    def record_read(self):
+        with self._lock:
+            self.reads += 1
+
+    def stats(self):
+        with self._lock:
+            lag, error, reads = self.lag, self.error, self.reads
+        return dict(self.pool.stats(), name=self.name, lag=lag, error=error,
+                    usable=lag is not None and lag <= MYSQL_REPLICA_MAX_LAG, reads=reads)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_replicas = []
+_replicas_pid = None
+
+
+def get_pool():
+    """The pool for this worker process, created on first use.
+
+    Created lazily (and re-created after a fork) so that pre-forking servers
+    never share sockets between worker processes.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(
+                    MYSQL_POOL_SIZE,
+                    MYSQL_POOL_TIMEOUT,
+                    ping_interval=MYSQL_POOL_PING_INTERVAL,
+                    host=MYSQL_HOST,
+                    port=MYSQL_PORT,
+                    user=MYSQL_USER,
+                    password=MYSQL_PASS,
+                    database=MYSQL_DB,
+                )
+                _pool_pid = pid
+    return _pool
+
+
+def parse_hosts(spec, default_port=MYSQL_PORT):
+    """[(host, port)] from "host[:port],host[:port]"."""
+    hosts = []
+    for item in spec.split(","):
+        host, _, port = item.strip().partition(":")
+        if host:
+            hosts.append((host, int(port) if port else default_port))
+    return hosts
+
+
+def get_replicas():
+    """This worker's replicas (see get_pool() about the per-pid pools)."""
+    global _replicas, _replicas_pid
+    pid = os.getpid()
+    if _replicas_pid != pid:
+        with _pool_lock:
+            if _replicas_pid != pid:
+                _replicas = [
+                    Replica(f"{host}:{port}", ConnectionPool(
+                        MYSQL_POOL_SIZE,
+                        MYSQL_POOL_TIMEOUT,
+                        ping_interval=MYSQL_POOL_PING_INTERVAL,
+                        host=host,
+                        port=port,
+                        user=MYSQL_USER,
+                        password=MYSQL_PASS,
+                        database=MYSQL_DB,
+                    ))
+                    for host, port in parse_hosts(MYSQL_REPLICA_HOSTS)
+                ]
+                _replicas_pid = pid
+    return _replicas
+
+
+def pick_replica():
+    """A replica that is up and caught up enough, or None."""
+    usable = [r for r in get_replicas() if r.usable()]
+    return random.choice(usable) if usable else None
+
+
+def get_db():
+    """Connection bound to the current request, checked out on first use.
+    This is the primary: use it for writes and for reads that must see
+    them."""
+    if "db_conn" not in g:
+        g.db_conn = get_pool().acquire()
+    return g.db_conn
+
+
+def _sticky():
+    """Whether this user wrote recently enough that a replica may not
+    have their write yet."""
+    return time.time() < session.get("db_write_at", 0) + MYSQL_STICKY_SECONDS
+
+
+def get_read_db():
+    """Connection for read-only queries: a replica when one is usable,
+    else the primary (get_db()). Nothing written through this connection
+    is allowed; a replica would reject it or, worse, diverge."""
+    if "db_read_conn" in g:
+        return g.db_read_conn
+    if not MYSQL_REPLICA_HOSTS or _sticky():
+        return get_db()
+    replica = pick_replica()
+    if replica is None:
+        return get_db()
+    try:
+        conn = replica.pool.acquire()
+    except Exception as e:
+        # Down or saturated: read from the primary until the next check
+        replica.mark(None, repr(e))
+        return get_db()
+    replica.record_read()
+    g.db_read_conn, g.db_read_replica = conn, replica
+    return conn
+
+
+def close_db(exc=None):
+    """Return the request's connections to their pools (teardown handler)."""
+    discard = isinstance(exc, mysql.connector.Error)
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        get_pool().release(conn, discard=discard)
+    conn = g.pop("db_read_conn", None)
+    if conn is not None:
+        g.pop("db_read_replica").pool.release(conn, discard=discard)
+
+
+def _remember_write(response):
+    """after_request: a non-GET request that used the primary counts as a
+    write, so the user's reads stick to the primary for a while."""
+    if MYSQL_REPLICA_HOSTS and "db_conn" in g and request.method not in SAFE_METHODS:
+        session["db_write_at"] = time.time()
+    return response
+
+
+def pool_stats():
+    return {"primary": get_pool().stats(), "replicas": [r.stats() for r in get_replicas()]}
+
+
+def init_app(app):
+    app.after_request(_remember_write)
+    app.teardown_appcontext(close_db)
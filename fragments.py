@@ -0,0 +1,179 @@
+"""Rendered-HTML cache for the parts of a page that every viewer shares.
+
+A post card is the same for everyone except a few viewer-specific bits
+(liked/saved state, the owner's delete button). Such a template renders
+those bits as overlay markers:
+
+    {{ overlay("like_label") }}                  a value filled in per viewer
+    {{ overlay_if("owner") }}...{{ overlay_end("owner") }}
+                                                 kept only if the value is truthy
+
+The rendered HTML, markers included, is cached under a key built from
+the row fields that can change (a post's like count, its author's
+avatar). An edit gets a new key instead of needing an invalidation, so
+entries are safe to share between workers. A stale entry just ages out.
+Serving a card is then a cache lookup and a join over its segments.
+
+Backends are chosen with FRAGMENT_CACHE_BACKEND ("module:Class"):
+MemoryBackend, an LRU per worker (the default), or RedisBackend, shared
+through FRAGMENT_CACHE_URL (needs the `redis` package).
+"""
+import hashlib
+import importlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+FRAGMENT_CACHE_BACKEND = os.environ.get("FRAGMENT_CACHE_BACKEND", "fragments:MemoryBackend")
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", "20000"))
+# Upper bound on staleness for anything the key doesn't capture (a media
+# variant that appeared after the card was first rendered, say)
+FRAGMENT_CACHE_TTL = int(os.environ.get("FRAGMENT_CACHE_TTL", "300"))
+FRAGMENT_CACHE_URL = os.environ.get("FRAGMENT_CACHE_URL", "redis://localhost:6379/0")
+
+# Markers are HTML comments: autoescaped user text can't contain "<", so
+# a post can't forge one
+_MARKER = re.compile(r"<!--@([?/]?\w+)-->")
+
+
+# ----- backends: get(key) -> str or None, set(key, html) -----
+
+class MemoryBackend:
+    """LRU of rendered fragments, in this worker only."""
+
+    def __init__(self, size=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (html, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, html):
+        with self._lock:
+            self._items[key] = (html, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RedisBackend:
+    """Fragments shared by every worker and replica through Redis."""
+
+    def __init__(self, url=FRAGMENT_CACHE_URL, ttl=FRAGMENT_CACHE_TTL):
+        import redis  # optional dependency, only needed for this backend
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        html = self._redis.get("frag:" + key)
+        return html.decode() if html is not None else None
+
+    def set(self, key, html):
+        self._redis.set("frag:" + key, html.encode(), ex=self.ttl)
+
+
+def load_backend(spec=FRAGMENT_CACHE_BACKEND):
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+# ----- overlay markers -----
+
+def overlay(name):
+    return Markup(f"<!--@{name}-->")
+
+
+def overlay_if(name):
+    return Markup(f"<!--@?{name}-->")
+
+
+def overlay_end(name):
+    return Markup(f"<!--@/{name}-->")
+
+
+OVERLAY_HELPERS = {"overlay": overlay, "overlay_if": overlay_if, "overlay_end": overlay_end}
+
+
+def fill(html, values):
+    """Replace the markers in a cached fragment with `values`."""
+    if "<!--@" not in html:
+        return html
+    parts = _MARKER.split(html)
+    out = []
+    skip = 0  # depth of overlay_if blocks being dropped
+    for i, part in enumerate(parts):
+        if not i % 2:
+            if not skip:
+                out.append(part)
+        elif part[0] == "?":
+            if skip or not values.get(part[1:]):
+                skip += 1
+        elif part[0] == "/":
+            if skip:
+                skip -= 1
+        elif not skip:
+            out.append(str(values[part]))
+    return "".join(out)
+
+
+def content_key(*values):
+    """A short stable digest of `values`, for keys built from content."""
+    return hashlib.sha1(repr(values).encode()).hexdigest()[:16]
+
+
+class FragmentCache:
+    def __init__(self, backend, jinja_env):
+        self.backend = backend
+        self.env = jinja_env
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _template_version(self, name):
+        """Part of every key, so a deploy that changes a template doesn't
+        reuse fragments a shared backend kept from the old one."""
+        version = self._versions.get(name)
+        if version is None:
+            source, _, _ = self.env.loader.get_source(self.env, name)
+            version = self._versions[name] = content_key(source)
+        return version
+
+    def render(self, template_name, key, context, values=None):
+        """`template_name` rendered with `context`, cached under `key` (a
+        tuple of everything the output depends on besides the template),
+        with overlay `values` applied."""
+        full_key = ":".join([template_name, self._template_version(template_name)]
+                            + [str(k) for k in key])
+        html = self.backend.get(full_key)
+        if html is None:
+            with self._lock:
+                self.misses += 1
+            html = self.env.get_template(template_name).render(**OVERLAY_HELPERS, **context)
+            self.backend.set(full_key, html)
+        else:
+            with self._lock:
+                self.hits += 1
+        return Markup(fill(html, values or {}))
+
+    def stats(self):
+        entries = len(self.backend) if hasattr(self.backend, "__len__") else None
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
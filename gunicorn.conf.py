@@ -0,0 +1,38 @@
+"""gunicorn settings, sized from the environment.
+
+Each worker is a process with its own MySQL pool (MYSQL_POOL_SIZE
+connections), so a pod holds up to WEB_CONCURRENCY * MYSQL_POOL_SIZE
+server connections. Threads share their worker's pool: keep
+GUNICORN_THREADS above MYSQL_POOL_SIZE by the number of open message
+streams and static requests a worker should carry, since those hold a
+thread without holding a connection.
+
+Message streams (SSE) are capped per worker at REALTIME_MAX_STREAMS,
+half of GUNICORN_THREADS unless set, so open chat tabs always leave
+threads for other requests. Past the cap the chat page polls. Raise both
+together to carry more streams.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# A message stream (SSE) holds a thread until it ends, after at most
+# REALTIME_STREAM_SECONDS. gthread workers heartbeat independently of
+# request length, so this only catches a worker that stopped responding
+# altogether
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Recycle workers now and then so slow leaks can't accumulate; the jitter
+# keeps them from all restarting at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
@@ -0,0 +1,315 @@
+"""Per-request timing: queries, DB time, template time, response size.
+
+- Every pooled connection is wrapped (db.connection_wrapper) so cursor
+  execute() calls are counted and timed against the current request.
+- Template rendering is timed through Flask's template signals.
+- Per-endpoint totals are kept per worker and served as Prometheus text
+  on /metrics. Each scrape sees one worker; the `pid` label tells them
+  apart.
+- Requests slower than SLOW_REQUEST_MS are logged as one JSON line on
+  the "slow_requests" logger. The line includes the slowest statements
+  and any statement run N_PLUS_ONE_THRESHOLD times or more, the usual
+  sign of a query in a loop.
+- A PROFILE_SAMPLE_RATE fraction of requests runs under cProfile. If one
+  of those turns out slow, its stats are written to PROFILE_DIR.
+"""
+import cProfile
+import heapq
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from flask import before_render_template, g, has_app_context, request, template_rendered
+
+import db
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "500"))
+# Slowest statements kept per request for the slow log
+SLOW_QUERY_KEEP = int(os.environ.get("SLOW_QUERY_KEEP", "5"))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", "10"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Request duration histogram buckets, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+slow_log = logging.getLogger("slow_requests")
+
+
+class RequestStats:
+    """What one request spent, collected in g.request_stats."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.templates = 0
+        self.statement_counts = defaultdict(int)
+        self._slowest = []  # min-heap of (seconds, seq, sql)
+        self._template_started = []
+
+    def record_query(self, sql, seconds):
+        self.queries += 1
+        self.db_time += seconds
+        self.statement_counts[sql] += 1
+        item = (seconds, self.queries, sql)
+        if len(self._slowest) < SLOW_QUERY_KEEP:
+            heapq.heappush(self._slowest, item)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def slowest(self):
+        return [{"ms": round(s * 1000, 2), "sql": sql}
+                for s, _, sql in sorted(self._slowest, reverse=True)]
+
+    def repeated(self):
+        return [{"count": n, "sql": sql}
+                for sql, n in sorted(self.statement_counts.items(), key=lambda kv: -kv[1])
+                if n >= N_PLUS_ONE_THRESHOLD]
+
+
+def _current_stats():
+    return g.get("request_stats") if has_app_context() else None
+
+
+# ----- connection / cursor wrappers -----
+
+class InstrumentedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def _timed(self, method, sql, *args, **kwargs):
+        stats = _current_stats()
+        if stats is None:
+            return method(sql, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(sql, *args, **kwargs)
+        finally:
+            stats.record_query(" ".join(sql.split()), time.perf_counter() - start)
+
+    def execute(self, sql, params=None, *args, **kwargs):
+        return self._timed(self._cursor.execute, sql, params, *args, **kwargs)
+
+    def executemany(self, sql, seq_params, *args, **kwargs):
+        return self._timed(self._cursor.executemany, sql, seq_params, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# ----- per-endpoint totals -----
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)           # (endpoint, method, status)
+        self.duration_buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.duration_sum = defaultdict(float)
+        self.duration_count = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.db_queries = defaultdict(int)
+        self.template_seconds = defaultdict(float)
+        self.response_bytes = defaultdict(int)
+        self.slow_requests = defaultdict(int)
+
+    def observe(self, endpoint, method, status, seconds, stats, size, slow):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            buckets = self.duration_buckets[endpoint]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            self.duration_sum[endpoint] += seconds
+            self.duration_count[endpoint] += 1
+            self.db_seconds[endpoint] += stats.db_time
+            self.db_queries[endpoint] += stats.queries
+            self.template_seconds[endpoint] += stats.template_time
+            self.response_bytes[endpoint] += size or 0
+            if slow:
+                self.slow_requests[endpoint] += 1
+
+    def render(self, extra_gauges=()):
+        pid = os.getpid()
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def sample(name, labels, value):
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in (("pid", pid),) + labels)
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+        with self._lock:
+            header("app_requests_total", "counter", "Requests handled.")
+            for (endpoint, method, status), n in sorted(self.requests.items()):
+                sample("app_requests_total",
+                       (("endpoint", endpoint), ("method", method), ("status", status)), n)
+
+            header("app_request_duration_seconds", "histogram", "Time to produce the response.")
+            for endpoint in sorted(self.duration_count):
+                labels = (("endpoint", endpoint),)
+                for bound, n in zip(BUCKETS, self.duration_buckets[endpoint]):
+                    sample("app_request_duration_seconds_bucket", labels + (("le", bound),), n)
+                sample("app_request_duration_seconds_bucket", labels + (("le", "+Inf"),),
+                       self.duration_count[endpoint])
+                sample("app_request_duration_seconds_sum", labels, self.duration_sum[endpoint])
+                sample("app_request_duration_seconds_count", labels, self.duration_count[endpoint])
+
+            for name, help_text, values in (
+                ("app_db_queries_total", "SQL statements executed.", self.db_queries),
+                ("app_db_seconds_total", "Time spent in SQL statements.", self.db_seconds),
+                ("app_template_seconds_total", "Time spent rendering templates.", self.template_seconds),
+                ("app_response_bytes_total", "Response body bytes (streamed bodies not counted).",
+                 self.response_bytes),
+                ("app_slow_requests_total", f"Requests slower than {SLOW_REQUEST_MS:g}ms.",
+                 self.slow_requests),
+            ):
+                header(name, "counter", help_text)
+                for endpoint, value in sorted(values.items()):
+                    sample(name, (("endpoint", endpoint),), value)
+
+        previous = None
+        for name, help_text, value, *labels in extra_gauges:
+            if name != previous:
+                header(name, "gauge", help_text)
+                previous = name
+            sample(name, tuple(labels[0].items()) if labels else (), value)
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+
+# ----- request lifecycle -----
+
+_profile_lock = threading.Lock()
+
+
+def _before_request():
+    g.request_stats = RequestStats()
+    # One profiled request at a time: a thread can't share cProfile
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler is active (3.12+)
+            _profile_lock.release()
+        else:
+            g.profiler = profiler
+
+
+def _stop_profiler():
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+    return profiler
+
+
+def _after_request(response):
+    stats = g.get("request_stats")
+    if stats is None:
+        return response
+    profiler = _stop_profiler()
+    seconds = time.perf_counter() - stats.started
+    endpoint = request.endpoint or "unmatched"
+    size = None if response.is_streamed else response.calculate_content_length()
+    slow = seconds * 1000 >= SLOW_REQUEST_MS
+
+    metrics.observe(endpoint, request.method, response.status_code, seconds, stats, size, slow)
+    response.headers["Server-Timing"] = (
+        f"db;dur={stats.db_time * 1000:.1f}, tpl;dur={stats.template_time * 1000:.1f}, "
+        f"total;dur={seconds * 1000:.1f}"
+    )
+
+    if slow:
+        entry = {
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code,
+            "ms": round(seconds * 1000, 1),
+            "db_ms": round(stats.db_time * 1000, 1),
+            "queries": stats.queries,
+            "template_ms": round(stats.template_time * 1000, 1),
+            "bytes": size,
+            "slowest": stats.slowest(),
+            "repeated": stats.repeated(),
+        }
+        if profiler is not None:
+            entry["profile"] = _dump_profile(profiler, endpoint)
+        slow_log.warning(json.dumps(entry, default=str))
+    return response
+
+
+def _teardown_request(exc=None):
+    # after_request doesn't run when a view raises
+    _stop_profiler()
+
+
+def _dump_profile(profiler, endpoint):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", endpoint)
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{safe}.prof")
+    profiler.dump_stats(path)
+    return path
+
+
+def _template_started(sender, template, context, **extra):
+    stats = _current_stats()
+    if stats is not None:
+        stats._template_started.append(time.perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):
+    stats = _current_stats()
+    if stats is not None and stats._template_started:
+        # A render_template() nested in another is timed by the outer one
+        started = stats._template_started.pop()
+        if not stats._template_started:
+            stats.template_time += time.perf_counter() - started
+        stats.templates += 1
+
+
+def init_app(app, extra_gauges=None):
+    """Install the hooks. `extra_gauges` is a callable returning
+    (name, help, value) or (name, help, value, labels) tuples added to
+    /metrics; samples of one gauge must be adjacent."""
+    db.connection_wrapper = InstrumentedConnection
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+    def metrics_view():
+        gauges = extra_gauges() if extra_gauges else ()
+        return metrics.render(gauges), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,154 @@
+"""Likes and saves applied in batches.
+
+The feed script queues taps and sends them together to /batch_api as
+[{"seq": n, "op": "like" | "unlike" | "save" | "unsave", "post_id": id}].
+Every op sets a state rather than toggling it, so only the last op per
+(post, like/save) matters. collapse() keeps those, and apply() writes
+them with a handful of multi-row statements in one transaction.
+
+The locking reads in that transaction take gap locks on rows that don't
+exist yet, so two batches for nearby (user, post) keys can deadlock on
+the inserts that follow. InnoDB then rolls one of them back whole, and
+apply_batch() runs it again.
+"""
+import os
+import random
+import time
+
+import mysql.connector
+
+# Ops accepted in one batch (the script sends far fewer)
+BATCH_MAX_OPS = int(os.environ.get("BATCH_MAX_OPS", "200"))
+# Times a batch is run before a deadlock is passed on
+BATCH_ATTEMPTS = int(os.environ.get("BATCH_ATTEMPTS", "3"))
+
+ER_LOCK_DEADLOCK = 1213
+
+# op -> (kind, desired state)
+OPS = {"like": ("like", True), "unlike": ("like", False),
+       "save": ("save", True), "unsave": ("save", False)}
+
+
+class InvalidBatch(ValueError):
+    pass
+
+
+def parse_ops(body):
+    """[(seq, kind, post_id, state)] from a request body, or InvalidBatch."""
+    ops = body.get("ops") if isinstance(body, dict) else None
+    if not isinstance(ops, list):
+        raise InvalidBatch("expected {\"ops\": [...]}")
+    if len(ops) > BATCH_MAX_OPS:
+        raise InvalidBatch(f"at most {BATCH_MAX_OPS} ops per batch")
+    parsed = []
+    for op in ops:
+        try:
+            kind, state = OPS[op["op"]]
+            seq, post_id = op["seq"], op["post_id"]
+        except (TypeError, KeyError):
+            raise InvalidBatch(f"bad op: {op!r}") from None
+        if type(seq) is not int or type(post_id) is not int:
+            raise InvalidBatch(f"seq and post_id must be integers: {op!r}")
+        parsed.append((seq, kind, post_id, state))
+    return parsed
+
+
+def collapse(ops):
+    """{(kind, post_id): (seq, state)} keeping the highest-seq op of each."""
+    final = {}
+    for seq, kind, post_id, state in ops:
+        key = (kind, post_id)
+        if key not in final or seq > final[key][0]:
+            final[key] = (seq, state)
+    return final
+
+
+def _in(ids):
+    return ", ".join(["%s"] * len(ids))
+
+
+def _current(cursor, table, user_id, post_ids):
+    """Which of `post_ids` the user has a row for in `table`, locked until
+    commit so a concurrent request can't change them under the deltas."""
+    if not post_ids:
+        return set()
+    cursor.execute(f"""
+        SELECT post_id FROM {table}
+        WHERE user_id=%s AND post_id IN ({_in(post_ids)})
+        FOR UPDATE
+    """, [user_id] + post_ids)
+    return {row["post_id"] for row in cursor.fetchall()}
+
+
+def _set_rows(cursor, table, user_id, add, remove):
+    if add:
+        cursor.execute(
+            f"INSERT IGNORE INTO {table} (post_id, user_id) VALUES "
+            + ", ".join(["(%s, %s)"] * len(add)),
+            [v for post_id in add for v in (post_id, user_id)])
+    if remove:
+        cursor.execute(f"DELETE FROM {table} WHERE user_id=%s AND post_id IN ({_in(remove)})",
+                       [user_id] + remove)
+
+
+def apply(cursor, user_id, final):
+    """Write the collapsed ops in `final` for `user_id`. The caller commits.
+
+    Returns {post_id: {"seq", "like_count", and "liked" and/or "saved"}},
+    the state after the batch, for the posts that exist. `seq` is the
+    highest op seq applied to that post.
+    """
+    post_ids = sorted({post_id for _, post_id in final})
+    if not post_ids:
+        return {}
+    cursor.execute(f"SELECT id FROM posts WHERE id IN ({_in(post_ids)})", post_ids)
+    existing = {row["id"] for row in cursor.fetchall()}
+
+    deltas = {}
+    for kind, table in (("like", "likes"), ("save", "saved_posts")):
+        wanted = {post_id: state for (k, post_id), (_, state) in final.items()
+                  if k == kind and post_id in existing}
+        have = _current(cursor, table, user_id, sorted(wanted))
+        add = sorted(p for p, state in wanted.items() if state and p not in have)
+        remove = sorted(p for p, state in wanted.items() if not state and p in have)
+        _set_rows(cursor, table, user_id, add, remove)
+        if kind == "like":
+            deltas.update({p: 1 for p in add})
+            deltas.update({p: -1 for p in remove})
+
+    if deltas:
+        ids = sorted(deltas)
+        cursor.execute(f"""
+            UPDATE posts
+            SET like_count = like_count + CASE id {" ".join(["WHEN %s THEN %s"] * len(ids))} END
+            WHERE id IN ({_in(ids)})
+        """, [v for post_id in ids for v in (post_id, deltas[post_id])] + ids)
+
+    ids = sorted(existing)
+    cursor.execute(f"SELECT id, like_count FROM posts WHERE id IN ({_in(ids)})", ids)
+    results = {row["id"]: {"seq": 0, "like_count": row["like_count"]}
+               for row in cursor.fetchall()}
+    for (kind, post_id), (seq, state) in final.items():
+        result = results.get(post_id)
+        if result is not None:
+            result["liked" if kind == "like" else "saved"] = state
+            result["seq"] = max(result["seq"], seq)
+    return results
+
+
+def apply_batch(conn, user_id, final, attempts=BATCH_ATTEMPTS):
+    """apply() in its own transaction and commit, run again (after a short
+    jittered pause) if InnoDB picks it as a deadlock victim."""
+    for attempt in range(1, attempts + 1):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            results = apply(cursor, user_id, final)
+            conn.commit()
+            return results
+        except mysql.connector.Error as e:
+            conn.rollback()
+            if e.errno != ER_LOCK_DEADLOCK or attempt == attempts:
+                raise
+        finally:
+            cursor.close()
+        time.sleep(random.uniform(0, 0.01 * attempt))
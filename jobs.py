@@ -0,0 +1,335 @@
+"""Background jobs: a durable queue in the `jobs` table.
+
+Request handlers enqueue() with their own cursor, so a job is committed
+(or rolled back) together with the change that asked for it, and return.
+A worker process (`flask --app app jobs-worker`) claims due jobs, runs
+their handlers on a thread pool and deletes each job in the handler's
+transaction, so a job's database effects and its completion commit
+together.
+
+Claiming uses SELECT ... FOR UPDATE SKIP LOCKED on MySQL 8, so workers
+never wait on each other's rows. MySQL 5.7 has no SKIP LOCKED. There, a
+worker claims with a single UPDATE ... ORDER BY ... LIMIT stamped with
+a unique token, then reads back what it got.
+
+A failed job is retried with exponential backoff (JOB_RETRY_BASE doubling
+up to JOB_RETRY_MAX, jittered) until max_attempts, then kept as
+'failed' for JOB_FAILED_RETENTION_DAYS for inspection (`flask
+jobs-status`). A claimed job holds a lease of JOB_LEASE seconds. If its
+worker dies, the job is requeued once the lease runs out. Handlers must
+therefore tolerate running more than once.
+"""
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+JOB_WORKER_THREADS = int(os.environ.get("JOB_WORKER_THREADS", "4"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "0.5"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE = float(os.environ.get("JOB_RETRY_BASE", "5"))
+JOB_RETRY_MAX = float(os.environ.get("JOB_RETRY_MAX", "600"))
+JOB_LEASE = int(os.environ.get("JOB_LEASE", "300"))
+JOB_FAILED_RETENTION_DAYS = int(os.environ.get("JOB_FAILED_RETENTION_DAYS", "7"))
+
+log = logging.getLogger(__name__)
+
+# kind -> handler(conn, payload)
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the function that runs jobs of `kind`. It gets a pooled
+    connection (committed by the worker afterwards) and the payload."""
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(cursor, kind, payload=None, delay=0, max_attempts=JOB_MAX_ATTEMPTS):
+    """Queue a job in the caller's transaction; it runs after the commit."""
+    now = datetime.now()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, status, attempts, max_attempts, run_at, created_at)
+        VALUES (%s, %s, 'queued', 0, %s, %s, %s)
+    """, (kind, json.dumps(payload or {}), max_attempts, now + timedelta(seconds=delay), now))
+    return cursor.lastrowid
+
+
+def retry_delay(attempts):
+    """Seconds before retry number `attempts` (1-based), jittered +-20%."""
+    delay = min(JOB_RETRY_MAX, JOB_RETRY_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _supports_skip_locked(conn):
+    try:
+        return tuple(conn.get_server_version()) >= (8, 0, 1)
+    except Exception:
+        return False
+
+
+def claim(conn, worker_id, limit, skip_locked=None):
+    """Mark up to `limit` due jobs as running for this worker and return
+    them as dicts (id, kind, payload, attempts, max_attempts, token)."""
+    if skip_locked is None:
+        skip_locked = _supports_skip_locked(conn)
+    now = datetime.now()
+    token = f"{worker_id}:{uuid.uuid4().hex[:12]}"
+    lease = now + timedelta(seconds=JOB_LEASE)
+    cursor = conn.cursor(dictionary=True)
+    try:
+        if skip_locked:
+            cursor.execute("""
+                SELECT id FROM jobs
+                WHERE status = 'queued' AND run_at <= %s
+                ORDER BY run_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (now, limit))
+            ids = [row["id"] for row in cursor.fetchall()]
+            if not ids:
+                conn.commit()
+                return []
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(f"""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                                locked_by = %s, locked_until = %s
+                WHERE id IN ({placeholders})
+            """, [token, lease] + ids)
+        else:
+            cursor.execute("""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                                locked_by = %s, locked_until = %s
+                WHERE status = 'queued' AND run_at <= %s
+                ORDER BY run_at, id
+                LIMIT %s
+            """, (token, lease, now, limit))
+            if not cursor.rowcount:
+                conn.commit()
+                return []
+        cursor.execute("""
+            SELECT id, kind, payload, attempts, max_attempts FROM jobs
+            WHERE locked_by = %s AND status = 'running'
+        """, (token,))
+        jobs = cursor.fetchall()
+        conn.commit()
+    finally:
+        cursor.close()
+    for job in jobs:
+        job["payload"] = json.loads(job["payload"])
+        job["token"] = token
+    return jobs
+
+
+def complete(conn, job):
+    """Delete a finished job and commit (with whatever the handler did)."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM jobs WHERE id = %s AND locked_by = %s", (job["id"], job["token"]))
+    conn.commit()
+    cursor.close()
+
+
+def fail(conn, job, error):
+    """Schedule a retry, or give up after max_attempts. Returns whether it
+    will be retried."""
+    retry = job["attempts"] < job["max_attempts"]
+    cursor = conn.cursor()
+    if retry:
+        cursor.execute("""
+            UPDATE jobs SET status = 'queued', run_at = %s, locked_by = NULL,
+                            locked_until = NULL, last_error = %s
+            WHERE id = %s AND locked_by = %s
+        """, (datetime.now() + timedelta(seconds=retry_delay(job["attempts"])), error[:2000],
+              job["id"], job["token"]))
+    else:
+        cursor.execute("""
+            UPDATE jobs SET status = 'failed', locked_by = NULL, locked_until = NULL,
+                            last_error = %s
+            WHERE id = %s AND locked_by = %s
+        """, (error[:2000], job["id"], job["token"]))
+    conn.commit()
+    cursor.close()
+    return retry
+
+
+def requeue_expired(conn):
+    """Give jobs whose worker died (lease expired) back to the queue, or
+    fail them if that was their last attempt. Returns how many."""
+    now = datetime.now()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE jobs SET status = IF(attempts < max_attempts, 'queued', 'failed'),
+                        locked_by = NULL, locked_until = NULL,
+                        last_error = 'lease expired'
+        WHERE status = 'running' AND locked_until < %s
+    """, (now,))
+    count = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return count
+
+
+def prune_failed(conn, older_than_days=JOB_FAILED_RETENTION_DAYS):
+    """Delete failed jobs last touched more than `older_than_days` ago."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM jobs WHERE status = 'failed' AND run_at < %s LIMIT 1000",
+                   (datetime.now() - timedelta(days=older_than_days),))
+    count = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return count
+
+
+def queue_stats(conn):
+    """{status: count} plus the age in seconds of the oldest due job."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+    stats = {"queued": 0, "running": 0, "failed": 0}
+    stats.update({status: count for status, count in cursor.fetchall()})
+    cursor.execute("SELECT MIN(run_at) FROM jobs WHERE status = 'queued' AND run_at <= %s",
+                   (datetime.now(),))
+    oldest = cursor.fetchone()[0]
+    cursor.close()
+    stats["oldest_due_seconds"] = (datetime.now() - oldest).total_seconds() if oldest else 0
+    return stats
+
+
+class Worker:
+    """Claims jobs and runs them on a thread pool until stopped."""
+
+    REQUEUE_INTERVAL = 30
+
+    def __init__(self, get_pool, threads=JOB_WORKER_THREADS, poll_interval=JOB_POLL_INTERVAL):
+        self.get_pool = get_pool
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+        self._slots = threading.Semaphore(threads)
+        self._last_requeue = 0.0
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+
+    def run(self):
+        with ThreadPoolExecutor(self.threads, thread_name_prefix="job") as pool:
+            while not self.stopping.is_set():
+                try:
+                    claimed = self._claim_and_submit(pool)
+                except Exception:
+                    log.exception("claiming jobs failed")
+                    claimed = 0
+                if claimed == 0:
+                    self.stopping.wait(self.poll_interval)
+        # leaving the with-block waits for running jobs
+        log.info("job worker %s stopped (%d done, %d retried, %d failed)",
+                 self.worker_id, self.done, self.retried, self.failed)
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def _claim_and_submit(self, pool):
+        """Claim jobs for the free threads. Returns how many were claimed,
+        or None if no thread was free."""
+        # Only claim what there are free threads for: a claimed job holds
+        # its lease, and sitting in our backlog it helps nobody
+        if not self._slots.acquire(timeout=self.poll_interval):
+            return None  # all busy; the wait was the poll interval
+        free = 1
+        while free < self.threads and self._slots.acquire(blocking=False):
+            free += 1
+
+        db = self.get_pool()
+        conn = db.acquire()
+        try:
+            if time.monotonic() - self._last_requeue > self.REQUEUE_INTERVAL:
+                self._last_requeue = time.monotonic()
+                requeued = requeue_expired(conn)
+                if requeued:
+                    log.warning("requeued %d job(s) with expired leases", requeued)
+                prune_failed(conn)
+            jobs = claim(conn, self.worker_id, free)
+        except Exception:
+            for _ in range(free):
+                self._slots.release()
+            raise
+        finally:
+            db.release(conn)
+
+        for _ in range(free - len(jobs)):
+            self._slots.release()
+        for job in jobs:
+            pool.submit(self._execute, job)
+        return len(jobs)
+
+    def _execute(self, job):
+        db = self.get_pool()
+        conn = db.acquire()
+        try:
+            fn = HANDLERS.get(job["kind"])
+            try:
+                if fn is None:
+                    raise LookupError(f"no handler for job kind {job['kind']!r}")
+                fn(conn, job["payload"])
+                complete(conn, job)
+                self.done += 1
+            except Exception as e:
+                log.exception("job %s (%s) attempt %d failed", job["id"], job["kind"], job["attempts"])
+                conn.rollback()
+                if fail(conn, job, f"{type(e).__name__}: {e}"):
+                    self.retried += 1
+                else:
+                    self.failed += 1
+        except Exception:
+            log.exception("job %s: could not record the outcome", job["id"])
+        finally:
+            db.release(conn)
+            self._slots.release()
+
+
+def run_worker(get_pool, threads=JOB_WORKER_THREADS):
+    """Run a Worker in this process until SIGTERM/SIGINT."""
+    worker = Worker(get_pool, threads)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    log.info("job worker %s: %d thread(s)", worker.worker_id, threads)
+    worker.run()
+
+
+def run_workers(get_pool, processes=1, threads=JOB_WORKER_THREADS):
+    """run_worker() in `processes` forked children (or in this process if
+    1). SIGTERM/SIGINT stop them all; returns when every child has."""
+    if processes <= 1:
+        run_worker(get_pool, threads)
+        return
+    import multiprocessing
+    children = [multiprocessing.Process(target=run_worker, args=(get_pool, threads),
+                                        name=f"jobs-worker-{i}") for i in range(processes)]
+    for child in children:
+        child.start()
+
+    def forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for child in children:
+        child.join()
+
+
+def start_worker_thread(get_pool, threads=JOB_WORKER_THREADS):
+    """Run a Worker on a daemon thread (the dev server's stand-in for the
+    worker process)."""
+    worker = Worker(get_pool, threads)
+    threading.Thread(target=worker.run, name="jobs-worker", daemon=True).start()
+    return worker
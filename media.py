@@ -0,0 +1,152 @@
+"""Resized, recompressed variants of uploaded images.
+
+Each uploaded image gets a set of WebP derivatives, written next to the
+uploads under variants/<original name>/:
+
+- avatar: square crops for profile pictures
+- story:  square crops for the story bubbles
+- feed:   width-bounded copies for post media, tiles and the story viewer
+
+EXIF (including GPS) is dropped; orientation is applied first so photos
+stay upright. Widths larger than the original are skipped rather than
+upscaled. A manifest.json per original lists what was produced, and the
+template helpers build src/srcset from it, falling back to the original
+file when an image hasn't been processed (yet).
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+from PIL import Image, ImageOps
+
+MEDIA_WEBP_QUALITY = int(os.environ.get("MEDIA_WEBP_QUALITY", "80"))
+
+VARIANTS_DIR = "variants"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}  # GIFs are left alone to keep animation
+
+# kind -> (widths, square crop?, default width for src=)
+VARIANT_KINDS = {
+    "avatar": ((48, 96, 160, 320), True, 96),
+    "story": ((64, 128), True, 128),
+    "feed": ((320, 640, 960, 1400), False, 640),
+}
+
+log = logging.getLogger(__name__)
+
+
+def is_image(filename):
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+def variant_dir(upload_folder, filename):
+    return os.path.join(upload_folder, VARIANTS_DIR, filename)
+
+
+def _variant_name(kind, width):
+    return f"{kind}-{width}.webp"
+
+
+def make_variants(upload_folder, filename, force=False):
+    """Write every variant of one upload. Returns the manifest, or None for
+    files that aren't processable images."""
+    if not is_image(filename):
+        return None
+    out_dir = variant_dir(upload_folder, filename)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    with Image.open(os.path.join(upload_folder, filename)) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() or im.mode == "P" else "RGB")
+        icc = im.info.get("icc_profile")
+
+        os.makedirs(out_dir, exist_ok=True)
+        manifest = {}
+        for kind, (widths, square, _) in VARIANT_KINDS.items():
+            limit = min(im.size) if square else im.width
+            made = [w for w in widths if w <= limit] or [limit]
+            for w in made:
+                if square:
+                    resized = ImageOps.fit(im, (w, w), Image.LANCZOS)
+                else:
+                    resized = im.resize((w, max(1, round(im.height * w / im.width))), Image.LANCZOS)
+                # No exif= argument: metadata is not carried over
+                resized.save(os.path.join(out_dir, _variant_name(kind, w)), "WEBP",
+                             quality=MEDIA_WEBP_QUALITY, method=6, icc_profile=icc)
+            manifest[kind] = made
+
+    # Manifest last: its presence means the set is complete
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_path)
+    _manifests.pop((upload_folder, filename), None)
+    return manifest
+
+
+def process_upload(upload_folder, filename):
+    """make_variants() for a fresh upload; a broken image must not fail the
+    request, the original is still served."""
+    try:
+        make_variants(upload_folder, filename)
+    except Exception:
+        log.exception("could not make variants for %s", filename)
+
+
+def delete_variants(upload_folder, filename):
+    shutil.rmtree(variant_dir(upload_folder, filename), ignore_errors=True)
+    _manifests.pop((upload_folder, filename), None)
+
+
+def iter_uploads(upload_folder):
+    """Relative paths of every original under the upload folder."""
+    for root, dirs, files in os.walk(upload_folder):
+        if root == upload_folder:
+            # variants, and dot-folders such as storage's .tmp
+            dirs[:] = [d for d in dirs if d != VARIANTS_DIR and not d.startswith(".")]
+        for name in files:
+            yield os.path.relpath(os.path.join(root, name), upload_folder).replace(os.sep, "/")
+
+
+# ----- template helpers -----
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def load_manifest(upload_folder, filename):
+    """Cached manifest for an upload, or None if it has no variants yet
+    (misses aren't cached, so newly processed files show up)."""
+    key = (upload_folder, filename)
+    manifest = _manifests.get(key)
+    if manifest is not None:
+        return manifest
+    try:
+        with open(os.path.join(variant_dir(upload_folder, filename), "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    with _manifests_lock:
+        if len(_manifests) > 10000:
+            _manifests.clear()
+        _manifests[key] = manifest
+    return manifest
+
+
+def variant_path(filename, kind, width):
+    """Path of a variant relative to the upload folder."""
+    return f"{VARIANTS_DIR}/{filename}/{_variant_name(kind, width)}"
+
+
+def pick_width(manifest, kind):
+    widths = manifest.get(kind) or []
+    if not widths:
+        return None
+    default = VARIANT_KINDS[kind][2]
+    fitting = [w for w in widths if w >= default]
+    return fitting[0] if fitting else widths[-1]
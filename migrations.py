@@ -0,0 +1,635 @@
+"""Versioned schema migrations.
+
+init_db() creates the baseline tables; everything after that is a numbered
+migration below. Applied versions are recorded in `schema_migrations`, so
+each one runs exactly once per database. Migrations should be idempotent
+on their own as well, because MySQL DDL is not transactional and a
+migration interrupted half-way will be re-run from the top.
+"""
+import mysql.connector
+
+import timelines
+
+# Secondary index builds that don't block concurrent reads/writes (InnoDB
+# online DDL). MySQL refuses the statement rather than silently locking
+# the table if it can't honour this.
+ONLINE_DDL = "ALGORITHM=INPLACE, LOCK=NONE"
+
+# Length of the last-message preview kept in `conversations`
+SNIPPET_LENGTH = 140
+
+
+def _index_exists(cursor, table, index_name):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name=%s AND index_name=%s
+        LIMIT 1
+    """, (table, index_name))
+    return cursor.fetchone() is not None
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name=%s AND column_name=%s
+        LIMIT 1
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+
+def add_column(cursor, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN online, unless it already exists."""
+    if _column_exists(cursor, table, column):
+        return
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}, {ONLINE_DDL}")
+
+
+def add_index(cursor, table, index_name, columns, unique=False):
+    """ALTER TABLE ... ADD [UNIQUE] INDEX online, unless it already exists."""
+    if _index_exists(cursor, table, index_name):
+        return
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    cursor.execute(
+        f"ALTER TABLE {table} ADD {kind} {index_name} ({', '.join(columns)}), {ONLINE_DDL}"
+    )
+
+
+def add_fulltext_index(cursor, table, index_name, columns):
+    """ALTER TABLE ... ADD FULLTEXT INDEX, unless it already exists.
+
+    InnoDB can't build a FULLTEXT index with LOCK=NONE: reads continue,
+    but writes to the table wait until the build is done. The first one
+    on a table also rebuilds it to add the hidden FTS_DOC_ID column.
+    """
+    if _index_exists(cursor, table, index_name):
+        return
+    cursor.execute(
+        f"ALTER TABLE {table} ADD FULLTEXT INDEX {index_name} ({', '.join(columns)}), "
+        "ALGORITHM=INPLACE, LOCK=SHARED"
+    )
+
+
+def drop_index(cursor, table, index_name):
+    """ALTER TABLE ... DROP INDEX online, if it exists."""
+    if not _index_exists(cursor, table, index_name):
+        return
+    cursor.execute(f"ALTER TABLE {table} DROP INDEX {index_name}, {ONLINE_DDL}")
+
+
+def dedupe(conn, table, columns, batch_size=1000, log=None):
+    """Delete duplicate rows on `columns`, keeping the lowest id.
+
+    Needs an index on `columns`. Works through ranges of `batch_size`
+    values of the first column, committing after each, so every DELETE
+    reads and locks one slice of that index rather than the whole table.
+    Returns the number of rows deleted.
+    """
+    first = columns[0]
+    keys = ", ".join(columns)
+    match = " AND ".join(f"t.{c} = d.{c}" for c in columns)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT COALESCE(MIN({first}), 0), COALESCE(MAX({first}), 0) FROM {table}")
+    lo, hi = cursor.fetchone()
+    deleted = 0
+    start = lo
+    while start and start <= hi:
+        end = start + batch_size - 1
+        # The grouped derived table is materialized first, which is what
+        # lets a DELETE read the table it deletes from
+        cursor.execute(f"""
+            DELETE t FROM {table} t
+            JOIN (
+                SELECT {keys}, MIN(id) AS keep_id
+                FROM {table}
+                WHERE {first} BETWEEN %s AND %s
+                GROUP BY {keys}
+                HAVING COUNT(*) > 1
+            ) d ON {match} AND t.id > d.keep_id
+        """, (start, end))
+        deleted += cursor.rowcount
+        conn.commit()
+        if log and cursor.rowcount:
+            log(f"{table} {first} {start}-{end}: {cursor.rowcount} duplicate(s) deleted")
+        start = end + 1
+    cursor.close()
+    return deleted
+
+
+def reconcile_like_counts(conn, batch_size=1000, log=None):
+    """Recompute posts.like_count from the likes table.
+
+    Works through posts in id ranges of `batch_size`, committing after each
+    range so row locks are held only briefly. Returns the number of posts
+    whose counter was wrong.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM posts")
+    lo, hi = cursor.fetchone()
+    fixed = 0
+    start = lo
+    while start and start <= hi:
+        end = start + batch_size - 1
+        cursor.execute("""
+            UPDATE posts p
+            LEFT JOIN (
+                SELECT post_id, COUNT(*) AS c
+                FROM likes
+                WHERE post_id BETWEEN %s AND %s
+                GROUP BY post_id
+            ) l ON l.post_id = p.id
+            SET p.like_count = COALESCE(l.c, 0)
+            WHERE p.id BETWEEN %s AND %s
+        """, (start, end, start, end))
+        fixed += cursor.rowcount
+        conn.commit()
+        if log:
+            log(f"posts {start}-{end}: {cursor.rowcount} counter(s) corrected")
+        start = end + 1
+    cursor.close()
+    return fixed
+
+
+def backfill_conversations(conn, batch_size=1000, log=None):
+    """Rebuild the conversations summary from the messages table.
+
+    Processes users in id ranges of `batch_size`, committing after each.
+    Unread counts are left as they are (there is no read state to recover).
+    Returns the number of conversation rows written.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM users")
+    lo, hi = cursor.fetchone()
+    written = 0
+    start = lo
+    while start and start <= hi:
+        end = start + batch_size - 1
+        cursor.execute("""
+            INSERT INTO conversations
+                (user_id, partner_id, last_message_id, last_message_at,
+                 last_sender_id, snippet, unread_count)
+            SELECT t.user_id, t.partner_id, m.id, m.created_at,
+                   m.sender_id, LEFT(m.content, %s), 0
+            FROM (
+                SELECT user_id, partner_id, MAX(last_id) AS last_id
+                FROM (
+                    SELECT sender_id AS user_id, recipient_id AS partner_id, MAX(id) AS last_id
+                    FROM messages
+                    WHERE sender_id BETWEEN %s AND %s
+                    GROUP BY sender_id, recipient_id
+                    UNION ALL
+                    SELECT recipient_id, sender_id, MAX(id)
+                    FROM messages
+                    WHERE recipient_id BETWEEN %s AND %s
+                    GROUP BY recipient_id, sender_id
+                ) both_directions
+                GROUP BY user_id, partner_id
+            ) t
+            JOIN messages m ON m.id = t.last_id
+            ON DUPLICATE KEY UPDATE
+                last_message_id = VALUES(last_message_id),
+                last_message_at = VALUES(last_message_at),
+                last_sender_id = VALUES(last_sender_id),
+                snippet = VALUES(snippet)
+        """, (SNIPPET_LENGTH, start, end, start, end))
+        written += cursor.rowcount
+        conn.commit()
+        if log:
+            log(f"users {start}-{end}: {cursor.rowcount} row(s) written")
+        start = end + 1
+    cursor.close()
+    return written
+
+
+def rebuild_blob_refcounts(conn):
+    """Set blobs.refcount from the posts, stories and profile pictures that
+    point at each stored file (adding rows for keys without one)."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO blobs (storage_key, size, refcount, created_at)
+        SELECT k, 0, COUNT(*), NOW() FROM (
+            SELECT media_filename AS k FROM posts WHERE media_filename IS NOT NULL
+            UNION ALL
+            SELECT media_filename FROM stories WHERE media_filename IS NOT NULL
+            UNION ALL
+            SELECT profile_picture FROM users WHERE profile_picture IS NOT NULL
+        ) refs
+        WHERE k <> ''
+        GROUP BY k
+        ON DUPLICATE KEY UPDATE refcount = VALUES(refcount)
+    """)
+    conn.commit()
+    cursor.close()
+
+
+def backfill_own_timelines(conn, batch_size=1000, log=None):
+    """Put every post in its author's own home timeline (timelines.py).
+    Safe to re-run; rows already there are skipped. Returns rows added."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM posts")
+    lo, hi = cursor.fetchone()
+    added = 0
+    start = lo
+    while start and start <= hi:
+        end = start + batch_size - 1
+        cursor.execute("""
+            INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+            SELECT user_id, id, user_id, created_at
+            FROM posts
+            WHERE id BETWEEN %s AND %s
+        """, (start, end))
+        added += cursor.rowcount
+        conn.commit()
+        if log:
+            log(f"posts {start}-{end}: {cursor.rowcount} timeline row(s) added")
+        start = end + 1
+    cursor.close()
+    return added
+
+
+def backfill_follower_counts(conn):
+    """Set users.follower_count from the follows table."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE users u
+        LEFT JOIN (SELECT followee_id, COUNT(*) AS c FROM follows GROUP BY followee_id) f
+          ON f.followee_id = u.id
+        SET u.follower_count = COALESCE(f.c, 0)
+    """)
+    conn.commit()
+    cursor.close()
+
+
+def backfill_follower_timelines(conn, batch_size=100, log=None):
+    """Put posts in their followers' home timelines, as fan-out on write
+    would have (authors over FANOUT_MAX_FOLLOWERS are pulled at read time
+    instead). Needs follower counts. Safe to re-run. Returns rows added."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM users")
+    lo, hi = cursor.fetchone()
+    added = 0
+    start = lo
+    while start and start <= hi:
+        end = start + batch_size - 1
+        cursor.execute("""
+            INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+            SELECT f.follower_id, p.id, p.user_id, p.created_at
+            FROM follows f
+            JOIN users u ON u.id = f.followee_id
+            JOIN posts p ON p.user_id = f.followee_id
+            WHERE f.follower_id BETWEEN %s AND %s AND u.follower_count < %s
+        """, (start, end, timelines.FANOUT_MAX_FOLLOWERS))
+        added += cursor.rowcount
+        conn.commit()
+        if log:
+            log(f"followers {start}-{end}: {cursor.rowcount} timeline row(s) added")
+        start = end + 1
+    cursor.close()
+    return added
+
+
+def rebuild_derived(conn, log=None):
+    """Recompute everything derived from the base rows (counters, home
+    timelines, conversations, blob refcounts), after loading rows in bulk."""
+    backfill_follower_counts(conn)
+    reconcile_like_counts(conn)
+    if log:
+        log("follower and like counts reconciled")
+    backfill_follower_timelines(conn)
+    backfill_own_timelines(conn)
+    if log:
+        log("timelines built")
+    backfill_conversations(conn)
+    rebuild_blob_refcounts(conn)
+    if log:
+        log("conversations and blob refcounts built")
+
+
+# ---------------------------------------------------------------------------
+# Migrations: (version, description, function(conn, cursor)). Append only.
+# ---------------------------------------------------------------------------
+
+def _m1_hot_path_indexes(conn, cursor):
+    # feed: ORDER BY created_at DESC, id DESC (InnoDB appends the PK)
+    add_index(cursor, "posts", "idx_posts_created", ["created_at"])
+    # profiles: WHERE user_id=? ORDER BY created_at DESC, id DESC
+    add_index(cursor, "posts", "idx_posts_user_created", ["user_id", "created_at"])
+    # stories (<24h)
+    add_index(cursor, "stories", "idx_stories_created", ["created_at"])
+    # conversations: (a -> b) OR (b -> a), newest first
+    add_index(cursor, "messages", "idx_messages_pair_created",
+              ["sender_id", "recipient_id", "created_at"])
+    # saved tab on the profile page
+    add_index(cursor, "saved_posts", "idx_saved_user", ["user_id"])
+
+
+def _m2_unique_likes_and_saves(conn, cursor):
+    # Double-clicks used to insert the same like twice; clear those out
+    # before the unique index goes on. A plain index on the pair goes on
+    # first (online) so the cleanup can find duplicates without scanning
+    # the table; the unique index replaces it afterwards.
+    for table, plain, unique in (("likes", "idx_likes_post_user", "uq_likes_post_user"),
+                                 ("saved_posts", "idx_saved_post_user", "uq_saved_post_user")):
+        add_index(cursor, table, plain, ["post_id", "user_id"])
+        dedupe(conn, table, ["post_id", "user_id"])
+        add_index(cursor, table, unique, ["post_id", "user_id"], unique=True)
+        drop_index(cursor, table, plain)
+
+
+def _m3_post_like_counter(conn, cursor):
+    # Maintained by like_api in the same transaction as the toggle, so
+    # rendering never has to COUNT(*) over likes.
+    add_column(cursor, "posts", "like_count", "INT NOT NULL DEFAULT 0")
+    conn.commit()
+    reconcile_like_counts(conn)
+
+
+def _m4_events_log(conn, cursor):
+    # Cross-worker change log for realtime.MySQLBus; pruned by the pollers.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            topic VARCHAR(32) NOT NULL,
+            payload VARCHAR(255) NOT NULL,
+            created_at DATETIME NOT NULL,
+            INDEX idx_events_created (created_at)
+        )
+    """)
+
+
+def _m5_conversations(conn, cursor):
+    # One row per (user, partner), maintained by direct_messages, so the
+    # inbox is a single range read on (user_id, last_message_at).
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INT NOT NULL,
+            partner_id INT NOT NULL,
+            last_message_id INT NOT NULL,
+            last_message_at DATETIME NOT NULL,
+            last_sender_id INT NOT NULL,
+            snippet VARCHAR({SNIPPET_LENGTH}) NOT NULL,
+            unread_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, partner_id),
+            INDEX idx_conversations_recent (user_id, last_message_at)
+        )
+    """)
+    conn.commit()
+    backfill_conversations(conn)
+
+
+def _m6_blobs(conn, cursor):
+    # Reference counts for stored uploads (storage.py). Files uploaded
+    # before content addressing keep their old names as keys; their size
+    # is unknown here and recorded as 0.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            storage_key VARCHAR(255) PRIMARY KEY,
+            size BIGINT NOT NULL DEFAULT 0,
+            refcount INT NOT NULL DEFAULT 0,
+            created_at DATETIME NOT NULL
+        )
+    """)
+    conn.commit()
+    rebuild_blob_refcounts(conn)
+
+
+def _m7_story_expiry(conn, cursor):
+    # The stories bar reads WHERE expires_at > NOW() and the reaper
+    # WHERE expires_at <= NOW(); both are ranges on this index.
+    add_column(cursor, "stories", "expires_at", "DATETIME NULL")
+    while True:
+        cursor.execute("""
+            UPDATE stories SET expires_at = created_at + INTERVAL 24 HOUR
+            WHERE expires_at IS NULL
+            LIMIT 1000
+        """)
+        conn.commit()
+        if cursor.rowcount < 1000:
+            break
+    add_index(cursor, "stories", "idx_stories_expires", ["expires_at"])
+
+
+def _m8_follows_and_timelines(conn, cursor):
+    # Follow graph; the secondary index answers "who follows X" for fan-out.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS follows (
+            follower_id INT NOT NULL,
+            followee_id INT NOT NULL,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (follower_id, followee_id),
+            INDEX idx_follows_followee (followee_id, follower_id)
+        )
+    """)
+    # Maintained by follow/unfollow; decides fan-out vs. pull per author.
+    add_column(cursor, "users", "follower_count", "INT NOT NULL DEFAULT 0")
+    # Materialized home timelines, written on post creation.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS timelines (
+            user_id INT NOT NULL,
+            post_id INT NOT NULL,
+            author_id INT NOT NULL,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (user_id, post_id),
+            INDEX idx_timelines_page (user_id, created_at, post_id),
+            INDEX idx_timelines_post (post_id)
+        )
+    """)
+    conn.commit()
+    backfill_own_timelines(conn)
+
+
+def _m9_jobs(conn, cursor):
+    # Background job queue (jobs.py). Workers claim due jobs in
+    # (status, run_at, id) order; the other indexes serve the claim
+    # read-back and the expired-lease sweep.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            kind VARCHAR(64) NOT NULL,
+            payload TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            max_attempts INT NOT NULL,
+            run_at DATETIME NOT NULL,
+            locked_by VARCHAR(128) NULL,
+            locked_until DATETIME NULL,
+            last_error TEXT NULL,
+            created_at DATETIME NOT NULL,
+            INDEX idx_jobs_claim (status, run_at, id),
+            INDEX idx_jobs_lease (status, locked_until),
+            INDEX idx_jobs_locked_by (locked_by)
+        )
+    """)
+    conn.commit()
+
+
+def _m10_search_indexes(conn, cursor):
+    # Full-text search (search.py). Username prefixes use the existing
+    # unique index on users.username.
+    add_fulltext_index(cursor, "posts", "ft_posts_content", ["content"])
+    add_fulltext_index(cursor, "users", "ft_users_bio", ["bio"])
+
+
+def _m11_archive_imports(conn, cursor):
+    # Archive chunks already imported (archive.py), written in the same
+    # transaction as the chunk's rows so an interrupted import resumes
+    # after the last committed one.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_imports (
+            archive_id CHAR(32) NOT NULL,
+            member VARCHAR(255) NOT NULL,
+            row_count INT NOT NULL,
+            imported_at DATETIME NOT NULL,
+            PRIMARY KEY (archive_id, member)
+        )
+    """)
+    conn.commit()
+
+
+MIGRATIONS = [
+    (1, "indexes for feed, profile, stories and conversation queries", _m1_hot_path_indexes),
+    (2, "unique (post_id, user_id) on likes and saved_posts", _m2_unique_likes_and_saves),
+    (3, "denormalized posts.like_count", _m3_post_like_counter),
+    (4, "events change-log table", _m4_events_log),
+    (5, "conversations summary table", _m5_conversations),
+    (6, "reference-counted upload blobs", _m6_blobs),
+    (7, "stories.expires_at", _m7_story_expiry),
+    (8, "follows, users.follower_count and home timelines", _m8_follows_and_timelines),
+    (9, "background jobs queue", _m9_jobs),
+    (10, "FULLTEXT indexes on posts.content and users.bio", _m10_search_indexes),
+    (11, "archive_imports progress table", _m11_archive_imports),
+]
+
+
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(conn):
+    cursor = conn.cursor()
+    _ensure_version_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    versions = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return versions
+
+
+def upgrade(conn, target=None, log=print):
+    """Apply pending migrations in order (up to `target`, if given).
+
+    Returns the list of versions applied.
+    """
+    done = applied_versions(conn)
+    applied = []
+    cursor = conn.cursor()
+    try:
+        for version, description, migrate in MIGRATIONS:
+            if version in done or (target is not None and version > target):
+                continue
+            log(f"applying migration {version}: {description}")
+            migrate(conn, cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description),
+            )
+            conn.commit()
+            applied.append(version)
+    finally:
+        cursor.close()
+    return applied
+
+
+def pending(conn):
+    """Versions not applied yet. Read-only: unlike upgrade(), a schema that
+    was never set up is an error here, not something to create."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+    return [v for v, _, _ in MIGRATIONS if v not in done]
+
+
+def status(conn):
+    """[(version, description, applied?)] for every known migration."""
+    done = applied_versions(conn)
+    return [(v, d, v in done) for v, d, _ in MIGRATIONS]
+
+
+# ---------------------------------------------------------------------------
+# EXPLAIN report
+# ---------------------------------------------------------------------------
+
+class _ExplainingCursor:
+    """Cursor proxy that EXPLAINs every SELECT before running it, so a hot
+    code path can be exercised as-is and its exact statements inspected."""
+
+    def __init__(self, conn):
+        self._cursor = conn.cursor(dictionary=True)
+        self._explain = conn.cursor(dictionary=True)
+        self.plans = []
+
+    def execute(self, sql, params=None):
+        if sql.lstrip().upper().startswith("SELECT"):
+            self._explain.execute("EXPLAIN " + sql, params)
+            self.plans.append((" ".join(sql.split()), self._explain.fetchall()))
+        return self._cursor.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def close(self):
+        self._explain.close()
+        self._cursor.close()
+
+
+def plan_warnings(plan_rows):
+    """Problems worth flagging in one statement's EXPLAIN output."""
+    warnings = []
+    for row in plan_rows:
+        table = row.get("table")
+        if row.get("type") == "ALL":
+            warnings.append(f"full scan of {table}")
+        extra = row.get("Extra") or ""
+        if "Using filesort" in extra:
+            warnings.append(f"filesort on {table}")
+        if "Using temporary" in extra:
+            warnings.append(f"temporary table for {table}")
+    return warnings
+
+
+def explain_report(conn, hot_paths, out=print):
+    """Run each hot path with an EXPLAINing cursor and print the plans.
+
+    `hot_paths` maps a name to a callable taking a cursor. Returns the
+    number of statements with warnings.
+    """
+    flagged = 0
+    for name, run in hot_paths.items():
+        cursor = _ExplainingCursor(conn)
+        try:
+            run(cursor)
+        except mysql.connector.Error as e:
+            out(f"== {name}: failed: {e}")
+            continue
+        finally:
+            cursor.close()
+        out(f"== {name}")
+        for sql, plan in cursor.plans:
+            out(f"  {sql}")
+            for row in plan:
+                out("    {table:<12} type={type:<8} key={key} rows={rows} {Extra}".format(
+                    **{k: str(row.get(k) or "") for k in ("table", "type", "key", "rows", "Extra")}
+                ))
+            warnings = plan_warnings(plan)
+            if warnings:
+                flagged += 1
+                out("    !! " + "; ".join(warnings))
+    conn.rollback()
+    return flagged
@@ -0,0 +1,64 @@
+import base64
+import os
+from datetime import datetime
+
+# Page sizes (rows per request); ?limit= may ask for fewer, never more than MAX_PAGE_SIZE
+FEED_PAGE_SIZE = int(os.environ.get("FEED_PAGE_SIZE", "20"))
+PROFILE_PAGE_SIZE = int(os.environ.get("PROFILE_PAGE_SIZE", "24"))
+MESSAGES_PAGE_SIZE = int(os.environ.get("MESSAGES_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "100"))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, row_id):
+    """Opaque token for the position just after (created_at, row_id)."""
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor(). Returns None for an empty token."""
+    if not token:
+        return None
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        created, row_id = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(created), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"bad cursor: {token!r}") from e
+
+
+def page_size(requested, default):
+    """Clamp a client-supplied ?limit= to [1, MAX_PAGE_SIZE]."""
+    try:
+        n = int(requested) if requested else default
+    except (TypeError, ValueError):
+        n = default
+    return max(1, min(n, MAX_PAGE_SIZE))
+
+
+def keyset_filter(position, created_col, id_col):
+    """WHERE fragment selecting rows strictly older than `position`, for
+    lists ordered by (created_col DESC, id_col DESC).
+
+    Returns (sql, params); sql is "" on the first page. Written as an OR
+    rather than a row comparison so MySQL can range-scan a
+    (created_at, id) index.
+    """
+    if position is None:
+        return "", []
+    created_at, row_id = position
+    sql = f"({created_col} < %s OR ({created_col} = %s AND {id_col} < %s))"
+    return sql, [created_at, created_at, row_id]
+
+
+def split_page(rows, limit, created_key="created_at", id_key="id"):
+    """Given up to limit+1 rows in page order, return (rows, next_cursor)."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[created_key], last[id_key])
@@ -0,0 +1,145 @@
+"""Password hashing on a bounded pool of threads.
+
+Hashing is slow on purpose. Run inline, a burst of logins would keep
+every request thread busy on CPU and starve everything else. Instead,
+each worker process hashes on PASSWORD_HASH_THREADS threads. hashlib's
+scrypt and pbkdf2 release the GIL, so those threads use real cores.
+At most PASSWORD_HASH_QUEUE more requests wait for a free thread. A
+request beyond that, or one that waits longer than
+PASSWORD_HASH_TIMEOUT, gets Busy and answers 503 straight away instead
+of piling up.
+
+New hashes use PASSWORD_HASH_METHOD, in werkzeug's notation
+("scrypt:32768:8:1", "pbkdf2:sha256:600000"). needs_rehash() tells
+login when a stored hash was made with other parameters, so it can be
+replaced while the plain password is at hand.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash,
+)
+
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", "16"))
+PASSWORD_HASH_THREADS = int(os.environ.get("PASSWORD_HASH_THREADS", "2"))
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", "16"))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", "5"))
+
+
+class Busy(Exception):
+    """Too many hashes queued already; try again shortly."""
+
+
+def method_prefix(method):
+    """The method as werkzeug writes it at the start of a hash, with its
+    defaults spelled out ("scrypt" -> "scrypt:32768:8:1")."""
+    name, *args = method.split(":")
+    if name == "scrypt":
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    if name == "pbkdf2":
+        hash_name = args[0] if args else "sha256"
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    return method
+
+
+class Hasher:
+    def __init__(self, threads=PASSWORD_HASH_THREADS, queue=PASSWORD_HASH_QUEUE,
+                 timeout=PASSWORD_HASH_TIMEOUT, method=PASSWORD_HASH_METHOD):
+        self.threads = threads
+        self.timeout = timeout
+        self.method = method
+        self._prefix = method_prefix(method)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="password-hash")
+        # Running plus waiting, so a full queue is refused up front
+        self._slots = threading.BoundedSemaphore(threads + queue)
+        self._lock = threading.Lock()
+
+        # stats
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.hash_time = 0.0
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Busy("password hashing queue is full")
+        submitted = time.monotonic()
+        with self._lock:
+            self.pending += 1
+
+        def task():
+            started = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.wait_time += started - submitted
+                    self.max_wait = max(self.max_wait, started - submitted)
+                    self.hash_time += time.monotonic() - started
+
+        future = self._executor.submit(task)
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            # Gave up waiting; a queued task is dropped, a running one
+            # finishes on its own and frees its slot then
+            future.cancel()
+            with self._lock:
+                self.rejected += 1
+            raise Busy(f"password hashing took longer than {self.timeout}s") from None
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if not future.cancelled():
+                self.completed += 1
+        self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, PASSWORD_SALT_LENGTH)
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Whether `password_hash` was made with parameters other than
+        PASSWORD_HASH_METHOD (or a salt of a different length)."""
+        method, _, rest = password_hash.partition("$")
+        salt = rest.partition("$")[0]
+        return method != self._prefix or len(salt) != PASSWORD_SALT_LENGTH
+
+    def stats(self):
+        with self._lock:
+            return {"threads": self.threads, "pending": self.pending,
+                    "completed": self.completed, "rejected": self.rejected,
+                    "wait_time_total": round(self.wait_time, 6),
+                    "wait_time_max": round(self.max_wait, 6),
+                    "hash_time_total": round(self.hash_time, 6)}
+
+
+_hasher = None
+_hasher_pid = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher():
+    """This worker's Hasher (threads don't survive a fork)."""
+    global _hasher, _hasher_pid
+    pid = os.getpid()
+    if _hasher_pid != pid:
+        with _hasher_lock:
+            if _hasher_pid != pid:
+                _hasher = Hasher()
+                _hasher_pid = pid
+    return _hasher
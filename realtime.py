@@ -0,0 +1,280 @@
+"""Push delivery of direct messages.
+
+A per-worker MessageHub keeps the open message streams, keyed by the pair
+of users in the conversation. When a message is sent, only the streams for
+that pair are woken; everyone else stays parked and costs nothing.
+
+Workers (and replicas) learn about each other's messages through an event
+bus:
+
+- LocalBus: in-process only, for a single worker or tests.
+- MySQLBus: an `events` change-log table. Publishing inserts a row; one
+  poller thread per worker tails the table and dispatches new rows. DB
+  reads therefore scale with messages sent, not with open tabs.
+
+Pick one with REALTIME_BUS=local|mysql (default mysql). The bus is not
+specific to messages: other per-worker state (the stories cache, say)
+uses it to hear about changes made by other workers.
+
+Each open stream holds one of its worker's gunicorn threads. So that
+chat tabs can't take every thread, a worker serves at most
+REALTIME_MAX_STREAMS at once (half its threads by default); past that,
+subscribe() raises StreamsFull and the page polls instead. Streams also
+end after REALTIME_STREAM_SECONDS, and the browser reconnects from the
+last event id, so threads turn over and a reconnect can land on a
+less busy worker.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+REALTIME_BUS = os.environ.get("REALTIME_BUS", "mysql")
+REALTIME_POLL_INTERVAL = float(os.environ.get("REALTIME_POLL_INTERVAL", "0.25"))
+REALTIME_EVENT_RETENTION = int(os.environ.get("REALTIME_EVENT_RETENTION", "3600"))
+# Seconds between keepalive comments on an idle stream
+REALTIME_KEEPALIVE = float(os.environ.get("REALTIME_KEEPALIVE", "15"))
+# Open streams per worker, and how long one lasts before the client is
+# made to reconnect
+REALTIME_MAX_STREAMS = int(os.environ.get(
+    "REALTIME_MAX_STREAMS", max(1, int(os.environ.get("GUNICORN_THREADS", "8")) // 2)))
+REALTIME_STREAM_SECONDS = float(os.environ.get("REALTIME_STREAM_SECONDS", "300"))
+
+log = logging.getLogger(__name__)
+
+
+class LocalBus:
+    """Dispatches events to subscribers in this process only."""
+
+    def __init__(self):
+        self._handlers = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, handler):
+        with self._lock:
+            self._handlers[topic].append(handler)
+
+    def publish(self, topic, payload, conn=None):
+        self._dispatch(topic, payload)
+
+    def _dispatch(self, topic, payload):
+        with self._lock:
+            handlers = list(self._handlers.get(topic, ()))
+        for handler in handlers:
+            try:
+                handler(payload)
+            except Exception:
+                log.exception("event handler for %r failed", topic)
+
+
+class MySQLBus(LocalBus):
+    """Event bus backed by the `events` table (see migrations.py).
+
+    Events are dispatched locally right away, and other workers pick them
+    up on their next poll. The poller re-reads a short window behind its
+    high-water mark, because AUTO_INCREMENT ids can become visible out of
+    order when transactions commit out of order.
+    """
+
+    LOOKBACK = 50
+
+    def __init__(self, get_pool, poll_interval=REALTIME_POLL_INTERVAL,
+                 retention=REALTIME_EVENT_RETENTION):
+        super().__init__()
+        self._get_pool = get_pool
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._seen = set()
+        self._seen_order = deque()
+        self._high_water = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._last_prune = 0.0
+        self.polls = 0
+
+    def publish(self, topic, payload, conn):
+        """Record the event using the caller's connection and commit it."""
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO events (topic, payload, created_at) VALUES (%s, %s, %s)",
+                       (topic, payload, datetime.now()))
+        event_id = cursor.lastrowid
+        conn.commit()
+        cursor.close()
+        self._mark_seen(event_id)
+        self._dispatch(topic, payload)
+
+    def subscribe(self, topic, handler):
+        super().subscribe(topic, handler)
+        self.start()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="events-poller", daemon=True)
+                self._thread.start()
+
+    def _mark_seen(self, event_id):
+        with self._lock:
+            self._seen.add(event_id)
+            self._seen_order.append(event_id)
+            while len(self._seen_order) > 10 * self.LOOKBACK:
+                self._seen.discard(self._seen_order.popleft())
+
+    def _run(self):
+        while True:
+            try:
+                self._poll_once()
+            except Exception:
+                log.exception("events poll failed")
+                time.sleep(1)
+            time.sleep(self.poll_interval)
+
+    def _poll_once(self):
+        pool = self._get_pool()
+        conn = pool.acquire()
+        try:
+            cursor = conn.cursor()
+            if self._high_water is None:
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM events")
+                self._high_water = cursor.fetchone()[0]
+            cursor.execute("""
+                SELECT id, topic, payload FROM events
+                WHERE id > %s
+                ORDER BY id
+                LIMIT 1000
+            """, (max(0, self._high_water - self.LOOKBACK),))
+            rows = cursor.fetchall()
+
+            if time.monotonic() - self._last_prune > 60:
+                cutoff = datetime.now() - timedelta(seconds=self.retention)
+                cursor.execute("DELETE FROM events WHERE created_at < %s LIMIT 1000", (cutoff,))
+                conn.commit()
+                self._last_prune = time.monotonic()
+            cursor.close()
+        finally:
+            pool.release(conn)
+
+        self.polls += 1
+        for event_id, topic, payload in rows:
+            self._high_water = max(self._high_water, event_id)
+            if event_id in self._seen:
+                continue
+            self._mark_seen(event_id)
+            self._dispatch(topic, payload)
+
+
+class StreamsFull(Exception):
+    """This worker already has REALTIME_MAX_STREAMS open streams."""
+
+
+class Subscription:
+    def __init__(self, key):
+        self.key = key
+        self._event = threading.Event()
+
+    def wake(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """Block until woken or `timeout` passes. Returns True if woken."""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+
+class MessageHub:
+    """Open message streams in this worker, keyed by conversation pair."""
+
+    TOPIC = "dm"
+
+    def __init__(self, bus, max_streams=REALTIME_MAX_STREAMS):
+        self.bus = bus
+        self.max_streams = max_streams
+        self._subs = defaultdict(set)
+        self._lock = threading.Lock()
+        self._open = 0
+        self.notifications = 0
+        self.rejected = 0
+        bus.subscribe(self.TOPIC, self._on_event)
+
+    @staticmethod
+    def pair_key(a, b):
+        return (a, b) if a < b else (b, a)
+
+    def subscribe(self, user_id, other_id):
+        """A Subscription for the pair, or StreamsFull."""
+        sub = Subscription(self.pair_key(user_id, other_id))
+        with self._lock:
+            if self._open >= self.max_streams:
+                self.rejected += 1
+                raise StreamsFull(f"{self._open} streams open")
+            self._subs[sub.key].add(sub)
+            self._open += 1
+        return sub
+
+    def unsubscribe(self, sub):
+        """Safe to call more than once."""
+        with self._lock:
+            subs = self._subs.get(sub.key)
+            if subs is not None and sub in subs:
+                subs.discard(sub)
+                self._open -= 1
+                if not subs:
+                    del self._subs[sub.key]
+
+    def message_sent(self, sender_id, recipient_id, message_id, conn):
+        """Announce a committed message to every worker."""
+        lo, hi = self.pair_key(sender_id, recipient_id)
+        self.bus.publish(self.TOPIC, f"{lo}:{hi}:{message_id}", conn)
+
+    def _on_event(self, payload):
+        lo, hi, _ = (int(x) for x in payload.split(":"))
+        with self._lock:
+            subs = list(self._subs.get((lo, hi), ()))
+            self.notifications += 1
+        for sub in subs:
+            sub.wake()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "conversations": len(self._subs),
+                "subscribers": self._open,
+                "max_streams": self.max_streams,
+                "rejected": self.rejected,
+                "notifications": self.notifications,
+            }
+
+
+_bus = None
+_hub = None
+_pid = None
+_lock = threading.Lock()
+
+
+def _ensure(get_pool):
+    global _bus, _hub, _pid
+    pid = os.getpid()
+    if _pid != pid:
+        with _lock:
+            if _pid != pid:
+                _bus = MySQLBus(get_pool) if REALTIME_BUS == "mysql" else LocalBus()
+                _hub = MessageHub(_bus)
+                _pid = pid
+
+
+def get_bus(get_pool):
+    """This worker's event bus, created on first use (and again after a
+    fork). Other modules publish/subscribe their own topics on it."""
+    _ensure(get_pool)
+    return _bus
+
+
+def get_hub(get_pool):
+    """This worker's message hub, on the bus from get_bus()."""
+    _ensure(get_pool)
+    return _hub
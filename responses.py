@@ -0,0 +1,152 @@
+"""Response encoding: on-the-fly compression and the JSON encoder.
+
+- Compression: HTML, JSON and other text responses of at least
+  COMPRESS_MIN_SIZE bytes are sent as brotli or gzip, whichever the
+  client's Accept-Encoding prefers (brotli if both). Streamed bodies are
+  compressed chunk by chunk with a flush after each, so the client still
+  gets every chunk when it is produced. Server-Sent Events are left
+  alone (proxies tend to buffer compressed streams), as are files from
+  send_file: assets.py serves precompressed copies of those.
+- Compression turns a strong ETag weak, since the bytes now depend on
+  the encoding. Compare If-None-Match with contains_weak().
+- JSON: orjson when it is installed, otherwise the stdlib encoder
+  without sorting keys or indenting. Dates still serialize the way
+  Flask's default encoder does.
+"""
+import os
+import zlib
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # stdlib json
+    orjson = None
+
+# Bodies smaller than this go out as they are: the encoding overhead
+# outweighs the saving
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+# 4-5 is the usual choice for compressing per response; 11 is for build
+# time (assets.compress_static)
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/plain", "text/css", "text/javascript", "application/javascript",
+    "application/json", "application/x-ndjson", "image/svg+xml",
+}
+
+
+class _Gzip:
+    def __init__(self):
+        # wbits 16+ writes the gzip header and trailer
+        self._z = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _Brotli:
+    def __init__(self):
+        self._c = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+def _encoders():
+    return {"br": _Brotli, "gzip": _Gzip} if brotli is not None else {"gzip": _Gzip}
+
+
+def _stream(chunks, encoder):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            out = encoder.compress(chunk) + encoder.flush()
+            if out:
+                yield out
+        yield encoder.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(response):
+    """after_request: compress `response` in place if it qualifies."""
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or request.method == "HEAD"):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoders = _encoders()
+    # best_match honours q-values; on a tie the order here wins
+    encoding = request.accept_encodings.best_match(list(encoders))
+    if encoding is None:
+        return response
+
+    encoder = encoders[encoding]()
+    if response.is_streamed:
+        response.response = _stream(response.response, encoder)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(encoder.compress(data) + encoder.finish())
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def epoch(dt):
+    """Seconds since the epoch for a naive server-local datetime (how the
+    app stores them), as the JSON APIs send timestamps."""
+    return int(dt.timestamp())
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask's JSON provider with orjson doing the encoding."""
+
+    def dumps(self, obj, **kwargs):
+        # Dates go through Flask's default() so they keep the same format
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        # The session serializer decodes with an object_hook, which
+        # orjson doesn't take
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def init_app(app):
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+    app.json.sort_keys = False
+    app.json.compact = True
+    app.after_request(compress_response)
@@ -0,0 +1,121 @@
+"""Search over posts and users, backed by indexes (migration 10).
+
+Posts match on a FULLTEXT index over posts.content. Every word of the
+query has to appear, and the last word also matches as a prefix, so
+results show up while the user is still typing. Words InnoDB doesn't
+index (stopwords, words that are too short) are left out, as requiring
+one would match nothing. Results are ranked by InnoDB's relevance score.
+
+People match by username prefix through the unique username index. The
+exact name sorts first, and the rest follow in username order. After
+them come users whose bio matches, again from a FULLTEXT index.
+
+Ranked results are paged by offset, because a relevance score is no
+good as a keyset cursor. Paging stops after SEARCH_MAX_RESULTS, so no
+query reads more than that many index entries however large the tables
+grow.
+"""
+import os
+import re
+
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "500"))
+# InnoDB doesn't index shorter words (innodb_ft_min_token_size)
+MIN_WORD_LENGTH = int(os.environ.get("SEARCH_MIN_WORD_LENGTH", "3"))
+# Longer queries are cut to this many words
+MAX_WORDS = 8
+# InnoDB's default stopword list (INFORMATION_SCHEMA.INNODB_FT_DEFAULT_STOPWORD);
+# set SEARCH_STOPWORDS (comma-separated) if the server uses its own table
+STOPWORDS = frozenset(os.environ.get("SEARCH_STOPWORDS", ",".join([
+    "a", "about", "an", "are", "as", "at", "be", "by", "com", "de", "en", "for", "from",
+    "how", "i", "in", "is", "it", "la", "of", "on", "or", "that", "the", "this", "to",
+    "was", "what", "when", "where", "who", "will", "with", "und", "www",
+])).lower().split(","))
+
+_WORD = re.compile(r"\w+")
+
+
+def fulltext_query(text):
+    """A BOOLEAN MODE query for `text`: every word required, the last one
+    as a prefix. Operators typed by the user are dropped, not
+    interpreted. Words that aren't indexed are dropped. Returns None if
+    no word is left."""
+    words = [w for w in _WORD.findall(text)
+             if len(w) >= MIN_WORD_LENGTH and w.lower() not in STOPWORDS][:MAX_WORDS]
+    if not words:
+        return None
+    terms = [f"+{w}" for w in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def like_prefix(text):
+    """A LIKE pattern matching strings that start with `text`."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+def clamp_offset(requested):
+    try:
+        offset = int(requested) if requested else 0
+    except (TypeError, ValueError):
+        offset = 0
+    return max(0, min(offset, SEARCH_MAX_RESULTS))
+
+
+def _next_offset(rows, offset, limit):
+    """(rows, next_offset) from up to limit+1 rows starting at `offset`."""
+    if len(rows) <= limit or offset + limit >= SEARCH_MAX_RESULTS:
+        return rows[:limit], None
+    return rows[:limit], offset + limit
+
+
+def search_post_ids(cursor, text, offset, limit):
+    """Ids of posts matching `text`, best first. Returns (ids, next_offset).
+
+    Only MATCH is in the WHERE and ORDER BY, so InnoDB can stop ranking
+    once it has offset+limit results instead of sorting every match."""
+    query = fulltext_query(text)
+    if query is None:
+        return [], None
+    cursor.execute("""
+        SELECT id FROM posts
+        WHERE MATCH(content) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY MATCH(content) AGAINST (%s IN BOOLEAN MODE) DESC
+        LIMIT %s, %s
+    """, (query, query, offset, limit + 1))
+    ids = [row["id"] for row in cursor.fetchall()]
+    return _next_offset(ids, offset, limit)
+
+
+def search_users(cursor, text, offset, limit):
+    """Users matching `text`: username prefix matches, then bio matches.
+    Returns (users, next_offset)."""
+    text = text.strip().lstrip("@")
+    if not text:
+        return [], None
+    wanted = offset + limit + 1
+    cursor.execute("""
+        SELECT id, username, profile_picture, bio, follower_count
+        FROM users
+        WHERE username LIKE %s
+        ORDER BY username
+        LIMIT %s
+    """, (like_prefix(text), wanted))
+    rows = cursor.fetchall()
+    # The exact name sorts first by itself, but the collation ignores
+    # case and trailing spaces. Move it up explicitly.
+    rows.sort(key=lambda u: u["username"].lower() != text.lower())
+
+    query = fulltext_query(text)
+    if len(rows) < wanted and query is not None:
+        cursor.execute("""
+            SELECT id, username, profile_picture, bio, follower_count
+            FROM users
+            WHERE MATCH(bio) AGAINST (%s IN BOOLEAN MODE)
+            ORDER BY MATCH(bio) AGAINST (%s IN BOOLEAN MODE) DESC
+            LIMIT %s
+        """, (query, query, wanted))
+        seen = {u["id"] for u in rows}
+        rows += [u for u in cursor.fetchall() if u["id"] not in seen][:wanted - len(rows)]
+    return _next_offset(rows[offset:], offset, limit)
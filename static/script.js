@@ -11,35 +11,57 @@ function showFilename(input, labelId) {
   }
 }
 
-// For story modal
-function openStoryModal(mediaUrl, username) {
+// For story modal. mediaUrls is one URL or a user's stories in order;
+// clicking the media steps to the next one.
+function openStoryModal(mediaUrls, username) {
   const modal = document.getElementById("storyModal");
   const closeBtn = document.getElementById("closeModal") || document.querySelector(".close");
   const modalMedia = document.getElementById("modalMedia");
   const modalUser = document.getElementById("modalUser");
+  const urls = Array.isArray(mediaUrls) ? mediaUrls : [mediaUrls];
+  let index = 0;
 
-  modalMedia.innerHTML = "";
-
-  const lowerUrl = mediaUrl.toLowerCase();
-  if (lowerUrl.endsWith(".png") || lowerUrl.endsWith(".jpg") ||
-      lowerUrl.endsWith(".jpeg") || lowerUrl.endsWith(".gif")) {
-    const img = document.createElement("img");
-    img.src = mediaUrl;
-    modalMedia.appendChild(img);
-  } else if (lowerUrl.endsWith(".mp4") || lowerUrl.endsWith(".mov") || lowerUrl.endsWith(".avi")) {
-    const vid = document.createElement("video");
-    vid.src = mediaUrl;
-    vid.controls = true;
-    modalMedia.appendChild(vid);
-  } else {
-    const p = document.createElement("p");
-    p.textContent = "Unsupported format.";
-    modalMedia.appendChild(p);
+  function show() {
+    const mediaUrl = urls[index];
+    modalMedia.innerHTML = "";
+
+    const lowerUrl = mediaUrl.split("?")[0].toLowerCase();
+    if (lowerUrl.endsWith(".png") || lowerUrl.endsWith(".jpg") ||
+        lowerUrl.endsWith(".jpeg") || lowerUrl.endsWith(".gif") ||
+        lowerUrl.endsWith(".webp")) {
+      const img = document.createElement("img");
+      img.src = mediaUrl;
+      modalMedia.appendChild(img);
+    } else if (lowerUrl.endsWith(".mp4") || lowerUrl.endsWith(".mov") || lowerUrl.endsWith(".avi")) {
+      const vid = document.createElement("video");
+      vid.src = mediaUrl;
+      vid.controls = true;
+      modalMedia.appendChild(vid);
+    } else {
+      const p = document.createElement("p");
+      p.textContent = "Unsupported format.";
+      modalMedia.appendChild(p);
+    }
+
+    modalUser.textContent = urls.length > 1
+      ? `Story by: ${username} (${index + 1}/${urls.length})`
+      : `Story by: ${username}`;
   }
 
-  modalUser.textContent = `Story by: ${username}`;
+  show();
   modal.style.display = "block";
 
+  // Next story (clicks on a video are for its controls)
+  modalMedia.onclick = (evt) => {
+    if (evt.target.tagName === "VIDEO") return;
+    if (index + 1 < urls.length) {
+      index++;
+      show();
+    } else {
+      modal.style.display = "none";
+    }
+  };
+
   // Close
   if (closeBtn) {
     closeBtn.onclick = () => {
@@ -54,3 +76,136 @@ function openStoryModal(mediaUrl, username) {
     }
   };
 }
+
+// "Load more" links: fetch the next page as an HTML fragment and
+// put it in place of the link (the link itself works without JS)
+function loadMore(link) {
+  const url = new URL(link.href, window.location.href);
+  url.searchParams.set("fragment", link.dataset.fragment || "1");
+  link.textContent = "Loading...";
+  fetch(url)
+    .then(r => r.text())
+    .then(html => {
+      link.insertAdjacentHTML("beforebegin", html);
+      link.remove();
+    })
+    .catch(err => {
+      console.error("loadMore error:", err);
+      link.textContent = "Load more";
+    });
+  return false;
+}
+
+// Likes and saves. A click updates the button at once; the change is
+// queued and sent with any others to /batch_api after BATCH_DELAY ms
+// without clicks (or BATCH_MAX_WAIT after the first one). A later click
+// on the same button replaces the queued one, so like/unlike/like sends
+// a single "like".
+const BATCH_DELAY = 400;
+const BATCH_MAX_WAIT = 2000;
+let batchSeq = 0;
+let batchTimer = null;
+let batchStarted = 0;
+const queuedOps = new Map();  // "like:12" -> {seq, op, post_id}
+const latestSeq = new Map();  // "like:12" -> seq of the newest click
+const confirmed = new Map();  // "like:12" -> last state the server confirmed
+
+function renderLike(postId, liked, count) {
+  const btn = document.getElementById(`likeBtn-${postId}`);
+  const countSpan = document.getElementById(`likeCount-${postId}`);
+  if (!btn) return;
+  btn.classList.toggle("liked", liked);
+  btn.textContent = liked ? "Unlike" : "Like";
+  if (countSpan) countSpan.textContent = count + " likes";
+}
+
+function renderSave(postId, saved) {
+  const btn = document.getElementById(`saveBtn-${postId}`);
+  if (btn) btn.textContent = saved ? "Unsave" : "Save";
+}
+
+function currentLike(postId) {
+  const countSpan = document.getElementById(`likeCount-${postId}`);
+  return {
+    liked: document.getElementById(`likeBtn-${postId}`).classList.contains("liked"),
+    count: parseInt(countSpan ? countSpan.textContent : "0", 10) || 0,
+  };
+}
+
+function currentSave(postId) {
+  return { saved: document.getElementById(`saveBtn-${postId}`).textContent.trim() === "Unsave" };
+}
+
+function toggleLike(postId) {
+  const now = currentLike(postId);
+  if (!confirmed.has(`like:${postId}`)) confirmed.set(`like:${postId}`, now);
+  renderLike(postId, !now.liked, now.count + (now.liked ? -1 : 1));
+  queueOp("like", postId, now.liked ? "unlike" : "like");
+}
+
+function toggleSave(postId) {
+  const now = currentSave(postId);
+  if (!confirmed.has(`save:${postId}`)) confirmed.set(`save:${postId}`, now);
+  renderSave(postId, !now.saved);
+  queueOp("save", postId, now.saved ? "unsave" : "save");
+}
+
+function queueOp(kind, postId, op) {
+  const key = `${kind}:${postId}`;
+  const seq = ++batchSeq;
+  queuedOps.set(key, { seq, op, post_id: postId });
+  latestSeq.set(key, seq);
+
+  const now = Date.now();
+  if (batchTimer) {
+    clearTimeout(batchTimer);
+  } else {
+    batchStarted = now;
+  }
+  batchTimer = setTimeout(flushOps, Math.min(BATCH_DELAY, Math.max(0, batchStarted + BATCH_MAX_WAIT - now)));
+}
+
+function flushOps() {
+  clearTimeout(batchTimer);
+  batchTimer = null;
+  if (!queuedOps.size) return;
+  const ops = Array.from(queuedOps.values());
+  queuedOps.clear();
+
+  // keepalive lets a batch sent while the page unloads still arrive
+  fetch("/batch_api", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ ops }),
+    keepalive: true,
+  })
+    .then(r => r.json())
+    .then(data => {
+      if (data.error) throw new Error(data.error);
+      Object.entries(data.posts).forEach(([postId, st]) => {
+        // Skip anything clicked again since this batch was sent
+        if ("liked" in st) {
+          confirmed.set(`like:${postId}`, { liked: st.liked, count: st.like_count });
+          if (latestSeq.get(`like:${postId}`) <= st.seq) renderLike(postId, st.liked, st.like_count);
+        }
+        if ("saved" in st) {
+          confirmed.set(`save:${postId}`, { saved: st.saved });
+          if (latestSeq.get(`save:${postId}`) <= st.seq) renderSave(postId, st.saved);
+        }
+      });
+    })
+    .catch(err => {
+      console.error("batch error:", err);
+      // Put back what the server last confirmed, unless clicked again
+      ops.forEach(({ seq, op, post_id }) => {
+        const kind = op.endsWith("like") ? "like" : "save";
+        const key = `${kind}:${post_id}`;
+        const last = confirmed.get(key);
+        if (!last || latestSeq.get(key) !== seq) return;
+        if (kind === "like") renderLike(post_id, last.liked, last.count);
+        else renderSave(post_id, last.saved);
+      });
+    });
+}
+
+window.addEventListener("pagehide", flushOps);
@@ -0,0 +1,254 @@
+"""Content-addressed upload storage.
+
+Uploads are stored under the SHA-256 of their bytes, sharded two levels
+deep: ab/cd/abcd1234...<ext>. Identical files are stored once, and two
+users uploading "image.jpg" no longer overwrite each other.
+
+Multipart file parts are streamed by Werkzeug straight into a temporary
+file that hashes as it is written (UploadRequest). Storing the upload is
+then a rename, with no second copy and no in-memory buffering. For that
+the temp folder has to be on the same filesystem as the files, so
+LocalStorage keeps it inside its root (.tmp) unless UPLOAD_TMP_FOLDER
+says otherwise.
+
+Every stored file has a row in `blobs` counting the posts, stories and
+profile pictures that point at it. acquire() and release() adjust the
+count inside the caller's transaction, and collect() deletes blobs that
+have dropped to zero.
+
+The backend is pluggable. LocalStorage keeps files under the upload
+folder. Anything implementing Storage (an object-store client, say) can
+be selected with STORAGE_BACKEND=module:Class.
+"""
+import errno
+import hashlib
+import importlib
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime
+
+from flask import Request, current_app, url_for
+
+# Where uploads are spooled; empty means the backend's own temp_folder
+UPLOAD_TMP_FOLDER = os.environ.get("UPLOAD_TMP_FOLDER", "")
+# LocalStorage's temp folder, inside its root
+TEMP_DIR = ".tmp"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "storage:LocalStorage")
+
+CHUNK_SIZE = 64 * 1024
+
+_KEY_RE = re.compile(r"[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.\w+)?")
+
+
+class Storage:
+    """Interface for blob backends. Keys are relative paths like
+    "ab/cd/<sha256>.jpg"."""
+
+    #: Directory holding the files if they live on the local filesystem
+    #: (media variants are only made for local backends), else None.
+    local_root = None
+    #: Local directory uploads are spooled to before put().
+    temp_folder = UPLOAD_TMP_FOLDER or ".upload_tmp"
+
+    def put(self, local_path, key):
+        """Take ownership of `local_path` and store it under `key`."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def open(self, key):
+        """Binary file object for reading the blob."""
+        raise NotImplementedError
+
+    def url(self, key):
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    def __init__(self, root):
+        self.local_root = root
+        self.temp_folder = UPLOAD_TMP_FOLDER or os.path.join(root, TEMP_DIR)
+
+    def _path(self, key):
+        return os.path.join(self.local_root, key)
+
+    def put(self, local_path, key):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            os.replace(local_path, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # UPLOAD_TMP_FOLDER is on another filesystem: copy next to the
+            # target first, so a crash never leaves a partial file at `path`
+            fd, part = tempfile.mkstemp(dir=directory, prefix=".part-")
+            os.close(fd)
+            try:
+                shutil.copyfile(local_path, part)
+                os.replace(part, path)
+            except BaseException:
+                os.remove(part)
+                raise
+            os.remove(local_path)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def open(self, key):
+        return open(self._path(key), "rb")
+
+    def url(self, key):
+        return url_for("static", filename="uploads/" + key)
+
+
+def load_backend(upload_folder, spec=STORAGE_BACKEND):
+    module_name, _, class_name = spec.partition(":")
+    cls = getattr(importlib.import_module(module_name), class_name)
+    return cls(upload_folder)
+
+
+# ----- streaming + hashing -----
+
+class HashingTempFile:
+    """Writable temp file that SHA-256s everything written to it."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix="upload-")
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        """Close, and delete the temp file unless it was stored."""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        # read/readline/seek/tell/flush/... go to the real file
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request class that streams uploaded files into HashingTempFiles."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return HashingTempFile(current_app.config.get("UPLOAD_TMP_FOLDER")
+                               or Storage.temp_folder)
+
+
+def _hashed_temp(file_storage, directory):
+    """The upload as a HashingTempFile, copying it in chunks (into
+    `directory`) only if it didn't arrive through UploadRequest (e.g.
+    test clients)."""
+    stream = file_storage.stream
+    if isinstance(stream, HashingTempFile):
+        stream.flush()
+        return stream
+    tmp = HashingTempFile(directory)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        tmp.write(chunk)
+    tmp.flush()
+    return tmp
+
+
+def blob_key(digest, filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+
+def key_digest(key):
+    """SHA-256 a content-addressed key was named after, or None for keys
+    (legacy file names) that aren't."""
+    m = _KEY_RE.fullmatch(key)
+    return m.group(1) if m else None
+
+
+# ----- reference counting -----
+
+def store_upload(backend, cursor, file_storage):
+    """Store an uploaded file and take a reference to it.
+
+    The reference is taken first, so the blob row stays locked until the
+    caller commits. A concurrent collect() of the same content therefore
+    either finishes before we check exists(), or waits for us.
+    Returns the blob key to save on the post/story/user row.
+    """
+    tmp = _hashed_temp(file_storage, backend.temp_folder)
+    key = blob_key(tmp.hexdigest(), file_storage.filename)
+    acquire(cursor, key, tmp.size)
+    if not backend.exists(key):
+        backend.put(tmp.path, key)
+    tmp.close()
+    return key
+
+
+def acquire(cursor, key, size=0):
+    cursor.execute("""
+        INSERT INTO blobs (storage_key, size, refcount, created_at)
+        VALUES (%s, %s, 1, %s)
+        ON DUPLICATE KEY UPDATE refcount = refcount + 1
+    """, (key, size, datetime.now()))
+
+
+def release(cursor, key):
+    """Drop one reference (no-op for None or unknown keys). Call collect()
+    after committing."""
+    if key:
+        cursor.execute("UPDATE blobs SET refcount = refcount - 1 WHERE storage_key=%s AND refcount > 0",
+                       (key,))
+
+
+def collect(backend, conn, keys, on_delete=None):
+    """Delete blobs in `keys` that nothing references any more.
+
+    The file is removed while the row is still locked and the row deleted
+    after, so a concurrent store_upload() of the same bytes (which blocks
+    on that row) always sees the file gone and writes it back.
+    Returns the keys deleted.
+    """
+    deleted = []
+    cursor = conn.cursor()
+    for key in {k for k in keys if k}:
+        cursor.execute("SELECT refcount FROM blobs WHERE storage_key=%s FOR UPDATE", (key,))
+        row = cursor.fetchone()
+        if row is None or row[0] > 0:
+            conn.rollback()
+            continue
+        backend.delete(key)
+        if on_delete:
+            on_delete(key)
+        cursor.execute("DELETE FROM blobs WHERE storage_key=%s", (key,))
+        conn.commit()
+        deleted.append(key)
+    cursor.close()
+    return deleted
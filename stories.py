@@ -0,0 +1,193 @@
+"""Stories: uploads shown in the bar above the feed until they expire.
+
+Each story has an `expires_at` (indexed, see migrations.py), so the bar
+is a range read on that index instead of a scan over every story ever
+posted. The bar is the same for everyone; each worker caches it for a few
+seconds and drops the copy when a story is posted on any worker (via the
+realtime event bus).
+
+Expired stories are deleted in batches by the reaper, which also releases
+their media and queues a media.collect job for it, so the job worker
+removes files nothing uses any more. It runs as a background thread in
+every worker (STORY_REAP_INTERVAL=0 turns that off) and as
+`flask reap-stories`.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import realtime
+import storage
+
+STORY_TTL = timedelta(hours=int(os.environ.get("STORY_TTL_HOURS", "24")))
+# Seconds a worker reuses the active-stories list
+STORIES_CACHE_TTL = float(os.environ.get("STORIES_CACHE_TTL", "10"))
+STORY_REAP_BATCH = int(os.environ.get("STORY_REAP_BATCH", "500"))
+# Seconds between reaper runs in each worker; 0 leaves it to the CLI
+STORY_REAP_INTERVAL = int(os.environ.get("STORY_REAP_INTERVAL", "300"))
+
+TOPIC = "stories"
+
+log = logging.getLogger(__name__)
+
+
+def load_active_stories(cursor, now=None):
+    """Unexpired stories grouped per user, most recently active user first;
+    each user's stories oldest first (the order they are watched in)."""
+    cursor.execute("""
+        SELECT s.id, s.user_id, s.media_filename, s.created_at,
+               u.username, u.profile_picture
+        FROM stories s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.expires_at > %s
+        ORDER BY s.expires_at
+    """, (now or datetime.now(),))
+    groups = {}
+    for row in cursor.fetchall():
+        group = groups.get(row["user_id"])
+        if group is None:
+            group = groups[row["user_id"]] = {
+                "user_id": row["user_id"],
+                "username": row["username"],
+                "profile_picture": row["profile_picture"],
+                "stories": [],
+            }
+        group["stories"].append({
+            "id": row["id"],
+            "media_filename": row["media_filename"],
+            "created_at": row["created_at"],
+        })
+    return sorted(groups.values(), key=lambda g: g["stories"][-1]["created_at"], reverse=True)
+
+
+class ActiveStoriesCache:
+    """The active-stories list, reloaded at most every `ttl` seconds."""
+
+    def __init__(self, ttl=STORIES_CACHE_TTL):
+        self.ttl = ttl
+        self._value = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, load):
+        if self._value is not None and time.monotonic() - self._loaded_at < self.ttl:
+            self.hits += 1
+            return self._value
+        # One reload at a time; requests arriving meanwhile get its result
+        with self._lock:
+            if self._value is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self.misses += 1
+                self._value = load()
+                self._loaded_at = time.monotonic()
+            else:
+                self.hits += 1
+            return self._value
+
+    def invalidate(self, payload=None):
+        self._value = None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "ttl": self.ttl}
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_cache(get_pool):
+    """This worker's stories cache, subscribed to story events."""
+    global _cache, _cache_pid
+    pid = os.getpid()
+    if _cache_pid != pid:
+        with _cache_lock:
+            if _cache_pid != pid:
+                _cache = ActiveStoriesCache()
+                realtime.get_bus(get_pool).subscribe(TOPIC, _cache.invalidate)
+                _cache_pid = pid
+    return _cache
+
+
+def story_posted(get_pool, user_id, conn):
+    """Tell every worker's cache about a committed story."""
+    realtime.get_bus(get_pool).publish(TOPIC, str(user_id), conn)
+
+
+# ----- reaper -----
+
+def reap_expired(conn, on_release, batch_size=STORY_REAP_BATCH, now=None, log=None):
+    """Delete expired stories `batch_size` at a time, one transaction per
+    batch. `on_release(cursor, keys)` is called in that transaction with
+    the media released, to queue their collection. Returns stories deleted."""
+    now = now or datetime.now()
+    total = 0
+    cursor = conn.cursor()
+    while True:
+        # Locking read: a reaper in another worker waits here, then skips
+        # the rows this one deleted, so each reference is released once.
+        cursor.execute("""
+            SELECT id, media_filename FROM stories
+            WHERE expires_at <= %s
+            ORDER BY expires_at
+            LIMIT %s
+            FOR UPDATE
+        """, (now, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.commit()
+            break
+        ids = [row[0] for row in rows]
+        placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(f"DELETE FROM stories WHERE id IN ({placeholders})", ids)
+        for _, key in rows:
+            storage.release(cursor, key)
+        on_release(cursor, [key for _, key in rows])
+        conn.commit()
+        total += len(rows)
+        if log:
+            log(f"stories: deleted {total} expired")
+        if len(rows) < batch_size:
+            break
+    cursor.close()
+    return total
+
+
+_reaper = None
+_reaper_pid = None
+_reaper_lock = threading.Lock()
+
+
+def start_reaper(get_pool, on_release, interval=STORY_REAP_INTERVAL):
+    """Start this worker's reaper thread, if enabled and not running."""
+    global _reaper, _reaper_pid
+    if interval <= 0:
+        return
+    pid = os.getpid()
+    if _reaper_pid == pid and _reaper.is_alive():
+        return
+    with _reaper_lock:
+        if _reaper_pid != pid or not _reaper.is_alive():
+            _reaper = threading.Thread(target=_reap_forever, name="stories-reaper", daemon=True,
+                                       args=(get_pool, on_release, interval))
+            _reaper.start()
+            _reaper_pid = pid
+
+
+def _reap_forever(get_pool, on_release, interval):
+    while True:
+        # Jitter so the workers don't all reap at the same moment
+        time.sleep(interval * random.uniform(0.5, 1.5))
+        pool = get_pool()
+        conn = pool.acquire()
+        try:
+            reap_expired(conn, on_release)
+        except Exception:
+            log.exception("story reaper failed")
+            pool.release(conn, discard=True)
+        else:
+            pool.release(conn)
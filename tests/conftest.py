@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# As the benchmark runs it: one process, no background threads
+os.environ.setdefault("REALTIME_BUS", "local")
+os.environ.setdefault("STORY_REAP_INTERVAL", "0")
+
+TEST_SIZES = {"users": 20, "posts": 200, "likes": 500, "saves": 50, "follows": 60,
+              "stories": 10, "messages": 200}
+
+
+@pytest.fixture(scope="session")
+def standin():
+    """The benchmark's in-memory MySQL stand-in, serving a small dataset."""
+    from bench import seed, standin
+    return standin.install(seed.generate(TEST_SIZES))
+
+
+@pytest.fixture(scope="session")
+def app_module(standin):
+    import app
+    app.app.config["TESTING"] = True
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def log_in(client, user_id=1):
+    from bench import seed
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+        session["username"] = seed.username(user_id)
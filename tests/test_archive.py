@@ -0,0 +1,194 @@
+import hashlib
+import io
+import re
+import sqlite3
+import tarfile
+
+import mysql.connector
+import pytest
+
+import archive
+import storage
+from conftest import log_in
+
+
+class SqliteConnection:
+    """The archive tables in an in-memory SQLite database, behind the
+    few MySQL spellings archive.py uses."""
+
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        for table, columns, _, _ in archive.TABLES:
+            key = ", PRIMARY KEY (id)" if "id" in columns else ""
+            self.db.execute(f"CREATE TABLE {table} ({', '.join(columns)}{key})")
+        self.db.execute("CREATE UNIQUE INDEX users_username ON users (username)")
+        self.db.execute("CREATE TABLE archive_imports (archive_id, member, row_count, "
+                        "imported_at, PRIMARY KEY (archive_id, member))")
+        self.db.execute("CREATE TABLE blobs (storage_key PRIMARY KEY, size, refcount, "
+                        "created_at)")
+
+    def cursor(self, **kwargs):
+        return SqliteCursor(self.db)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def rows(self, table):
+        return self.db.execute(f"SELECT * FROM {table} ORDER BY 1, 2").fetchall()
+
+
+class SqliteCursor:
+    def __init__(self, db):
+        self.cursor = db.cursor()
+        self.rowcount = -1
+
+    def execute(self, sql, params=()):
+        if sql.startswith("START TRANSACTION"):
+            return
+        sql = sql.replace("%s", "?").replace("INSERT IGNORE", "INSERT OR IGNORE")
+        sql = re.sub(r"ON DUPLICATE KEY UPDATE (\w+) = (.*)",
+                     lambda m: f"ON CONFLICT (storage_key) DO UPDATE SET {m.group(1)} = "
+                     + re.sub(r"VALUES\((\w+)\)", r"excluded.\1", m.group(2)), sql)
+        try:
+            self.cursor.execute(sql, tuple(params))
+        except sqlite3.IntegrityError as e:
+            raise mysql.connector.IntegrityError(msg=str(e)) from None
+        self.rowcount = self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+@pytest.fixture
+def no_derive(monkeypatch):
+    # Counters and inboxes are MySQL statements; the rows are what's tested
+    for table in ("follows", "posts", "likes", "messages"):
+        monkeypatch.setitem(archive._DERIVE, table, lambda cursor, rows: None)
+
+
+@pytest.fixture
+def site(tmp_path):
+    conn = SqliteConnection()
+    backend = storage.LocalStorage(str(tmp_path / "src"))
+    data = b"pixels" * 1000
+    key = storage.blob_key(hashlib.sha256(data).hexdigest(), "a.jpg")
+    tmp = storage.HashingTempFile(backend.temp_folder)
+    tmp.write(data)
+    tmp.flush()
+    backend.put(tmp.path, key)
+    tmp.close()
+    db = conn.db
+    db.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+                   [(i, f"u{i}", "scrypt$x$y", key if i == 1 else None, "bio é")
+                    for i in range(1, 11)])
+    db.executemany("INSERT INTO posts VALUES (?, ?, ?, ?, ?)",
+                   [(i, i % 10 + 1, f"post {i}", key if i % 7 == 0 else None,
+                     "2024-01-02 03:04:05") for i in range(1, 51)])
+    db.executemany("INSERT INTO likes VALUES (?, ?, ?)",
+                   [(i, i % 50 + 1, i % 10 + 1) for i in range(1, 31)])
+    db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                   [(i, i % 10 + 1, (i + 1) % 10 + 1, "hi", "2024-01-02 03:04:05")
+                    for i in range(1, 21)])
+    db.commit()
+    return conn, backend, key
+
+
+def test_export_then_import_round_trips(site, tmp_path, no_derive):
+    src, backend, key = site
+    data = b"".join(archive.export_archive(src, backend, chunk_rows=16,
+                                           password_hashes=True))
+    assert "media/" + key in tarfile.open(fileobj=io.BytesIO(data)).getnames()
+
+    dst = SqliteConnection()
+    target = storage.LocalStorage(str(tmp_path / "dst"))
+    stored = []
+    stats = archive.import_archive(dst, io.BytesIO(data), target,
+                                   on_media=lambda cursor, k: stored.append(k))
+    assert stats["rows"] == 10 + 50 + 30 + 20 and stats["media"] == 1
+    for table, _, _, _ in archive.TABLES:
+        assert dst.rows(table) == src.rows(table), table
+    assert stored == [key]
+    with target.open(key) as f, backend.open(key) as g:
+        assert f.read() == g.read()
+
+
+def test_export_leaves_out_password_hashes(site, no_derive):
+    src, backend, _ = site
+    data = b"".join(archive.export_archive(src, backend, user_id=3))
+    dst = SqliteConnection()
+    archive.import_archive(dst, io.BytesIO(data), backend)
+    assert dst.rows("users") == [(3, "u3", archive.UNUSABLE_PASSWORD, None, "bio é")]
+
+
+def test_interrupted_import_resumes(site, tmp_path, monkeypatch, no_derive):
+    src, backend, _ = site
+    data = b"".join(archive.export_archive(src, backend, chunk_rows=16,
+                                           password_hashes=True))
+    dst = SqliteConnection()
+    target = storage.LocalStorage(str(tmp_path / "dst"))
+    real_import_chunk = archive._import_chunk
+    calls = []
+
+    def interrupted(*args):
+        calls.append(args[2])
+        if len(calls) == 4:
+            raise ConnectionError("server gone")
+        return real_import_chunk(*args)
+    monkeypatch.setattr(archive, "_import_chunk", interrupted)
+    with pytest.raises(ConnectionError):
+        archive.import_archive(dst, io.BytesIO(data), target)
+    monkeypatch.setattr(archive, "_import_chunk", real_import_chunk)
+
+    stats = archive.import_archive(dst, io.BytesIO(data), target)
+    assert stats["chunks_skipped"] == 3
+    for table, _, _, _ in archive.TABLES:
+        assert dst.rows(table) == src.rows(table), table
+    assert archive.import_archive(dst, io.BytesIO(data), target)["rows"] == 0
+
+
+def test_site_import_into_a_used_site_conflicts(site, no_derive):
+    src, backend, _ = site
+    data = b"".join(archive.export_archive(src, backend))
+    with pytest.raises(archive.ImportConflict):
+        archive.import_archive(src, io.BytesIO(data), backend)
+
+
+def test_truncated_archive_is_invalid(site):
+    src, backend, _ = site
+    data = b"".join(archive.export_archive(src, backend))
+    with pytest.raises(archive.InvalidArchive):
+        archive.import_archive(SqliteConnection(), io.BytesIO(data[:300]), backend)
+
+
+@pytest.mark.parametrize("method", ["HEAD", "GET"])
+def test_export_returns_its_connection(client, app_module, method):
+    log_in(client)
+    pool = app_module.get_pool()
+    in_use = pool.stats()["in_use"]
+    resp = client.open("/export", method=method)
+    assert resp.status_code == 200
+    resp.close()
+    assert pool.stats()["in_use"] == in_use
+
+
+def test_export_abandoned_midway_discards_its_connection(client, app_module):
+    log_in(client)
+    pool = app_module.get_pool()
+    in_use, discarded = pool.stats()["in_use"], pool.stats()["discarded"]
+    resp = client.get("/export", buffered=False)
+    next(resp.response)
+    resp.close()
+    assert pool.stats()["in_use"] == in_use
+    assert pool.stats()["discarded"] == discarded + 1
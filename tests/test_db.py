@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+import db
+
+
+class StubConnection:
+    def __init__(self, n):
+        self.n = n
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class StubPool(db.ConnectionPool):
+    """A pool whose connections are StubConnections, numbered as opened."""
+
+    def __init__(self, size=2, timeout=0.05):
+        super().__init__(size, timeout)
+        self.opened = []
+
+    def _connect(self):
+        conn = StubConnection(len(self.opened) + 1)
+        self.opened.append(conn)
+        return conn
+
+
+def test_acquire_and_release_reuse_connections():
+    pool = StubPool()
+    conn = pool.acquire()
+    assert pool.stats()["in_use"] == 1
+    pool.release(conn)
+    assert conn.rollbacks == 1
+    assert pool.acquire() is conn
+    assert len(pool.opened) == 1
+    stats = pool.stats()
+    assert (stats["open"], stats["in_use"], stats["checkouts"]) == (1, 1, 2)
+
+
+def test_exhausted_pool_times_out():
+    pool = StubPool(size=2)
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire()
+    stats = pool.stats()
+    assert (stats["open"], stats["in_use"], stats["timeouts"]) == (2, 2, 1)
+
+
+def test_waiter_gets_released_connection():
+    pool = StubPool(size=1, timeout=2)
+    conn = pool.acquire()
+    threading.Timer(0.05, pool.release, (conn,)).start()
+    assert pool.acquire() is conn
+    assert pool.stats()["waits"] == 1
+
+
+def test_discard_closes_and_frees_the_slot():
+    pool = StubPool(size=1)
+    conn = pool.acquire()
+    pool.release(conn, discard=True)
+    assert conn.closed and conn.rollbacks == 0
+    assert pool.stats()["open"] == 0 and pool.stats()["discarded"] == 1
+    assert pool.acquire() is not conn
+    assert len(pool.opened) == 2
+
+
+def test_failed_rollback_discards():
+    pool = StubPool(size=1)
+    conn = pool.acquire()
+
+    def rollback():
+        raise RuntimeError("server gone")
+    conn.rollback = rollback
+    pool.release(conn)
+    assert conn.closed and pool.stats()["open"] == 0
+
+
+def test_get_pool_is_recreated_after_fork(monkeypatch):
+    monkeypatch.setattr(db, "_pool", None)
+    monkeypatch.setattr(db, "_pool_pid", None)
+    monkeypatch.setattr(db.os, "getpid", lambda: 100)
+    parent = db.get_pool()
+    assert db.get_pool() is parent
+    monkeypatch.setattr(db.os, "getpid", lambda: 101)
+    child = db.get_pool()
+    assert child is not parent
+    assert child.stats()["open"] == 0
+
+
+def test_replica_read_count_is_exact_across_threads():
+    replica = db.Replica("replica:3306", StubPool())
+    replica.mark(0.5)
+
+    def read():
+        for _ in range(1000):
+            replica.record_read()
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = replica.stats()
+    assert stats["reads"] == 8000
+    assert stats["usable"] and stats["lag"] == 0.5
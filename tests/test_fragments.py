@@ -0,0 +1,64 @@
+from jinja2 import DictLoader, Environment, select_autoescape
+
+import fragments
+from fragments import fill, overlay, overlay_end, overlay_if
+
+
+def test_fill_replaces_value_markers():
+    html = f"<b class='{overlay('cls')}'>{overlay('label')}</b>"
+    assert fill(html, {"cls": "liked", "label": "Unlike"}) == "<b class='liked'>Unlike</b>"
+
+
+def test_fill_keeps_or_drops_conditional_blocks():
+    html = f"a{overlay_if('owner')}<button>{overlay('label')}</button>{overlay_end('owner')}b"
+    assert fill(html, {"owner": True, "label": "Delete"}) == "a<button>Delete</button>b"
+    assert fill(html, {"owner": False}) == "ab"
+    assert fill(html, {}) == "ab"
+
+
+def test_fill_nested_conditional_blocks():
+    html = (f"{overlay_if('a')}A{overlay_if('b')}B{overlay_end('b')}"
+            f"{overlay('x')}{overlay_end('a')}.")
+    assert fill(html, {"a": True, "b": True, "x": 1}) == "AB1."
+    assert fill(html, {"a": True, "b": False, "x": 1}) == "A1."
+    assert fill(html, {"a": False, "b": True}) == "."
+
+
+def test_fill_without_markers_is_unchanged():
+    assert fill("<p>plain</p>", {"x": 1}) == "<p>plain</p>"
+
+
+def _cache(templates):
+    env = Environment(loader=DictLoader(templates), autoescape=select_autoescape(default=True))
+    return fragments.FragmentCache(fragments.MemoryBackend(), env)
+
+
+def test_user_text_cannot_forge_a_marker():
+    cache = _cache({"card.html": "<p>{{ text }}</p>{{ overlay('label') }}"})
+    html = cache.render("card.html", (1,), {"text": "<!--@label-->"}, {"label": "Like"})
+    assert html == "<p>&lt;!--@label--&gt;</p>Like"
+
+
+def test_render_caches_by_key_and_fills_per_call():
+    cache = _cache({"card.html": "{{ n }}:{{ overlay('who') }}"})
+    assert cache.render("card.html", (1,), {"n": 1}, {"who": "a"}) == "1:a"
+    # Same key: the cached HTML is reused, even with a different context
+    assert cache.render("card.html", (1,), {"n": 2}, {"who": "b"}) == "1:b"
+    assert cache.render("card.html", (2,), {"n": 2}, {"who": "b"}) == "2:b"
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 2}
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = fragments.MemoryBackend(size=2)
+    backend.set("a", "A")
+    backend.set("b", "B")
+    backend.get("a")
+    backend.set("c", "C")
+    assert (backend.get("a"), backend.get("b"), backend.get("c")) == ("A", None, "C")
+
+
+def test_memory_backend_expires_entries():
+    backend = fragments.MemoryBackend(ttl=0)
+    backend.set("a", "A")
+    assert backend.get("a") is None
+    assert len(backend) == 0
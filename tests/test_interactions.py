@@ -0,0 +1,153 @@
+import re
+
+import mysql.connector
+import pytest
+
+import interactions
+from conftest import log_in
+from interactions import InvalidBatch, collapse, parse_ops
+
+
+def ops(*items):
+    return {"ops": [{"seq": seq, "op": op, "post_id": post_id} for seq, op, post_id in items]}
+
+
+def test_parse_ops():
+    assert parse_ops(ops((1, "like", 10), (2, "unsave", 11))) == [
+        (1, "like", 10, True), (2, "save", 11, False)]
+    assert parse_ops({"ops": []}) == []
+
+
+@pytest.mark.parametrize("body", [
+    None,
+    [],
+    {},
+    {"ops": "like"},
+    {"ops": [{"seq": 1, "op": "boop", "post_id": 1}]},
+    {"ops": [{"seq": 1, "op": "like"}]},
+    {"ops": [{"op": "like", "post_id": 1}]},
+    {"ops": [{"seq": "1", "op": "like", "post_id": 1}]},
+    {"ops": [{"seq": 1, "op": "like", "post_id": 1.5}]},
+    {"ops": [{"seq": 1, "op": "like", "post_id": True}]},
+    {"ops": ["like"]},
+])
+def test_parse_ops_rejects_bad_input(body):
+    with pytest.raises(InvalidBatch):
+        parse_ops(body)
+
+
+def test_parse_ops_batch_size_limit():
+    limit = interactions.BATCH_MAX_OPS
+    assert len(parse_ops(ops(*[(i, "like", i) for i in range(limit)]))) == limit
+    with pytest.raises(InvalidBatch, match="at most"):
+        parse_ops(ops(*[(i, "like", i) for i in range(limit + 1)]))
+
+
+def test_collapse_keeps_last_op_per_post_and_kind():
+    final = collapse(parse_ops(ops(
+        (1, "like", 10), (2, "unlike", 10),  # like then unlike: ends unliked
+        (5, "save", 10), (3, "unsave", 10),  # out of order: seq 5 wins
+        (4, "like", 11),
+    )))
+    assert final == {("like", 10): (2, False), ("save", 10): (5, True), ("like", 11): (4, True)}
+
+
+class StubCursor:
+    """Answers apply()'s reads: every post in `posts` exists, the user
+    already likes `liked`; records the writes."""
+
+    def __init__(self, posts, liked=()):
+        self.posts = posts
+        self.liked = set(liked)
+        self.writes = []
+        self.rows = []
+
+    def execute(self, sql, params):
+        sql = re.sub(r"\s+", " ", sql).strip()
+        if sql.startswith("SELECT id FROM posts"):
+            self.rows = [{"id": p} for p in params if p in self.posts]
+        elif sql.startswith("SELECT post_id FROM likes"):
+            self.rows = [{"post_id": p} for p in params[1:] if p in self.liked]
+        elif sql.startswith("SELECT post_id FROM saved_posts"):
+            self.rows = []
+        elif sql.startswith("SELECT id, like_count"):
+            self.rows = [{"id": p, "like_count": self.posts[p]} for p in params]
+        else:
+            self.writes.append(sql.split(" ")[0])
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def test_like_then_unlike_in_one_batch_writes_nothing():
+    cursor = StubCursor({10: 3})
+    final = collapse(parse_ops(ops((1, "like", 10), (2, "unlike", 10))))
+    assert interactions.apply(cursor, 1, final) == {10: {"seq": 2, "like_count": 3, "liked": False}}
+    assert cursor.writes == []
+
+
+def test_apply_skips_posts_that_dont_exist():
+    cursor = StubCursor({10: 0})
+    final = collapse(parse_ops(ops((1, "like", 10), (2, "like", 99))))
+    assert set(interactions.apply(cursor, 1, final)) == {10}
+    assert cursor.writes == ["INSERT", "UPDATE"]
+
+
+class StubConnection:
+    def __init__(self):
+        self.commits = self.rollbacks = 0
+
+    def cursor(self, dictionary=False):
+        return StubCursor({})
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_apply_batch_retries_deadlocks(monkeypatch):
+    failures = [mysql.connector.Error(errno=1213), mysql.connector.Error(errno=1213)]
+
+    def apply(cursor, user_id, final):
+        if failures:
+            raise failures.pop()
+        return {"ok": True}
+    monkeypatch.setattr(interactions, "apply", apply)
+    conn = StubConnection()
+    assert interactions.apply_batch(conn, 1, {}, attempts=3) == {"ok": True}
+    assert (conn.rollbacks, conn.commits) == (2, 1)
+
+
+def test_apply_batch_gives_up_and_passes_other_errors(monkeypatch):
+    def deadlock(cursor, user_id, final):
+        raise mysql.connector.Error(errno=1213)
+    monkeypatch.setattr(interactions, "apply", deadlock)
+    conn = StubConnection()
+    with pytest.raises(mysql.connector.Error):
+        interactions.apply_batch(conn, 1, {}, attempts=2)
+    assert conn.rollbacks == 2
+
+    def lock_timeout(cursor, user_id, final):
+        raise mysql.connector.Error(errno=1205)
+    monkeypatch.setattr(interactions, "apply", lock_timeout)
+    conn = StubConnection()
+    with pytest.raises(mysql.connector.Error):
+        interactions.apply_batch(conn, 1, {}, attempts=3)
+    assert conn.rollbacks == 1
+
+
+def test_batch_api(client, standin):
+    assert client.post("/batch_api", json=ops((1, "like", 1))).status_code == 403
+    log_in(client, 1)
+    assert client.post("/batch_api", json={"ops": "nope"}).status_code == 400
+    post_id = next(p for p in sorted(standin.posts) if (p, 1) not in standin.likes)
+    before = standin.posts[post_id]["like_count"]
+    resp = client.post("/batch_api", json=ops((1, "like", post_id), (2, "save", post_id)))
+    assert resp.status_code == 200
+    result = resp.get_json()["posts"][str(post_id)]
+    assert result == {"seq": 2, "like_count": before + 1, "liked": True, "saved": True}
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import log_in
+from pagination import InvalidCursor, decode_cursor, encode_cursor, split_page
+
+
+def test_cursor_round_trip():
+    created = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    token = encode_cursor(created, 42)
+    assert "=" not in token
+    assert decode_cursor(token) == (created, 42)
+
+
+def test_empty_cursor_is_the_first_page():
+    assert decode_cursor(None) is None
+    assert decode_cursor("") is None
+
+
+@pytest.mark.parametrize("token", [
+    "not a cursor",
+    "!!!!",
+    encode_cursor(datetime(2024, 1, 1), 1)[:-3],
+    "MjAyNC0wMS0wMXxhYmM",  # 2024-01-01|abc
+    "Zm9v",  # foo
+    "/w",  # not UTF-8
+])
+def test_bad_cursor_raises_invalid_cursor(token):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(token)
+
+
+def test_split_page_cursor_points_after_last_row():
+    rows = [{"id": 3 - i, "created_at": datetime(2024, 1, 3 - i)} for i in range(3)]
+    page, cursor = split_page(rows, 2)
+    assert [r["id"] for r in page] == [3, 2]
+    assert decode_cursor(cursor) == (datetime(2024, 1, 2), 2)
+    assert split_page(rows, 3) == (rows, None)
+
+
+def test_tampered_cursor_in_html_shows_first_page(client):
+    log_in(client)
+    first = client.get("/feed")
+    tampered = client.get("/feed?cursor=%2F%2F%2Fnot-base64")
+    assert first.status_code == tampered.status_code == 200
+    assert tampered.data == first.data
+
+
+@pytest.mark.parametrize("url", [
+    "/feed_api?cursor=Zm9v",
+    "/messages_api/user000002?before=Zm9v",
+])
+def test_tampered_cursor_in_api_is_400(client, url):
+    log_in(client)
+    resp = client.get(url)
+    assert resp.status_code == 400
+    assert "cursor" in resp.get_json()["error"]
@@ -0,0 +1,79 @@
+import pytest
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import passwords
+from passwords import Hasher, method_prefix
+
+
+@pytest.mark.parametrize("method", [
+    "scrypt", "scrypt:32768:8:1", "scrypt:16384:8:2",
+    "pbkdf2", "pbkdf2:sha512", "pbkdf2:sha256:1000",
+])
+def test_method_prefix_matches_what_werkzeug_writes(method):
+    written = generate_password_hash("x", method, passwords.PASSWORD_SALT_LENGTH)
+    assert method_prefix(method) == written.partition("$")[0]
+
+
+def test_needs_rehash_without_hashing():
+    hasher = Hasher(threads=1, method="scrypt:16384:8:1")
+    current = generate_password_hash("pw", "scrypt:16384:8:1", passwords.PASSWORD_SALT_LENGTH)
+    assert not hasher.needs_rehash(current)
+    assert hasher.needs_rehash(
+        generate_password_hash("pw", "scrypt:32768:8:1", passwords.PASSWORD_SALT_LENGTH))
+    assert hasher.needs_rehash(
+        generate_password_hash("pw", "pbkdf2:sha256:1000", passwords.PASSWORD_SALT_LENGTH))
+    assert hasher.needs_rehash(generate_password_hash("pw", "scrypt:16384:8:1", 8))
+    assert hasher.stats()["completed"] == 0
+
+
+def test_full_queue_is_busy():
+    hasher = Hasher(threads=1, queue=0, timeout=5)
+    hasher._slots.acquire()  # the one slot is taken
+    with pytest.raises(passwords.Busy):
+        hasher.check("pbkdf2:sha256:1000$salt$00", "pw")
+    assert hasher.stats()["rejected"] == 1
+
+
+@pytest.fixture
+def old_hash_user(standin):
+    user = standin.users[3]
+    saved = user["password_hash"]
+    user["password_hash"] = generate_password_hash("pw", "pbkdf2:sha256:1000")
+    yield user
+    user["password_hash"] = saved
+
+
+def _log_in(client, user, password="pw"):
+    return client.post("/login", data={"username": user["username"], "password": password})
+
+
+def test_login_upgrades_an_old_hash(client, old_hash_user):
+    old = old_hash_user["password_hash"]
+    assert _log_in(client, old_hash_user).status_code == 302
+    new = old_hash_user["password_hash"]
+    assert new != old and new.startswith(method_prefix(passwords.PASSWORD_HASH_METHOD) + "$")
+    assert check_password_hash(new, "pw")
+
+
+def test_busy_rehash_still_logs_in(client, old_hash_user, monkeypatch):
+    def busy(password):
+        raise passwords.Busy("queue full")
+    monkeypatch.setattr(passwords.get_hasher(), "hash", busy)
+    old = old_hash_user["password_hash"]
+    resp = _log_in(client, old_hash_user)
+    assert resp.status_code == 302 and resp.location.endswith("/feed")
+    assert old_hash_user["password_hash"] == old
+
+
+def test_busy_check_is_503(client, old_hash_user, monkeypatch):
+    def busy(password_hash, password):
+        raise passwords.Busy("queue full")
+    monkeypatch.setattr(passwords.get_hasher(), "check", busy)
+    resp = _log_in(client, old_hash_user)
+    assert resp.status_code == 503 and resp.headers["Retry-After"]
+
+
+def test_wrong_password_is_not_upgraded(client, old_hash_user):
+    old = old_hash_user["password_hash"]
+    assert _log_in(client, old_hash_user, "nope").status_code == 200
+    assert old_hash_user["password_hash"] == old
@@ -0,0 +1,146 @@
+import gzip
+import json
+
+import brotli
+import pytest
+from flask import Flask, Response, flash, get_flashed_messages, jsonify
+
+import responses
+from conftest import log_in
+
+BIG = "cat " * 1000
+
+
+def make_app():
+    app = Flask(__name__)
+    app.secret_key = "test"
+    responses.init_app(app)
+
+    @app.route("/flash")
+    def set_flash():
+        flash("Welcome back!", "success")
+        return "ok"
+
+    @app.route("/messages")
+    def messages():
+        return jsonify(get_flashed_messages(with_categories=True))
+
+    @app.route("/big")
+    def big():
+        resp = Response(BIG, mimetype="text/html")
+        resp.set_etag("v1")
+        return resp
+
+    @app.route("/small")
+    def small():
+        return Response("x" * (responses.COMPRESS_MIN_SIZE - 1), mimetype="text/html")
+
+    @app.route("/binary")
+    def binary():
+        return Response(b"\0" * 5000, mimetype="image/png")
+
+    @app.route("/stream")
+    def stream():
+        return Response((f"line {i}\n" for i in range(100)), mimetype="text/plain")
+
+    @app.route("/events")
+    def events():
+        return Response((f"data: {i}\n\n" for i in range(100)), mimetype="text/event-stream")
+
+    return app
+
+
+def test_flash_round_trips_through_session_cookie():
+    client = make_app().test_client()
+    client.get("/flash")
+    assert client.get("/messages").get_json() == [["success", "Welcome back!"]]
+
+
+def test_session_keeps_tagged_values():
+    app = make_app()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["pair"] = (1, "two")
+        session["blob"] = b"\x00\x01"
+    with client.session_transaction() as session:
+        assert session["pair"] == (1, "two")
+        assert session["blob"] == b"\x00\x01"
+
+
+@pytest.mark.parametrize("accept, encoding", [
+    ("gzip, deflate, br", "br"),
+    ("br;q=0.5, gzip", "gzip"),
+    ("gzip", "gzip"),
+    ("br", "br"),
+])
+def test_picks_encoding_from_accept_encoding(accept, encoding):
+    resp = make_app().test_client().get("/big", headers={"Accept-Encoding": accept})
+    assert resp.headers["Content-Encoding"] == encoding
+    decode = brotli.decompress if encoding == "br" else gzip.decompress
+    assert decode(resp.data).decode() == BIG
+    assert "Accept-Encoding" in resp.headers["Vary"]
+
+
+@pytest.mark.parametrize("accept", [None, "identity", "deflate"])
+def test_no_acceptable_encoding_sends_plain(accept):
+    headers = {"Accept-Encoding": accept} if accept else {}
+    resp = make_app().test_client().get("/big", headers=headers)
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data.decode() == BIG
+    assert "Accept-Encoding" in resp.headers["Vary"]
+
+
+def test_small_and_binary_bodies_are_not_compressed():
+    client = make_app().test_client()
+    for url in ("/small", "/binary"):
+        resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers, url
+
+
+def test_head_is_not_compressed():
+    resp = make_app().test_client().head("/big", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_compression_weakens_the_etag():
+    client = make_app().test_client()
+    assert client.get("/big").headers["ETag"] == '"v1"'
+    resp = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["ETag"] == 'W/"v1"'
+    assert resp.get_etag() == ("v1", True)
+
+
+def test_streamed_body_is_compressed_chunk_by_chunk():
+    client = make_app().test_client()
+    resp = client.get("/stream", headers={"Accept-Encoding": "gzip"}, buffered=False)
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in resp.headers
+    chunks = [chunk for chunk in resp.response if chunk]
+    # One flushed piece per line, each decodable as it arrives
+    assert len(chunks) > 1
+    assert gzip.decompress(b"".join(chunks)).decode() == "".join(f"line {i}\n" for i in range(100))
+
+
+def test_event_streams_are_not_compressed():
+    resp = make_app().test_client().get("/events", headers={"Accept-Encoding": "gzip, br"})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data.startswith(b"data: 0\n\n")
+
+
+def test_messages_api_sends_users_map_and_epoch_times(client, standin):
+    (sender, recipient), rows = next((pair, rows) for pair, rows in standin.messages.items()
+                                     if rows and pair[0] != pair[1])
+    log_in(client, sender)
+    other = standin.users[recipient]["username"]
+    resp = client.get(f"/messages_api/{other}")
+    assert resp.status_code == 200
+    body = json.loads(resp.data)
+    assert body["users"] == {str(sender): {"username": standin.users[sender]["username"]},
+                             str(recipient): {"username": other}}
+    assert body["messages"]
+    for msg in body["messages"]:
+        assert set(msg) == {"id", "sender_id", "content", "created_at"}
+        assert isinstance(msg["created_at"], int)
+    sent = {m["id"]: m for m in body["messages"]}
+    row = rows[-1]
+    assert sent[row["id"]]["created_at"] == responses.epoch(row["created_at"])
@@ -0,0 +1,16 @@
+import search
+
+
+def test_fulltext_query_requires_every_word():
+    assert search.fulltext_query("sunset beach") == "+sunset +beach*"
+
+
+def test_fulltext_query_drops_stopwords_and_short_words():
+    assert search.fulltext_query("the cat") == "+cat*"
+    assert search.fulltext_query("Cat ON a mat") == "+Cat +mat*"
+
+
+def test_fulltext_query_without_indexed_words():
+    assert search.fulltext_query("the") is None
+    assert search.fulltext_query("is it") is None
+    assert search.fulltext_query("+-*") is None
@@ -0,0 +1,143 @@
+import errno
+import os
+import re
+
+import storage
+
+KEY = "ab/cd/" + "ab" * 32 + ".jpg"
+
+
+class BlobsConnection:
+    """Just enough of a connection for acquire/release/collect: a dict of
+    storage_key -> refcount behind the statements they issue."""
+
+    def __init__(self):
+        self.refcounts = {}
+        self.commits = 0
+
+    def cursor(self):
+        return BlobsCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class BlobsCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, sql, params):
+        refcounts = self.conn.refcounts
+        sql = re.sub(r"\s+", " ", sql).strip()
+        key = params[0]
+        if sql.startswith("INSERT INTO blobs"):
+            refcounts[key] = refcounts.get(key, 0) + 1
+        elif sql.startswith("UPDATE blobs SET refcount = refcount - 1"):
+            if refcounts.get(key, 0) > 0:
+                refcounts[key] -= 1
+        elif sql.startswith("SELECT refcount"):
+            self.row = (refcounts[key],) if key in refcounts else None
+        elif sql.startswith("DELETE FROM blobs"):
+            del refcounts[key]
+        else:
+            raise AssertionError(sql)
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+def _temp_file(backend, data=b"pixels"):
+    tmp = storage.HashingTempFile(backend.temp_folder)
+    tmp.write(data)
+    tmp.flush()
+    return tmp
+
+
+def test_temp_folder_is_inside_the_root(tmp_path):
+    backend = storage.LocalStorage(str(tmp_path))
+    assert backend.temp_folder == os.path.join(str(tmp_path), storage.TEMP_DIR)
+
+
+def test_put_renames_the_temp_file(tmp_path, monkeypatch):
+    backend = storage.LocalStorage(str(tmp_path))
+    tmp = _temp_file(backend)
+    copies = []
+    monkeypatch.setattr(storage.shutil, "copyfile", lambda *a: copies.append(a))
+    backend.put(tmp.path, KEY)
+    tmp.close()
+    assert copies == []
+    assert backend.exists(KEY) and not os.path.exists(tmp.path)
+    with backend.open(KEY) as f:
+        assert f.read() == b"pixels"
+
+
+def test_put_across_filesystems_never_leaves_a_partial_file(tmp_path, monkeypatch):
+    backend = storage.LocalStorage(str(tmp_path))
+    tmp = _temp_file(backend)
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if src == tmp.path:
+            raise OSError(errno.EXDEV, "cross-device link")
+        return real_replace(src, dst)
+    monkeypatch.setattr(storage.os, "replace", replace)
+
+    def failing_copy(src, dst):
+        with open(dst, "wb") as f:
+            f.write(b"pix")
+        raise OSError(errno.ENOSPC, "disk full")
+    monkeypatch.setattr(storage.shutil, "copyfile", failing_copy)
+    try:
+        backend.put(tmp.path, KEY)
+    except OSError:
+        pass
+    assert not backend.exists(KEY)
+    assert os.listdir(os.path.dirname(backend._path(KEY))) == []
+
+    monkeypatch.undo()
+    monkeypatch.setattr(storage.os, "replace", replace)
+    backend.put(tmp.path, KEY)
+    tmp.close()
+    with backend.open(KEY) as f:
+        assert f.read() == b"pixels"
+    assert not os.path.exists(tmp.path)
+
+
+def test_release_then_collect_deletes_unreferenced_blobs(tmp_path):
+    backend = storage.LocalStorage(str(tmp_path))
+    conn = BlobsConnection()
+    cursor = conn.cursor()
+    other = "cd/ef/" + "cd" * 32 + ".png"
+    for key in (KEY, KEY, other):
+        storage.acquire(cursor, key)
+        tmp = _temp_file(backend)
+        if not backend.exists(key):
+            backend.put(tmp.path, key)
+        tmp.close()
+    assert conn.refcounts == {KEY: 2, other: 1}
+
+    storage.release(cursor, KEY)
+    storage.release(cursor, other)
+    storage.release(cursor, None)
+    deleted = []
+    assert storage.collect(backend, conn, [KEY, other, other, None],
+                           on_delete=deleted.append) == [other]
+    assert deleted == [other]
+    assert backend.exists(KEY) and not backend.exists(other)
+    assert conn.refcounts == {KEY: 1}
+
+
+def test_release_never_goes_below_zero(tmp_path):
+    conn = BlobsConnection()
+    cursor = conn.cursor()
+    storage.acquire(cursor, KEY)
+    storage.release(cursor, KEY)
+    storage.release(cursor, KEY)
+    assert conn.refcounts == {KEY: 0}
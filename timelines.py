@@ -0,0 +1,140 @@
+"""Home timelines: posts by the people a user follows, newest first.
+
+Fan-out on write: creating a post inserts the author's own `timelines`
+row in the same transaction as the post (so they see it at once), and
+queues a job that inserts one row per follower (jobs.py). Reading a
+home page is then a range read on (user_id, created_at, post_id)
+instead of a join over follows and posts.
+
+Accounts with FANOUT_MAX_FOLLOWERS or more followers are not fanned out;
+one post would mean that many inserts. Their followers pull those posts
+at read time from posts (user_id, created_at) and merge them into the
+page. An account that drops back under the limit has its posts from the
+pull period missing from home timelines (they stay on its profile).
+"""
+import os
+
+from pagination import keyset_filter, split_page
+
+FANOUT_MAX_FOLLOWERS = int(os.environ.get("FANOUT_MAX_FOLLOWERS", "5000"))
+# Recent posts copied into your timeline when you follow someone
+FOLLOW_BACKFILL = int(os.environ.get("FOLLOW_BACKFILL", "50"))
+
+
+def follow(cursor, follower_id, followee_id):
+    """Returns False if already following (or following yourself)."""
+    if follower_id == followee_id:
+        return False
+    cursor.execute("""
+        INSERT IGNORE INTO follows (follower_id, followee_id, created_at)
+        VALUES (%s, %s, NOW())
+    """, (follower_id, followee_id))
+    if cursor.rowcount != 1:
+        return False
+    cursor.execute("UPDATE users SET follower_count = follower_count + 1 WHERE id=%s",
+                   (followee_id,))
+    cursor.execute("""
+        INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+        SELECT %s, p.id, p.user_id, p.created_at
+        FROM posts p
+        JOIN users u ON u.id = p.user_id
+        WHERE p.user_id = %s AND u.follower_count < %s
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT %s
+    """, (follower_id, followee_id, FANOUT_MAX_FOLLOWERS, FOLLOW_BACKFILL))
+    return True
+
+
+def unfollow(cursor, follower_id, followee_id):
+    """Returns False if not following."""
+    cursor.execute("DELETE FROM follows WHERE follower_id=%s AND followee_id=%s",
+                   (follower_id, followee_id))
+    if cursor.rowcount != 1:
+        return False
+    cursor.execute("UPDATE users SET follower_count = follower_count - 1 WHERE id=%s AND follower_count > 0",
+                   (followee_id,))
+    cursor.execute("DELETE FROM timelines WHERE user_id=%s AND author_id=%s",
+                   (follower_id, followee_id))
+    return True
+
+
+def is_following(cursor, follower_id, followee_id):
+    cursor.execute("SELECT 1 FROM follows WHERE follower_id=%s AND followee_id=%s",
+                   (follower_id, followee_id))
+    return cursor.fetchone() is not None
+
+
+def count_following(cursor, user_id):
+    cursor.execute("SELECT COUNT(*) AS c FROM follows WHERE follower_id=%s", (user_id,))
+    row = cursor.fetchone()
+    return row["c"] if isinstance(row, dict) else row[0]
+
+
+def add_own(cursor, author_id, post_id, created_at):
+    """Put a new post in its author's timeline. Run in the transaction
+    that inserts the post."""
+    cursor.execute("""
+        INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+        VALUES (%s, %s, %s, %s)
+    """, (author_id, post_id, author_id, created_at))
+
+
+def fan_out(cursor, post_id):
+    """Put a post in the timeline of each of its author's followers (if
+    the author is below the limit). Runs as a job, after the post was
+    committed; does nothing if it was deleted since, and is safe to
+    repeat."""
+    cursor.execute("""
+        INSERT IGNORE INTO timelines (user_id, post_id, author_id, created_at)
+        SELECT f.follower_id, p.id, p.user_id, p.created_at
+        FROM posts p
+        JOIN users u ON u.id = p.user_id
+        JOIN follows f ON f.followee_id = p.user_id
+        WHERE p.id = %s AND u.follower_count < %s
+    """, (post_id, FANOUT_MAX_FOLLOWERS))
+    return cursor.rowcount
+
+
+def remove_post(cursor, post_id):
+    cursor.execute("DELETE FROM timelines WHERE post_id=%s", (post_id,))
+
+
+def load_home_ids(cursor, user_id, position, limit):
+    """One page of a home timeline as rows of {id, created_at}, plus the
+    next cursor. Merges the materialized timeline with posts pulled from
+    followed accounts that are over the fan-out limit."""
+    where, params = keyset_filter(position, "t.created_at", "t.post_id")
+    cursor.execute(f"""
+        SELECT t.post_id AS id, t.created_at
+        FROM timelines t
+        WHERE t.user_id = %s {"AND " + where if where else ""}
+        ORDER BY t.created_at DESC, t.post_id DESC
+        LIMIT %s
+    """, [user_id] + params + [limit + 1])
+    rows = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT f.followee_id
+        FROM follows f
+        JOIN users u ON u.id = f.followee_id
+        WHERE f.follower_id = %s AND u.follower_count >= %s
+    """, (user_id, FANOUT_MAX_FOLLOWERS))
+    pulled = [r["followee_id"] for r in cursor.fetchall()]
+    if pulled:
+        where, params = keyset_filter(position, "p.created_at", "p.id")
+        placeholders = ", ".join(["%s"] * len(pulled))
+        cursor.execute(f"""
+            SELECT p.id, p.created_at
+            FROM posts p
+            WHERE p.user_id IN ({placeholders}) {"AND " + where if where else ""}
+            ORDER BY p.created_at DESC, p.id DESC
+            LIMIT %s
+        """, pulled + params + [limit + 1])
+        # Posts from before the account went over the limit are in both
+        merged = {r["id"]: r for r in rows}
+        for r in cursor.fetchall():
+            merged.setdefault(r["id"], r)
+        rows = sorted(merged.values(), key=lambda r: (r["created_at"], r["id"]), reverse=True)
+        rows = rows[:limit + 1]
+
+    return split_page(rows, limit)
@@ -0,0 +1,154 @@
+"""Cached user lookups.
+
+Profile pages and every message poll resolve a username to a user. Each
+worker keeps recently used users in an LRU cache (USER_CACHE_SIZE
+entries, USER_CACHE_TTL seconds), keyed by id and by username, holding
+only the public columns: never password_hash.
+
+Edits and follows call user_changed(), which drops the entry in every
+worker and replica through the realtime event bus (REALTIME_BUS=mysql
+shares it; local only reaches this process). The TTL bounds how stale an
+entry can get if an event is missed.
+
+Login still reads the users table directly, since it needs the hash.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import realtime
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "60"))
+
+# What callers get back
+COLUMNS = ("id", "username", "profile_picture", "bio", "follower_count")
+
+TOPIC = "users"
+
+
+def load_user(cursor, column, value):
+    """One user's public columns by `id` or `username`, or None."""
+    cursor.execute(f"SELECT {', '.join(COLUMNS)} FROM users WHERE {column}=%s", (value,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row if isinstance(row, dict) else dict(zip(COLUMNS, row))
+
+
+class UserCache:
+    """LRU of users by id, with a username -> id index."""
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._users = OrderedDict()  # id -> (user, expires_at)
+        self._ids = {}               # username -> id
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        user, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._drop(user_id)
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    def _put(self, user):
+        self._users[user["id"]] = (user, time.monotonic() + self.ttl)
+        self._users.move_to_end(user["id"])
+        self._ids[user["username"]] = user["id"]
+        while len(self._users) > self.size:
+            self._drop(next(iter(self._users)))
+
+    def _drop(self, user_id):
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self._ids.pop(entry[0]["username"], None)
+
+    def by_id(self, user_id, get_conn):
+        """The user with this id, or None. `get_conn` is only called on a
+        miss, so a hit needs no database connection at all."""
+        with self._lock:
+            user = self._get(user_id)
+            if user is not None:
+                self.hits += 1
+                return dict(user)
+            self.misses += 1
+            generation = self.invalidations
+        return self._load("id", user_id, get_conn, generation)
+
+    def by_username(self, username, get_conn):
+        """Same, by username. Only the stored spelling is cached; other
+        spellings MySQL's collation accepts are loaded every time."""
+        with self._lock:
+            user_id = self._ids.get(username)
+            user = self._get(user_id) if user_id is not None else None
+            if user is not None:
+                self.hits += 1
+                return dict(user)
+            self.misses += 1
+            generation = self.invalidations
+        return self._load("username", username, get_conn, generation)
+
+    def _load(self, column, value, get_conn, generation):
+        cursor = get_conn().cursor(dictionary=True)
+        try:
+            user = load_user(cursor, column, value)
+        finally:
+            cursor.close()
+        if user is not None:
+            with self._lock:
+                # Skip it if an invalidation arrived while loading: the row
+                # read may predate the change
+                if generation == self.invalidations:
+                    self._put(user)
+            user = dict(user)
+        return user
+
+    def invalidate(self, payload=None):
+        """Forget one user (payload is the id as text), or everyone."""
+        with self._lock:
+            self.invalidations += 1
+            if payload is None:
+                self._users.clear()
+                self._ids.clear()
+            else:
+                self._drop(int(payload))
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations, "entries": len(self._users),
+                    "size": self.size, "ttl": self.ttl}
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_cache(get_pool):
+    """This worker's user cache, subscribed to user change events."""
+    global _cache, _cache_pid
+    pid = os.getpid()
+    if _cache_pid != pid:
+        with _cache_lock:
+            if _cache_pid != pid:
+                _cache = UserCache()
+                realtime.get_bus(get_pool).subscribe(TOPIC, _cache.invalidate)
+                _cache_pid = pid
+    return _cache
+
+
+def user_changed(get_pool, user_id, conn):
+    """Drop a user from every worker's cache. Call after committing the
+    change; publishing commits `conn`."""
+    realtime.get_bus(get_pool).publish(TOPIC, str(user_id), conn)
@@ -0,0 +1,7 @@
+"""WSGI entry point: gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is built by importing app.py; create_app() only applies config.
+"""
+from app import create_app
+
+app = create_app()